@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+"""
+Нагрузочный тест эндпоинтов приложения
+
+Приложение запускается из make_app() в production-настройках на
+свободном порту, база заполняется набором данных заданного размера
+(generate_dataset.py), после чего каждый маршрут нагружается
+параллельными запросами. Для каждого
+маршрута выводятся req/s, p50/p99 задержки и количество команд Redis и
+round trip на запрос; результаты дописываются в файл для сравнения между
+коммитами.
+
+По умолчанию используется Redis в процессе (fakeredis). Для замеров на
+настоящем Redis укажите --redis: подключение берется из переменных
+REDIS_*, а база очищается перед каждым набором данных, поэтому нужен
+также флаг --flush.
+
+Примеры:
+    python benchmark.py --sizes 1000
+    python benchmark.py --redis --flush --sizes 1000,100000,1000000 --concurrency 100
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import logging
+import os
+import subprocess
+import sys
+import time
+from urllib.parse import urlencode
+
+import tornado.httpclient
+import tornado.httpserver
+import tornado.netutil
+
+# Импортируем наше приложение
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import main
+from generate_dataset import dataset_counts, load
+
+# Маршруты: (имя, метод, путь, доля от --requests)
+ROUTES = [
+    ("index", "GET", "/", 1),
+    ("hospital list", "GET", "/hospital", 1),
+    ("doctor list", "GET", "/doctor", 1),
+    ("patient list", "GET", "/patient", 1),
+    ("diagnosis list", "GET", "/diagnosis", 1),
+    ("doctor-patient list", "GET", "/doctor-patient", 1),
+    ("hospital doctors", "GET", "/hospital/{hospital}/doctors", 1),
+    ("patient chart", "GET", "/patient/{patient}/chart", 1),
+    ("patient by mpn", "GET", "/patient/by-mpn/{mpn}", 1),
+    ("patients by born date", "GET", "/patient/born?from=1950-01-01&to=1960-12-31", 1),
+    ("patient search", "GET", "/search/patient?q=iv", 1),
+    ("doctor search", "GET", "/search/doctor?q=sur", 1),
+    ("analytics", "GET", "/analytics", 1),
+    ("top diagnoses", "GET", "/analytics/diagnoses/top", 1),
+    ("hospital top diagnoses", "GET", "/analytics/diagnoses/top?hospital={hospital}", 1),
+    ("health", "GET", "/health", 1),
+    ("export hospital", "GET", "/export/hospital", 0.01),
+    ("create hospital", "POST", "/hospital", 1),
+    ("create doctor", "POST", "/doctor", 1),
+    ("create patient", "POST", "/patient", 1),
+    ("create diagnosis", "POST", "/diagnosis", 1),
+    ("create doctor-patient", "POST", "/doctor-patient", 1),
+]
+
+DEFAULT_RESULTS_FILE = "benchmark_results.jsonl"
+
+
+def percentile(values, fraction: float) -> float:
+    """Процентиль по ближайшему рангу"""
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def redis_totals():
+    """Команды и round trip Redis, учтенные метриками процесса"""
+    commands = sum(main.metrics.redis_commands.values())
+    round_trips = sum(histogram.count for histogram in main.metrics.redis_durations.values())
+    return commands, round_trips
+
+
+async def drive_route(client, base_url: str, route, generator, requests: int, concurrency: int):
+    """Нагрузка одного маршрута: requests запросов в concurrency потоков"""
+    name, method, path, share = route
+    total = max(1, int(requests * share))
+    latencies = []
+    errors = 0
+    remaining = iter(range(total))
+
+    async def worker():
+        nonlocal errors
+        for _ in remaining:
+            patient = generator.pick("patient")
+            url = base_url + path.format(hospital=generator.pick("hospital"), patient=patient,
+                                         mpn=generator.patient_mpn(patient))
+            body = None
+            if method == "POST":
+                body = urlencode(generator.make_row(path.lstrip("/")))
+            started = time.perf_counter()
+            response = await client.fetch(url, method=method, body=body, raise_error=False)
+            latencies.append(time.perf_counter() - started)
+            if response.code >= 400:
+                errors += 1
+
+    commands_before, round_trips_before = redis_totals()
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(min(concurrency, total))))
+    elapsed = time.perf_counter() - started
+    commands_after, round_trips_after = redis_totals()
+
+    return {
+        'route': name,
+        'method': method,
+        'requests': total,
+        'errors': errors,
+        'rps': round(total / elapsed, 1),
+        'p50_ms': round(percentile(latencies, 0.5) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 2),
+        'redis_commands_per_request': round((commands_after - commands_before) / total, 2),
+        'redis_round_trips_per_request': round((round_trips_after - round_trips_before) / total, 2),
+    }
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def load_previous(path: str, commit: str):
+    """Последние результаты других коммитов: (redis, размер, маршрут) -> запись"""
+    previous = {}
+    if not os.path.exists(path):
+        return previous
+    with open(path) as results:
+        for line in results:
+            record = json.loads(line)
+            if record['commit'] != commit:
+                previous[(record['redis'], record['size'], record['route'])] = record
+    return previous
+
+
+def print_results(size: int, results, previous, redis_name: str):
+    print(f"\nDataset: {size} entities ({redis_name})")
+    print(f"{'route':<24}{'req/s':>10}{'p50 ms':>10}{'p99 ms':>10}{'cmd/req':>10}{'rt/req':>10}{'errors':>8}  vs prev")
+    for result in results:
+        before = previous.get((redis_name, size, result['route']))
+        change = f"{(result['rps'] / before['rps'] - 1) * 100:+.1f}% ({before['commit']})" if before else ""
+        print(f"{result['route']:<24}{result['rps']:>10}{result['p50_ms']:>10}{result['p99_ms']:>10}"
+              f"{result['redis_commands_per_request']:>10}{result['redis_round_trips_per_request']:>10}"
+              f"{result['errors']:>8}  {change}")
+
+
+async def run_benchmark(args):
+    if args.redis:
+        redis_name = "redis"
+    else:
+        import fakeredis
+        main.r = fakeredis.FakeAsyncRedis()
+        redis_name = "stand-in"
+
+    app = main.make_app(production=True)
+    sockets = tornado.netutil.bind_sockets(0, "127.0.0.1")
+    server = tornado.httpserver.HTTPServer(app)
+    server.add_sockets(sockets)
+    base_url = f"http://127.0.0.1:{sockets[0].getsockname()[1]}"
+    client = tornado.httpclient.AsyncHTTPClient(max_clients=args.concurrency)
+
+    commit = git_commit()
+    previous = load_previous(args.output, commit)
+    timestamp = datetime.datetime.now().isoformat(timespec="seconds")
+
+    for size in args.sizes:
+        await main.r.flushdb()
+        main.response_cache.clear()
+        main.entity_cache.clear()
+        await main.init_db()
+
+        started = time.perf_counter()
+        generator = await load(main.r, dataset_counts(size))
+        print(f"\nSeeded {size} entities in {time.perf_counter() - started:.1f} s")
+
+        results = []
+        for route in ROUTES:
+            results.append(await drive_route(client, base_url, route, generator, args.requests, args.concurrency))
+        print_results(size, results, previous, redis_name)
+
+        with open(args.output, "a") as output:
+            for result in results:
+                record = {'commit': commit, 'timestamp': timestamp, 'redis': redis_name, 'size': size,
+                          'concurrency': args.concurrency, **result}
+                output.write(json.dumps(record) + "\n")
+
+    server.stop()
+    client.close()
+    print(f"\nResults appended to {args.output}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Load benchmark of the application endpoints")
+    parser.add_argument("--redis", action="store_true",
+                        help="use the Redis configured by REDIS_* variables instead of the in-process stand-in")
+    parser.add_argument("--flush", action="store_true",
+                        help="allow flushing the configured Redis database (required with --redis)")
+    parser.add_argument("--sizes", default="1000",
+                        type=lambda value: [int(size) for size in value.split(",")],
+                        help="comma-separated dataset sizes, e.g. 1000,100000,1000000")
+    parser.add_argument("--requests", type=int, default=1000, help="requests per route")
+    parser.add_argument("--concurrency", type=int, default=20, help="concurrent requests")
+    parser.add_argument("--output", default=DEFAULT_RESULTS_FILE, help="file the results are appended to")
+    args = parser.parse_args(argv)
+    if args.redis and not args.flush:
+        parser.error("--redis flushes the configured database before seeding; confirm with --flush")
+    return args
+
+
+if __name__ == "__main__":
+    # Под нагрузкой запросы ждут в очереди event loop и превышают порог
+    # длительности журнала медленных запросов
+    logging.getLogger().setLevel(logging.ERROR)
+    args = parse_args()
+    # Путь результатов - относительно каталога запуска, а не приложения
+    args.output = os.path.abspath(args.output)
+    # Шаблоны и статические файлы задаются путями относительно каталога приложения
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    asyncio.run(run_benchmark(args))
@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+"""
+Генератор синтетического набора данных для оценки нагрузки
+
+Создает больницы, врачей (с существующим hospital_ID), пациентов
+(корректные sex, mpn, born_date), диагнозы и связи врач-пациент. Записи
+загружаются теми же Lua-скриптами, что и формы, пакетами через pipeline
+(в режиме кластера записи пишутся вторым pipeline пакета), поэтому записи
+(`{model}:{id}`, `doctor-patient:{id}`), счетчики ID, счетчики аналитики и
+индексы совпадают с создаваемыми приложением.
+Подключение к Redis задается переменными REDIS_*; новые записи
+добавляются к существующим и ссылаются только на созданные в этом запуске.
+Результат каждой строки проверяется: если скрипт отклонил запись
+(занятый номер полиса, отсутствующая связанная запись), загрузка
+прерывается с DatasetError.
+
+Примеры:
+    python generate_dataset.py --size 100000
+    python generate_dataset.py --hospitals 50 --doctors 2000 --patients 100000 --diagnoses 300000 --links 150000 --skew 1.5
+"""
+import argparse
+import asyncio
+import datetime
+import os
+import random
+import sys
+import time
+
+# Импортируем наше приложение
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import main
+
+# Доля каждой модели в наборе данных по умолчанию
+DEFAULT_SHARES = {
+    "hospital": 0.01,
+    "doctor": 0.09,
+    "patient": 0.4,
+    "diagnosis": 0.3,
+    "doctor-patient": 0.2,
+}
+
+# Модели в порядке создания (ссылки указывают на уже созданные записи)
+# и параметры командной строки с количеством их записей
+MODEL_OPTIONS = {
+    "hospital": "hospitals",
+    "doctor": "doctors",
+    "patient": "patients",
+    "diagnosis": "diagnoses",
+    "doctor-patient": "links",
+}
+
+SURNAMES = ["Ivanov", "Petrova", "Smirnov", "Kuznetsova", "Popov", "Sokolova", "Lebedev", "Novikova"]
+PROFESSIONS = ["surgeon", "therapist", "cardiologist", "neurologist", "pediatrician", "oncologist"]
+DIAGNOSIS_TYPES = ["flu", "cold", "fracture", "hypertension", "diabetes", "asthma", "migraine"]
+
+
+class DatasetError(Exception):
+    """Строки набора, отклоненные при загрузке"""
+
+
+def dataset_counts(size: int, shares=DEFAULT_SHARES):
+    """Количество записей каждой модели в наборе из size сущностей"""
+    return {model: max(1, int(size * share)) for model, share in shares.items()}
+
+
+class DatasetGenerator:
+    """Случайные записи моделей со ссылками на записи того же набора
+
+    ids - ID созданных записей каждой модели в порядке создания: ID
+    выдает скрипт создания, и при параллельной записи других клиентов
+    они идут с пропусками. first_mpn - первый номер полиса набора. При
+    skew > 0 ссылки распределены неравномерно: записи, созданные раньше,
+    получают больше врачей, диагнозов и связей.
+    """
+
+    def __init__(self, counts, skew: float = 0.0, seed: int = None, first_mpn: int = 1):
+        self.counts = counts
+        self.skew = skew
+        self.random = random.Random(seed)
+        self.next_mpn = first_mpn
+        self.ids = {model: [] for model in main.ENTITY_MODELS}
+        self.mpns = {}
+
+    def add_created(self, model: str, entity_id: int, data):
+        """Учет записи, созданной скриптом"""
+        if model in self.ids:
+            self.ids[model].append(entity_id)
+        if model == "patient":
+            self.mpns[str(entity_id)] = data['mpn']
+
+    def pick(self, model: str) -> str:
+        """ID существующей записи модели"""
+        ids = self.ids[model]
+        if not ids:
+            raise DatasetError(f"No {model} records were created to reference")
+        return str(ids[int(len(ids) * self.random.random() ** (1 + self.skew))])
+
+    def patient_mpn(self, patient_id) -> str:
+        """Номер полиса пациента набора"""
+        return self.mpns[str(patient_id)]
+
+    def make_row(self, model: str):
+        rng = self.random
+        if model == "hospital":
+            return {'name': f"City Hospital {rng.randint(1, 10 ** 6)}",
+                    'address': f"{rng.randint(1, 200)} Main st.",
+                    'phone': str(rng.randint(10 ** 9, 10 ** 10 - 1)),
+                    'beds_number': str(rng.randint(20, 2000))}
+        if model == "doctor":
+            return {'surname': rng.choice(SURNAMES), 'profession': rng.choice(PROFESSIONS),
+                    'hospital_ID': self.pick("hospital")}
+        if model == "patient":
+            born_date = datetime.date(1930, 1, 1) + datetime.timedelta(days=rng.randint(0, 90 * 365))
+            # Уникален, как требует индекс MPN
+            mpn = str(10 ** 9 + self.next_mpn)
+            self.next_mpn += 1
+            return {'surname': rng.choice(SURNAMES), 'born_date': born_date.isoformat(),
+                    'sex': rng.choice("MF"), 'mpn': mpn}
+        if model == "diagnosis":
+            return {'patient_ID': self.pick("patient"), 'type': rng.choice(DIAGNOSIS_TYPES),
+                    'information': "generated"}
+        return {'doctor_ID': self.pick("doctor"), 'patient_ID': self.pick("patient")}
+
+
+async def load(redis_conn, counts, skew: float = 0.0, seed: int = None, progress=None):
+    """Загрузка набора пакетами через pipeline
+
+    Возвращает генератор набора (с ID созданных записей).
+    progress(model, created) вызывается после каждого пакета. Если скрипт
+    отклонил строки пакета, загрузка прерывается с DatasetError.
+    """
+    await redis_conn.script_load(main.CREATE_ENTITY_LUA)
+    await redis_conn.script_load(main.LINK_DOCTOR_PATIENT_LUA)
+    await redis_conn.script_load(main.FANOUT_REFS_LUA)
+
+    # Номера полисов продолжают нумерацию пациентов и не совпадают с прежними
+    first_mpn = int(await redis_conn.get(main.AUTO_ID_KEY.format("patient")) or 1)
+
+    generator = DatasetGenerator(counts, skew, seed, first_mpn)
+    for model in MODEL_OPTIONS:
+        model_spec = main.MODELS[model]
+        count = counts[model]
+        for start in range(0, count, main.PIPELINE_BATCH_SIZE):
+            rows = [generator.make_row(model) for _ in range(start, min(start + main.PIPELINE_BATCH_SIZE, count))]
+            results = await main.create_records(model_spec, rows, redis_conn)
+
+            created = []
+            errors = []
+            for data, result in zip(rows, results):
+                if isinstance(result, Exception):
+                    errors.append(str(result))
+                elif result is None:
+                    errors.append(model_spec.reference_message)
+                elif result == main.DUPLICATE:
+                    errors.append(model_spec.unique_message)
+                else:
+                    created.append((result, data))
+            for (entity_id, _, _), data in created:
+                generator.add_created(model, entity_id, data)
+            if errors:
+                # Созданные до ошибки записи остаются в базе
+                raise DatasetError(f"{model}: {len(errors)} of {len(rows)} rows in batch rejected "
+                                   f"after {start + len(created)} created: {errors[0]}")
+            if progress:
+                progress(model, min(start + main.PIPELINE_BATCH_SIZE, count))
+    return generator
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Generate a synthetic hospital dataset in Redis")
+    parser.add_argument("--size", type=int, default=10000,
+                        help="total number of entities split by the default shares")
+    for model, option in MODEL_OPTIONS.items():
+        parser.add_argument(f"--{option}", dest=model, type=int,
+                            help=f"number of {model} records (overrides --size share)")
+    parser.add_argument("--skew", type=float, default=0.0,
+                        help="reference skew: 0 - uniform, larger values concentrate doctors, "
+                             "diagnoses and links on fewer hospitals and patients")
+    parser.add_argument("--seed", type=int, help="random seed for a reproducible dataset")
+    args = parser.parse_args(argv)
+
+    args.counts = dataset_counts(args.size)
+    for model in MODEL_OPTIONS:
+        if getattr(args, model) is not None:
+            args.counts[model] = getattr(args, model)
+    if any(count < 1 for count in args.counts.values()):
+        parser.error("every model needs at least one record")
+    return args
+
+
+async def run(args):
+    await main.init_db()
+    started = time.monotonic()
+
+    def progress(model, created):
+        print(f"\r{model}: {created}/{args.counts[model]}", end="", flush=True)
+        if created == args.counts[model]:
+            print()
+
+    try:
+        await load(main.r, args.counts, args.skew, args.seed, progress)
+    except DatasetError as e:
+        print(f"\nDataset load failed: {e}", file=sys.stderr)
+        sys.exit(1)
+    seconds = time.monotonic() - started
+    total = sum(args.counts.values())
+    print(f"Created {total} records in {seconds:.1f} s ({total / seconds:.0f} records/s)")
+
+
+if __name__ == "__main__":
+    asyncio.run(run(parse_args()))
@@ -3,387 +3,2298 @@
 Hospital Management Application - Рефакторинг
 """
 
+import asyncio
+import bisect
+import csv
+import datetime
+import inspect
+from collections import OrderedDict
+import io
 import logging
 import os
+import string
+import tempfile
+import time
 import redis
+import redis.asyncio as aioredis
+from redis.asyncio.cluster import RedisCluster
+from redis.asyncio.retry import Retry
+from redis.backoff import ExponentialBackoff
+import tornado.httpserver
 import tornado.ioloop
+import tornado.netutil
+import tornado.process
 import tornado.web
-from tornado.options import parse_command_line
-from typing import Dict, List, Optional, Any
+from tornado.options import define, options, parse_command_line
+from typing import Dict, List, Optional, Any, Tuple
 import json
 
 # Настройки порта
 PORT = 8888
 
+# Режим запуска: development (один процесс, autoreload и отладка) или
+# production (несколько процессов на общем сокете, кэш шаблонов)
+define("mode", default=os.environ.get("APP_MODE", "development"),
+       help="run mode: development or production")
+define("workers", default=int(os.environ.get("APP_WORKERS", "0")),
+       help="number of worker processes in production mode (0 - one per CPU core)")
+
+# Модели сущностей с автоинкрементными ID
+ENTITY_MODELS = ("hospital", "doctor", "patient", "diagnosis")
+
+# Параметры постраничного вывода списков
+DEFAULT_PAGE_LIMIT = 100
+MAX_PAGE_LIMIT = 1000
+# Возрастные группы аналитики: нижние границы, лет
+AGE_BUCKETS = (0, 18, 30, 45, 60, 75)
+# Количество типов в рейтинге диагнозов
+DEFAULT_TOP_DIAGNOSES = 10
+MAX_TOP_DIAGNOSES = 100
+# Количество результатов поиска по префиксу
+DEFAULT_SEARCH_LIMIT = 20
+MAX_SEARCH_LIMIT = 100
+# Количество команд в одном pipeline (один round trip к Redis)
+PIPELINE_BATCH_SIZE = 500
+# Количество страниц списков в кэше ответов процесса
+RESPONSE_CACHE_SIZE = int(os.environ.get("RESPONSE_CACHE_SIZE", "256"))
+# Кэш записей сущностей процесса: количество записей и время жизни, с
+ENTITY_CACHE_SIZE = int(os.environ.get("ENTITY_CACHE_SIZE", "10000"))
+ENTITY_CACHE_TTL = float(os.environ.get("ENTITY_CACHE_TTL", "300"))
+# Пороги журнала медленных запросов: длительность, мс, и количество round trip
+# к Redis (признак N+1; команды pipeline идут за один round trip)
+SLOW_REQUEST_MS = float(os.environ.get("SLOW_REQUEST_MS", "100"))
+SLOW_REQUEST_ROUND_TRIPS = int(os.environ.get("SLOW_REQUEST_ROUND_TRIPS", "10"))
+# Cookie с временем последней записи клиента: пока не истекло окно
+# REDIS_READ_PRIMARY_AFTER_WRITE, чтения клиента идут на primary
+LAST_WRITE_COOKIE = "last_write"
+# Период сохранения снимка метрик рабочего процесса для /metrics других процессов, с
+METRICS_FLUSH_INTERVAL = float(os.environ.get("METRICS_FLUSH_INTERVAL", "5"))
+# Общий каталог снимков метрик рабочих процессов: постоянное имя по порту,
+# поэтому перезапуски не оставляют новых каталогов
+METRICS_DIR = os.environ.get("METRICS_DIR") or os.path.join(tempfile.gettempdir(), f"hospital-metrics-{PORT}")
+# Режим кластера: возраст незавершенного создания записи, после которого
+# recover_pending завершает или откатывает его, с (см. ClusterCreate)
+PENDING_TIMEOUT = float(os.environ.get("PENDING_TIMEOUT", "60"))
+
+# Массовый импорт: максимальный размер тела запроса и число ошибок в отчете
+IMPORT_MAX_BODY_SIZE = 10 * 1024 ** 3
+IMPORT_MAX_ERRORS = 100
+# Недоступность Redis: соединение разорвано или ответ не получен за socket_timeout
+REDIS_ERRORS = (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError)
+
+
+class RedisCommandCluster(RedisCluster):
+    """Клиент Redis Cluster, не повторяющий команды после таймаута
+
+    По таймауту неизвестно, выполнена ли команда, и повтор скрипта
+    создания мог бы записать сущность дважды.
+    """
+    ERRORS_ALLOW_RETRY = (redis.exceptions.ConnectionError, redis.exceptions.ClusterDownError)
+
+
 class RedisManager:
-    """Класс для управления подключением к Redis"""
+    """Класс для управления подключением к Redis
+
+    Используется асинхронный клиент: обращения к Redis не блокируют
+    IOLoop Tornado, и один процесс обслуживает много запросов параллельно.
+    Параметры пула соединений, таймауты и политика повторов задаются
+    переменными окружения (см. load_settings). При REDIS_CLUSTER=1
+    используется клиент Redis Cluster: REDIS_HOST и REDIS_PORT задают
+    узел, по которому определяется состав кластера.
+
+    REDIS_REPLICAS задает реплики для чтения ("host:port,host:port"):
+    у каждой свой пул, реплики выдаются по кругу (get_read_connection), а
+    реплика с ошибкой соединения пропускается replica_retry_interval
+    секунд. В режиме кластера реплики не используются.
+    """
+
+    def __init__(self, environ=None):
+        self.settings = self.load_settings(os.environ if environ is None else environ)
+        self.replicas = []
+        if self.settings['cluster']:
+            self.pool = None
+            self.connection = self.create_cluster(self.settings)
+        else:
+            self.pool = self.create_pool(self.settings)
+            self.connection = aioredis.StrictRedis(connection_pool=self.pool)
+            for host, port in self.settings['replicas']:
+                # Повтор на реплике заменяет переход на primary
+                replica_settings = dict(self.settings, host=host, port=port, unix_socket_path=None, retries=0)
+                self.replicas.append(aioredis.StrictRedis(connection_pool=self.create_pool(replica_settings)))
+        # Момент, до которого реплика считается недоступной (time.monotonic)
+        self.replica_down_until = [0.0] * len(self.replicas)
+        self.next_replica = 0
+
+    @staticmethod
+    def load_settings(environ) -> Dict[str, Any]:
+        """Чтение настроек подключения из переменных окружения"""
+        return {
+            'host': environ.get("REDIS_HOST", "localhost"),
+            'port': int(environ.get("REDIS_PORT", "6379")),
+            'unix_socket_path': environ.get("REDIS_UNIX_SOCKET") or None,
+            'cluster': environ.get("REDIS_CLUSTER", "0") == "1",
+            'max_connections': int(environ.get("REDIS_MAX_CONNECTIONS", "50")),
+            'pool_timeout': float(environ.get("REDIS_POOL_TIMEOUT", "5")),
+            'connect_timeout': float(environ.get("REDIS_CONNECT_TIMEOUT", "2")),
+            'socket_timeout': float(environ.get("REDIS_SOCKET_TIMEOUT", "5")),
+            'health_check_interval': int(environ.get("REDIS_HEALTH_CHECK_INTERVAL", "30")),
+            'retries': int(environ.get("REDIS_RETRIES", "3")),
+            'retry_backoff_base': float(environ.get("REDIS_RETRY_BACKOFF_BASE", "0.05")),
+            'retry_backoff_cap': float(environ.get("REDIS_RETRY_BACKOFF_CAP", "1")),
+            'replicas': RedisManager.parse_addresses(environ.get("REDIS_REPLICAS", "")),
+            'replica_retry_interval': float(environ.get("REDIS_REPLICA_RETRY_INTERVAL", "5")),
+            'read_primary_after_write': float(environ.get("REDIS_READ_PRIMARY_AFTER_WRITE", "5")),
+        }
 
-    def __init__(self):
-        self.connection = redis.StrictRedis(
-            host=os.environ.get("REDIS_HOST", "localhost"),
-            port=int(os.environ.get("REDIS_PORT", "6379")),
-            db=0,
-            decode_responses=False  # Оставляем как есть для совместимости
+    @staticmethod
+    def parse_addresses(value: str) -> List[Tuple[str, int]]:
+        """Разбор списка адресов "host:port,host" (порт по умолчанию 6379)"""
+        addresses = []
+        for address in value.split(","):
+            address = address.strip()
+            if address:
+                host, _, port = address.partition(":")
+                addresses.append((host, int(port or "6379")))
+        return addresses
+
+    @staticmethod
+    def create_pool(settings: Dict[str, Any]):
+        """Создание пула соединений
+
+        BlockingConnectionPool ограничивает число соединений и при их
+        исчерпании ждет освобождения не дольше pool_timeout вместо
+        открытия новых соединений без ограничений.
+        """
+        connection_kwargs = {
+            'db': 0,
+            'decode_responses': False,  # Оставляем как есть для совместимости
+            'socket_connect_timeout': settings['connect_timeout'],
+            'socket_timeout': settings['socket_timeout'],
+            'health_check_interval': settings['health_check_interval'],
+            'retry': RedisManager.create_retry(settings),
+            # Без явного списка ошибок redis-py не повторяет команды вовсе
+            'retry_on_error': [redis.exceptions.ConnectionError],
+        }
+
+        if settings['unix_socket_path']:
+            connection_kwargs['connection_class'] = aioredis.UnixDomainSocketConnection
+            connection_kwargs['path'] = settings['unix_socket_path']
+        else:
+            connection_kwargs['host'] = settings['host']
+            connection_kwargs['port'] = settings['port']
+
+        return aioredis.BlockingConnectionPool(
+            max_connections=settings['max_connections'],
+            timeout=settings['pool_timeout'],
+            **connection_kwargs
+        )
+
+    @staticmethod
+    def create_cluster(settings: Dict[str, Any]):
+        """Создание клиента Redis Cluster
+
+        Соединения открываются с каждым узлом по мере надобности, не более
+        max_connections на узел; состав кластера читается при первой
+        команде и обновляется по ответам MOVED.
+        """
+        return RedisCommandCluster(
+            host=settings['host'],
+            port=settings['port'],
+            max_connections=settings['max_connections'],
+            decode_responses=False,
+            socket_connect_timeout=settings['connect_timeout'],
+            socket_timeout=settings['socket_timeout'],
+            health_check_interval=settings['health_check_interval'],
+            retry=RedisManager.create_retry(settings),
+            retry_on_error=[redis.exceptions.ConnectionError],
+            # Повторы команды целиком, с обновлением состава кластера
+            cluster_error_retry_attempts=settings['retries'],
+        )
+
+    @staticmethod
+    def create_retry(settings: Dict[str, Any]) -> Retry:
+        """Политика повтора команд: retries повторов с экспоненциальной паузой
+
+        Повторяются только ошибки соединения. После таймаута команда могла
+        быть выполнена, поэтому скрипты создания не повторяются вслепую.
+        """
+        return Retry(
+            ExponentialBackoff(cap=settings['retry_backoff_cap'], base=settings['retry_backoff_base']),
+            settings['retries'],
+            supported_errors=(redis.exceptions.ConnectionError,),
         )
 
     def get_connection(self):
         return self.connection
 
+    def get_read_connection(self, primary):
+        """Клиент для чтения: следующая доступная реплика или primary
+
+        Если реплик нет или все недоступны, возвращается primary.
+        """
+        now = time.monotonic()
+        for _ in range(len(self.replicas)):
+            index = self.next_replica
+            self.next_replica = (index + 1) % len(self.replicas)
+            if self.replica_down_until[index] <= now:
+                return ReplicaRedis(self, index, primary)
+        return primary
+
+    def mark_replica_down(self, index: int):
+        """Исключение реплики из выдачи на replica_retry_interval секунд"""
+        self.replica_down_until[index] = time.monotonic() + self.settings['replica_retry_interval']
+
+    def replica_stats(self) -> List[Dict[str, Any]]:
+        """Адреса реплик и их доступность для чтения"""
+        now = time.monotonic()
+        return [{'address': f"{host}:{port}", 'available': down_until <= now}
+                for (host, port), down_until in zip(self.settings['replicas'], self.replica_down_until)]
+
+    def reset_after_fork(self):
+        """Сброс соединений, унаследованных от родительского процесса
+
+        Каждый рабочий процесс открывает собственные соединения, иначе
+        процессы делили бы одни и те же сокеты.
+        """
+        if self.pool is None:
+            # У клиента кластера свои соединения у каждого узла
+            for node in self.connection.get_nodes():
+                node._connections.clear()
+                node._free.clear()
+        else:
+            self.pool.reset()
+            for replica in self.replicas:
+                replica.connection_pool.reset()
+
+    def pool_stats(self) -> Dict[str, int]:
+        """Статистика использования пула соединений (в кластере - сумма по узлам)"""
+        if self.pool is None:
+            nodes = self.connection.get_nodes()
+            created = sum(len(node._connections) for node in nodes)
+            idle = sum(len(node._free) for node in nodes)
+            max_connections = sum(node.max_connections for node in nodes)
+        else:
+            # В очереди пула лежат свободные соединения и заглушки None
+            # для еще не созданных соединений
+            idle = sum(1 for connection in self.pool.pool._queue if connection is not None)
+            created = len(self.pool._connections)
+            max_connections = self.pool.max_connections
+        return {
+            'max_connections': max_connections,
+            'created_connections': created,
+            'in_use_connections': created - idle,
+            'idle_connections': idle,
+        }
+
 
 # Глобальный экземпляр Redis
 redis_manager = RedisManager()
 r = redis_manager.get_connection()
+# Режим Redis Cluster: запись создается в несколько шагов (ClusterCreate)
+CLUSTER_MODE = redis_manager.settings['cluster']
+
+
+# Раскладка ключей. Записи сущностей ("{модель}:{ID}") и связей
+# ("doctor-patient:{ID врача}") хранятся без хеш-тега и в Redis Cluster
+# распределяются по узлам. Индексы отдельной сущности имеют тег ее записи
+# ('{patient:1}:doctors' лежит в одном слоте с 'patient:1'). Счетчики ID,
+# общие индексы, счетчики аналитики и версии модели имеют тег модели
+# ('{patient}:ids'): в режиме кластера скрипты создания обновляют их
+# атомарно в одном слоте, а нагрузка разных моделей ложится на разные
+# узлы. Тег '{meta}' - только у служебных ключей базы. В шаблонах для
+# format теги экранированы; IndexFormatter подставляет их по HASH_TAGS.
+HASH_TAGS = ("meta", "hospital", "doctor", "patient", "diagnosis", "doctor-patient")
+
+# Счетчики ID моделей и признак инициализированной базы
+AUTO_ID_KEY = "{{{}}}:autoID"                              # модель -> следующий ID
+DB_INITIATED_KEY = "{meta}:db_initiated"
+
+# Ключи инкрементально поддерживаемых счетчиков аналитики
+ENTITY_COUNT_KEY = "{{{}}}:analytics:count"                # модель -> количество сущностей
+HOSPITAL_DOCTORS_COUNT_KEY = "{doctor}:analytics:hospital-doctors"  # ID больницы -> количество врачей
+PATIENT_DIAGNOSES_COUNT_KEY = "{diagnosis}:analytics:patient-diagnoses"  # ID пациента -> количество диагнозов
+HOSPITAL_NAMES_KEY = "{hospital}:analytics:names"          # ID больницы -> название
+DIAGNOSIS_TYPES_KEY = "{diagnosis}:analytics:types"        # тип диагноза -> количество (sorted set)
+HOSPITAL_DIAGNOSIS_TYPES_KEY = "{{diagnosis}}:analytics:hospital-types:{}"  # то же по больнице
+DIAGNOSIS_HOSPITALS_KEY = "{diagnosis}:index:hospitals"    # ID диагноза -> ID больниц, где он учтен, через запятую
+
+# Вторичные индексы
+IDS_KEY = "{{{}}}:ids"                                     # модель -> ID записей с весом ID (sorted set)
+HOSPITAL_DOCTORS_KEY = "{{hospital:{}}}:doctors"           # ID больницы -> множество ID врачей
+DOCTOR_HOSPITALS_KEY = "{doctor}:index:hospital"           # ID врача -> ID больницы
+PATIENT_DIAGNOSES_KEY = "{{patient:{}}}:diagnoses"         # ID пациента -> множество ID диагнозов
+PATIENT_DOCTORS_KEY = "{{patient:{}}}:doctors"             # ID пациента -> множество ID врачей
+PATIENT_BORN_KEY = "{patient}:index:born"                  # ID пациента с весом ГГГГММДД даты рождения
+PATIENT_MPN_KEY = "{patient}:index:mpn"                    # номер полиса (MPN) -> ID пациента
+SEARCH_KEY = "{{{}}}:search"                               # модель -> "значение\0ID" с весом 0 (ZRANGEBYLEX)
+
+# Версии данных моделей для кэша ответов: увеличиваются каждой записью
+CACHE_VERSION_KEY = "{{{}}}:cache:version"                 # модель -> версия
+
+# Режим кластера: журнал незавершенных созданий (ClusterCreate) и
+# блокировка их восстановления (recover_pending)
+PENDING_KEY = "{{{}}}:pending"                             # ID записи -> JSON: время и данные
+RECOVERY_LOCK_KEY = "{meta}:db:recovery"
+
+# Версия схемы счетчиков и индексов: при ее увеличении init_db
+# один раз перестраивает их по уже сохраненным данным
+INDEX_VERSION_KEY = "{meta}:db:index_version"
+INDEX_VERSION = 11
+# Пересчет заполняет временные ключи (суффикс сохраняет хеш-тег и слот) и
+# переименовывает их на место; одновременно - только в одном процессе
+REBUILD_SUFFIX = ":rebuild"
+REBUILD_LOCK_KEY = "{meta}:db:rebuild"
+REBUILD_LOCK_TIMEOUT = 60                                  # секунд, продлевается каждым пакетом
+
+# Служебные ключи раскладки без хеш-тегов: база с ними переносится
+# migrate_layout, после переноса на месте они удаляются
+LEGACY_DB_INITIATED_KEY = "db_initiated"
+LEGACY_KEY_PATTERNS = ("db_initiated", "db:index_version", "cache:versions", "analytics:*", "index:*",
+                       "search:*", "hospital-doctor:*", "patient-diagnosis:*", "patient-doctor:*",
+                       "*:autoID", "*:ids")
+# Ключи раскладки с общим тегом '{meta}' (INDEX_VERSION < 10): счетчики
+# ID и версии переносятся migrate_meta_keys, остальное перестраивается
+META_AUTO_ID_KEY = "{{meta}}:{}:autoID"
+META_CACHE_VERSIONS_KEY = "{meta}:cache:versions"
+META_KEY_PATTERNS = ("{meta}:analytics:*", "{meta}:index:*", "{meta}:search:*", "{meta}:hospital-doctor:*",
+                     "{meta}:patient-diagnosis:*", "{meta}:patient-doctor:*", "{meta}:cache:versions",
+                     "{meta}:*:autoID", "{meta}:*:ids")
+
+# Команда FANOUT в индексах модели: "FANOUT, множество, хеш, хеш
+# атрибуции, ID записи, команда, аргументы...". Команда выполняется для
+# каждого различного значения хеша по элементам множества; к аргументам
+# RefSuffix дописывается это значение. Так диагноз учитывается в больницах
+# врачей пациента. Значения читаются до создания записи (FANOUT_REFS_LUA,
+# в режиме кластера - ClusterCreate) и сохраняются в хеше атрибуции под ID
+# записи: пересчет индексов повторяет их, а не читает текущие связи.
+# KEYS[1] - множество, KEYS[2] - хеш; возвращает значения хеша по элементам
+FANOUT_REFS_LUA = """
+local unpack = table.unpack or unpack
+local members = redis.call('SMEMBERS', KEYS[1])
+if #members == 0 then
+    return {}
+end
+return redis.call('HMGET', KEYS[2], unpack(members))
+"""
 
+# Выполнение групп "длина, команда, аргументы..." (Model.pack_commands)
+# начиная с ARGV[i]: ключ каждой команды - очередной KEYS[k], в длину
+# входят команда и аргументы после ключа. ID записи подставляет приложение.
+RUN_GROUPS_LUA_FUNCTION = """
+local function run_groups(i, k)
+    while i <= #ARGV do
+        local length = tonumber(ARGV[i])
+        redis.call(ARGV[i + 1], KEYS[k], unpack(ARGV, i + 2, i + length))
+        i = i + length + 1
+        k = k + 1
+    end
+end
+"""
 
-class BaseHandler(tornado.web.RequestHandler):
-    """Базовый обработчик с общими методами"""
+# Атомарное создание сущности на стороне Redis (без кластера).
+# KEYS[1] - ключ записи, KEYS[2] и KEYS[3] - множество ID связанной модели и
+# запись связанной сущности (если она указана), далее - ключи групп.
+# ARGV[1] - ID записи (выделяет prepare_creates), ARGV[2] - ID связанной
+# сущности, ARGV[3] - ее поле для ответа, ARGV[4] - количество пар
+# поле/значение N, ARGV[5..4+2N] - пары поле/значение, далее - команды
+# обновления счетчиков и индексов в виде групп (run_groups).
+# Команды HSETNX - уникальные индексы: до записи проверяется, что значение
+# еще не занято, иначе возвращается {-1, ID записи с этим значением}.
+CREATE_ENTITY_LUA = """
+local unpack = table.unpack or unpack
+""" + RUN_GROUPS_LUA_FUNCTION + """
+local k = 2
+if ARGV[2] ~= '' then
+    if not redis.call('ZSCORE', KEYS[2], ARGV[2]) then
+        return false
+    end
+    k = 4
+end
+local n = tonumber(ARGV[4])
+local i, j = 5 + 2 * n, k
+while i <= #ARGV do
+    if ARGV[i + 1] == 'HSETNX' then
+        local existing = redis.call('HGET', KEYS[j], ARGV[i + 2])
+        if existing then
+            return {-1, existing}
+        end
+    end
+    i = i + tonumber(ARGV[i]) + 1
+    j = j + 1
+end
+
+local fields_set = redis.call('HSET', KEYS[1], unpack(ARGV, 5, 4 + 2 * n))
+run_groups(5 + 2 * n, k)
+
+local label = false
+if ARGV[2] ~= '' and ARGV[3] ~= '' then
+    label = redis.call('HGET', KEYS[3], ARGV[3])
+end
+return {tonumber(ARGV[1]), fields_set, label}
+"""
 
-    def get_redis(self):
-        return r
+# Поиск записи по уникальному индексу за один round trip.
+# KEYS[1] - хеш индекса "значение -> ID", ARGV[1] - значение, ARGV[2] - модель.
+# Возвращает {ID, поле, значение, ...} или false, если запись не найдена.
+# Не используется в режиме кластера: запись лежит в другом слоте
+LOOKUP_UNIQUE_LUA = """
+local id = redis.call('HGET', KEYS[1], ARGV[1])
+if not id then
+    return false
+end
+local record = redis.call('HGETALL', ARGV[2] .. ':' .. id)
+table.insert(record, 1, id)
+return record
+"""
 
-    def handle_redis_error(self, error: Exception, message: str = "Redis connection refused"):
-        """Обработка ошибок Redis"""
-        logging.error(f"Redis error: {str(error)}")
-        self.set_status(400)
-        self.write(message)
+# Страница sorted set после курсора (вес, элемент) за O(log N + количество).
+# KEYS[1] - sorted set; ARGV[1] - минимальный вес, ARGV[2] - количество,
+# ARGV[3] и ARGV[4] - вес и элемент последней записи прошлой страницы
+# (пустые для первой). Элементы с равным весом упорядочены по байтам,
+# поэтому продолжение - позиция элемента курсора (ZRANK) плюс один; если
+# его уже нет в индексе, пропускаются элементы с тем же весом, не большие
+# его. Возвращает {элемент, вес, ...}; верхнюю границу веса проверяет вызывающий
+ZSET_PAGE_LUA = """
+local count = tonumber(ARGV[2])
+if ARGV[4] == '' then
+    return redis.call('ZRANGEBYSCORE', KEYS[1], ARGV[1], '+inf', 'WITHSCORES', 'LIMIT', 0, count)
+end
+local score = tonumber(ARGV[3])
+local start = redis.call('ZRANK', KEYS[1], ARGV[4])
+if start and tonumber(redis.call('ZSCORE', KEYS[1], ARGV[4])) == score then
+    start = start + 1
+else
+    start = redis.call('ZCOUNT', KEYS[1], '-inf', '(' .. ARGV[3])
+    while true do
+        local item = redis.call('ZRANGE', KEYS[1], start, start, 'WITHSCORES')
+        if #item == 0 or tonumber(item[2]) ~= score or item[1] > ARGV[4] then
+            break
+        end
+        start = start + 1
+    end
+end
+return redis.call('ZRANGE', KEYS[1], start, start + count - 1, 'WITHSCORES')
+"""
 
-    def validate_required_fields(self, fields_func, required: List[str]) -> bool:
-        """Проверка обязательных полей"""
-        for field in required:
-            try:
-                value = fields_func(field)
-                if not value:
-                    return False
-            except:
-                return False
-        return True
+# Атомарное создание связи врач-пациент с проверкой обеих сущностей (без кластера).
+# KEYS[1] и KEYS[2] - множества ID врачей и пациентов, KEYS[3] - врачи пациента,
+# KEYS[4] - запись связи doctor-patient:{ID врача}, далее - ключи групп;
+# ARGV[1] - ID врача, ARGV[2] - ID пациента, далее - группы обновления
+# счетчиков и индексов (run_groups), выполняемые только для новой связи
+LINK_DOCTOR_PATIENT_LUA = """
+local unpack = table.unpack or unpack
+""" + RUN_GROUPS_LUA_FUNCTION + """
+if not redis.call('ZSCORE', KEYS[1], ARGV[1]) or not redis.call('ZSCORE', KEYS[2], ARGV[2]) then
+    return false
+end
+local added = redis.call('SADD', KEYS[3], ARGV[1])
+if added == 1 then
+    redis.call('SADD', KEYS[4], ARGV[2])
+    run_groups(3, 5)
+end
+return added
+"""
 
+# Режим кластера, шаг 2 ClusterCreate: выделение ID в слоте модели.
+# KEYS[1] - счетчик ID модели, KEYS[2] - журнал модели (PENDING_KEY),
+# KEYS[3..] - хеши уникальных индексов; ARGV[1] - запись журнала (JSON),
+# ARGV[2..] - значения для этих хешей. Занятое значение - {-1, ID записи
+# с ним}, иначе значения занимаются новым ID, запись журнала сохраняется
+# под ним: {ID}
+RESERVE_ENTITY_LUA = """
+for k = 3, #KEYS do
+    local existing = redis.call('HGET', KEYS[k], ARGV[k - 1])
+    if existing then
+        return {-1, existing}
+    end
+end
+local id = redis.call('INCR', KEYS[1]) - 1
+for k = 3, #KEYS do
+    redis.call('HSET', KEYS[k], ARGV[k - 1], id)
+end
+redis.call('HSET', KEYS[2], id, ARGV[1])
+return {id}
+"""
 
-class MainHandler(BaseHandler):
-    def get(self):
-        self.render('templates/index.html')
+# Режим кластера, шаг 4 ClusterCreate: завершение создания в слоте модели.
+# KEYS[1] - журнал модели, KEYS[2] - множество ID модели, далее - ключи
+# групп; ARGV[1] - ID записи (для связи - "ID врача:ID пациента"), ARGV[2] -
+# режим: 'guarded' - группы (run_groups) выполняются, только если запись
+# была в журнале, 'always' - всегда (новая связь), 'skip' - никогда (связь
+# уже была). Возвращает 1, если группы выполнены, 2, если запись уже
+# учтена в множестве ID, 0 - если создание откачено recover_pending
+COMMIT_ENTITY_LUA = """
+local unpack = table.unpack or unpack
+""" + RUN_GROUPS_LUA_FUNCTION + """
+local removed = redis.call('HDEL', KEYS[1], ARGV[1])
+if ARGV[2] == 'always' or (ARGV[2] == 'guarded' and removed == 1) then
+    run_groups(3, 3)
+    return 1
+end
+if redis.call('ZSCORE', KEYS[2], ARGV[1]) then
+    return 2
+end
+return 0
+"""
 
+# Режим кластера: откат прерванного создания (recover_pending).
+# KEYS[1] - журнал модели, KEYS[2..] - хеши уникальных индексов; ARGV[1] -
+# ID записи в журнале, ARGV[2..] - значения для этих хешей: значение
+# освобождается, только если занято этой записью. Возвращает 0, если
+# записи в журнале уже нет
+RELEASE_ENTITY_LUA = """
+if redis.call('HDEL', KEYS[1], ARGV[1]) == 0 then
+    return 0
+end
+for k = 2, #KEYS do
+    if redis.call('HGET', KEYS[k], ARGV[k]) == ARGV[1] then
+        redis.call('HDEL', KEYS[k], ARGV[k])
+    end
+end
+return 1
+"""
 
-class HospitalHandler(BaseHandler):
-    MODEL_NAME = "hospital"
-    REQUIRED_FIELDS = ["name", "address"]
+create_entity_script = r.register_script(CREATE_ENTITY_LUA)
+link_doctor_patient_script = r.register_script(LINK_DOCTOR_PATIENT_LUA)
+lookup_unique_script = r.register_script(LOOKUP_UNIQUE_LUA)
+zset_page_script = r.register_script(ZSET_PAGE_LUA)
+fanout_refs_script = r.register_script(FANOUT_REFS_LUA)
+reserve_entity_script = r.register_script(RESERVE_ENTITY_LUA)
+commit_entity_script = r.register_script(COMMIT_ENTITY_LUA)
+release_entity_script = r.register_script(RELEASE_ENTITY_LUA)
+
+
+class LRUCache:
+    """Ограниченный по размеру кэш с вытеснением давно не использованных записей
+
+    Если задан ttl, записи старше ttl секунд считаются отсутствующими.
+    """
+
+    def __init__(self, max_size: int, ttl: Optional[float] = None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        if key not in self.entries:
+            return None
+        stored_at, value = self.entries[key]
+        if self.ttl is not None and time.monotonic() - stored_at > self.ttl:
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        self.entries[key] = (time.monotonic(), value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+
+
+# Отрисованные страницы списков: (модель, курсор, лимит) -> (версии, страница, курсор следующей)
+response_cache = LRUCache(RESPONSE_CACHE_SIZE)
+# Границы интервалов гистограмм длительности, с
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Histogram:
+    """Гистограмма значений с фиксированными границами интервалов"""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {'counts': self.counts, 'sum': self.sum, 'count': self.count}
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "Histogram":
+        histogram = cls()
+        histogram.counts = list(data['counts'])
+        histogram.sum = data['sum']
+        histogram.count = data['count']
+        return histogram
+
+
+class Metrics:
+    """Метрики процесса в текстовом формате Prometheus
+
+    Запросы учитываются по обработчику, методу и статусу, команды Redis -
+    по имени команды; длительность обращений к Redis учитывается по
+    round trip (весь pipeline - одно обращение PIPELINE).
+
+    В production рабочие процессы делят один сокет, и запрос /metrics
+    попадает в случайный процесс. Поэтому каждый процесс раз в
+    METRICS_FLUSH_INTERVAL секунд сохраняет снимок своих метрик в общий
+    каталог (start_worker), а /metrics отдает метрики всех процессов с
+    меткой worker: свои - текущие, остальные - по последнему снимку.
+    """
+
+    # Словари метрик: ключ - значения меток, значение - счетчик или гистограмма
+    COUNTERS = ("requests", "redis_commands")
+    HISTOGRAMS = ("request_durations", "redis_durations")
 
-    def get(self):
-        items = []
+    def __init__(self):
+        self.requests = {}
+        self.request_durations = {}
+        self.redis_commands = {}
+        self.redis_durations = {}
+        self.directory = None
+        self.worker = None
+
+    def start_worker(self, directory: str, worker: int):
+        """Учет метрик рабочего процесса worker со снимками в каталоге directory"""
+        self.directory = directory
+        self.worker = str(worker)
+        self.save_snapshot()
+
+    def snapshot(self) -> Dict[str, list]:
+        """Метрики процесса в виде, пригодном для JSON"""
+        data = {name: [[key, value] for key, value in getattr(self, name).items()] for name in self.COUNTERS}
+        for name in self.HISTOGRAMS:
+            data[name] = [[key, histogram.to_dict()] for key, histogram in getattr(self, name).items()]
+        return data
+
+    @classmethod
+    def from_snapshot(cls, data: Dict[str, list]) -> "Metrics":
+        # Составные ключи в JSON - списки
+        def key(value):
+            return tuple(value) if isinstance(value, list) else value
+
+        result = cls()
+        for name in cls.COUNTERS:
+            setattr(result, name, {key(k): value for k, value in data[name]})
+        for name in cls.HISTOGRAMS:
+            setattr(result, name, {key(k): Histogram.from_dict(value) for k, value in data[name]})
+        return result
+
+    def snapshot_path(self, worker: str) -> str:
+        return os.path.join(self.directory, f"worker-{worker}.json")
+
+    def save_snapshot(self):
+        """Запись снимка метрик процесса; файл заменяется атомарно"""
+        path = self.snapshot_path(self.worker)
+        with open(path + ".tmp", "w") as snapshot_file:
+            json.dump(self.snapshot(), snapshot_file)
+        os.replace(path + ".tmp", path)
+
+    def load_workers(self) -> Dict[str, "Metrics"]:
+        """Метрики всех рабочих процессов по номеру процесса"""
+        workers = {}
+        for file_name in os.listdir(self.directory):
+            if file_name.startswith("worker-") and file_name.endswith(".json"):
+                worker = file_name[len("worker-"):-len(".json")]
+                try:
+                    with open(os.path.join(self.directory, file_name)) as snapshot_file:
+                        workers[worker] = Metrics.from_snapshot(json.load(snapshot_file))
+                except (OSError, ValueError) as e:
+                    logging.warning(f"Skipping metrics snapshot {file_name}: {str(e)}")
+        workers[self.worker] = self
+        return workers
+
+    def observe_request(self, handler: str, method: str, status: int, duration: float):
+        key = (handler, method, str(status))
+        self.requests[key] = self.requests.get(key, 0) + 1
+        key = (handler, method)
+        if key not in self.request_durations:
+            self.request_durations[key] = Histogram()
+        self.request_durations[key].observe(duration)
+
+    def observe_redis(self, round_trip: str, commands: List[str], duration: float):
+        for command in commands:
+            self.redis_commands[command] = self.redis_commands.get(command, 0) + 1
+        if round_trip not in self.redis_durations:
+            self.redis_durations[round_trip] = Histogram()
+        self.redis_durations[round_trip].observe(duration)
+
+    @staticmethod
+    def format_labels(names, values) -> str:
+        return ",".join(f'{name}="{value}"' for name, value in zip(names, values))
+
+    @staticmethod
+    def labeled(workers: Dict[Optional[str], "Metrics"], name: str, label_names):
+        """Серии метрики name всех процессов: (имена меток, значения меток, значение)
+
+        Если процессов несколько, первой идет метка worker.
+        """
+        for worker, worker_metrics in sorted(workers.items(), key=lambda item: int(item[0] or 0)):
+            for values, value in sorted(getattr(worker_metrics, name).items()):
+                values = values if isinstance(values, tuple) else (values,)
+                if worker is None:
+                    yield label_names, values, value
+                else:
+                    yield ("worker",) + label_names, (worker,) + values, value
+
+    def render_histograms(self, name: str, series) -> List[str]:
+        lines = []
+        for label_names, values, histogram in series:
+            labels = self.format_labels(label_names, values)
+            cumulative = 0
+            for bound, count in zip(list(histogram.buckets) + ["+Inf"], histogram.counts):
+                cumulative += count
+                lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f"{name}_sum{{{labels}}} {histogram.sum}")
+            lines.append(f"{name}_count{{{labels}}} {histogram.count}")
+        return lines
+
+    def render(self) -> str:
+        """Метрики процесса или, после start_worker, всех рабочих процессов"""
+        workers = {None: self} if self.directory is None else self.load_workers()
+        lines = [
+            "# HELP http_requests_total Total HTTP requests.",
+            "# TYPE http_requests_total counter",
+        ]
+        for label_names, values, count in self.labeled(workers, "requests", ("handler", "method", "status")):
+            lines.append(f"http_requests_total{{{self.format_labels(label_names, values)}}} {count}")
+
+        lines += [
+            "# HELP http_request_duration_seconds HTTP request latency.",
+            "# TYPE http_request_duration_seconds histogram",
+        ]
+        lines += self.render_histograms("http_request_duration_seconds",
+                                        self.labeled(workers, "request_durations", ("handler", "method")))
+
+        lines += [
+            "# HELP redis_commands_total Redis commands sent, including pipelined ones.",
+            "# TYPE redis_commands_total counter",
+        ]
+        for label_names, values, count in self.labeled(workers, "redis_commands", ("command",)):
+            lines.append(f"redis_commands_total{{{self.format_labels(label_names, values)}}} {count}")
+
+        lines += [
+            "# HELP redis_roundtrip_duration_seconds Redis round trip latency.",
+            "# TYPE redis_roundtrip_duration_seconds histogram",
+        ]
+        lines += self.render_histograms("redis_roundtrip_duration_seconds",
+                                        self.labeled(workers, "redis_durations", ("command",)))
+        return "\n".join(lines) + "\n"
+
+
+# Метрики процесса
+metrics = Metrics()
+
+
+class ReplicaRedis:
+    """Клиент чтения с реплики с переходом на primary
+
+    Команды и pipeline выполняются на реплике; при ошибке соединения или
+    таймауте реплика исключается из выдачи (mark_replica_down), команда
+    повторяется на primary, и остальные обращения запроса идут на него.
+    """
+
+    def __init__(self, manager: "RedisManager", index: int, primary):
+        self.manager = manager
+        self.index = index
+        self.primary = primary
+        self.client = manager.replicas[index]
+
+    def failover(self, error: Exception) -> bool:
+        """Переход на primary после ошибки; False, если уже на primary"""
+        if self.client is self.primary:
+            return False
+        address = "{}:{}".format(*self.manager.settings['replicas'][self.index])
+        logging.warning(f"Redis replica {address} failed, reading from primary: {error}")
+        self.manager.mark_replica_down(self.index)
+        self.client = self.primary
+        return True
+
+    def pipeline(self, *args, **kwargs):
+        return ReplicaPipeline(self, args, kwargs)
+
+    async def retried(self, name: str, args, kwargs, awaitable):
+        try:
+            return await awaitable
+        except REDIS_ERRORS as e:
+            if not self.failover(e):
+                raise
+            return await getattr(self.client, name)(*args, **kwargs)
+
+    def __getattr__(self, name):
+        attr = getattr(self.client, name)
+        if not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            result = attr(*args, **kwargs)
+            if inspect.isawaitable(result):
+                return self.retried(name, args, kwargs, result)
+            return result
+        return call
+
+
+class ReplicaPipeline:
+    """Pipeline на реплике: команды запоминаются, чтобы повторить их на primary"""
+
+    def __init__(self, redis_conn: ReplicaRedis, args, kwargs):
+        self.redis = redis_conn
+        self.args = args
+        self.kwargs = kwargs
+        self.pipe = redis_conn.client.pipeline(*args, **kwargs)
+        self.calls = []
+
+    async def execute(self, *args, **kwargs):
+        calls, self.calls = self.calls, []
+        try:
+            return await self.pipe.execute(*args, **kwargs)
+        except REDIS_ERRORS as e:
+            if not self.redis.failover(e):
+                raise
+            self.pipe = self.redis.client.pipeline(*self.args, **self.kwargs)
+            for name, call_args, call_kwargs in calls:
+                getattr(self.pipe, name)(*call_args, **call_kwargs)
+            return await self.pipe.execute(*args, **kwargs)
+
+    def __getattr__(self, name):
+        attr = getattr(self.pipe, name)
+        if not callable(attr):
+            return attr
+
+        def queue(*args, **kwargs):
+            self.calls.append((name, args, kwargs))
+            attr(*args, **kwargs)
+            return self
+        return queue
+
+
+class InstrumentedRedis:
+    """Обертка клиента Redis, учитывающая команды и длительность обращений
+
+    Команды передаются клиенту без изменений; по завершении каждой
+    команды или pipeline вызывается record(round_trip, commands, duration).
+    """
+
+    def __init__(self, client, record):
+        self.client = client
+        self.record = record
+
+    def pipeline(self, *args, **kwargs):
+        return InstrumentedPipeline(self.client.pipeline(*args, **kwargs), self.record)
+
+    async def timed(self, command: str, awaitable):
+        started = time.perf_counter()
         try:
-            auto_id = self.get_redis().get(f"{self.MODEL_NAME}:autoID")
-            if auto_id:
-                auto_id = auto_id.decode()
+            return await awaitable
+        finally:
+            self.record(command, [command], time.perf_counter() - started)
+
+    def __getattr__(self, name):
+        attr = getattr(self.client, name)
+        if not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            result = attr(*args, **kwargs)
+            if inspect.isawaitable(result):
+                return self.timed(name.upper(), result)
+            return result
+        return call
+
+
+class InstrumentedPipeline:
+    """Обертка pipeline: команды учитываются при постановке в очередь, время - при execute"""
+
+    def __init__(self, pipe, record):
+        self.pipe = pipe
+        self.record = record
+        self.commands = []
+
+    async def execute(self, *args, **kwargs):
+        commands, self.commands = self.commands, []
+        started = time.perf_counter()
+        try:
+            return await self.pipe.execute(*args, **kwargs)
+        finally:
+            self.record("PIPELINE", commands, time.perf_counter() - started)
 
-                for i in range(int(auto_id)):
-                    result = self.get_redis().hgetall(f"{self.MODEL_NAME}:{i}")
-                    if result:
-                        items.append(result)
+    def __getattr__(self, name):
+        attr = getattr(self.pipe, name)
+        if not callable(attr):
+            return attr
 
-            self.render(f'templates/{self.MODEL_NAME}.html', items=items)
-        except redis.exceptions.ConnectionError as e:
-            self.handle_redis_error(e)
+        def queue(*args, **kwargs):
+            # Команды из описаний моделей ставятся через execute_command
+            self.commands.append(str(args[0]).upper() if name == "execute_command" else name.upper())
+            return attr(*args, **kwargs)
+        return queue
 
-    def post(self):
-        # Получаем аргументы
-        data = {
-            'name': self.get_argument('name'),
-            'address': self.get_argument('address'),
-            'phone': self.get_argument('phone'),
-            'beds_number': self.get_argument('beds_number')
-        }
 
-        # Проверяем обязательные поля
-        if not self.validate_required_fields(self.get_argument, self.REQUIRED_FIELDS):
-            self.set_status(400)
-            self.write(f"{self.MODEL_NAME.capitalize()} name and address required")
-            return
+# Записи сущностей: "{модель}:{ID}" -> поля. Сущности не изменяются после
+# создания, поэтому запись кэша устаревает только при очистке базы (ttl)
+entity_cache = LRUCache(ENTITY_CACHE_SIZE, ENTITY_CACHE_TTL)
 
-        logging.debug(f"{data['name']} {data['address']} {data['phone']} {data['beds_number']}")
 
-        try:
-            auto_id = self.get_redis().get(f"{self.MODEL_NAME}:autoID").decode()
+def validate_sex(data: Dict[str, str]) -> Optional[str]:
+    """Проверка пола пациента"""
+    if data['sex'] not in ['M', 'F']:
+        return "Sex must be 'M' or 'F'"
+    return None
 
-            # Сохраняем данные
-            fields_set = 0
-            fields_set += self.get_redis().hset(f"{self.MODEL_NAME}:{auto_id}", "name", data['name'])
-            fields_set += self.get_redis().hset(f"{self.MODEL_NAME}:{auto_id}", "address", data['address'])
-            fields_set += self.get_redis().hset(f"{self.MODEL_NAME}:{auto_id}", "phone", data['phone'])
-            fields_set += self.get_redis().hset(f"{self.MODEL_NAME}:{auto_id}", "beds_number", data['beds_number'])
 
-            self.get_redis().incr(f"{self.MODEL_NAME}:autoID")
-        except redis.exceptions.ConnectionError as e:
-            self.handle_redis_error(e)
-        else:
-            if fields_set != 4:
-                self.set_status(500)
-                self.write("Something went terribly wrong")
-            else:
-                self.write(f'OK: ID {auto_id} for {data["name"]}')
+def parse_date(value: str) -> datetime.date:
+    """Разбор даты ГГГГ-ММ-ДД; ValueError, если формат неверный"""
+    return datetime.datetime.strptime(value, "%Y-%m-%d").date()
 
 
-class DoctorHandler(BaseHandler):
-    MODEL_NAME = "doctor"
-    REQUIRED_FIELDS = ["surname", "profession"]
+def validate_born_date(data: Dict[str, str]) -> Optional[str]:
+    """Проверка формата даты рождения"""
+    try:
+        parse_date(data['born_date'])
+    except ValueError:
+        return "Born date must be YYYY-MM-DD"
+    return None
 
-    def get(self):
-        items = []
-        try:
-            auto_id = self.get_redis().get(f"{self.MODEL_NAME}:autoID")
-            if auto_id:
-                auto_id = auto_id.decode()
 
-                for i in range(int(auto_id)):
-                    result = self.get_redis().hgetall(f"{self.MODEL_NAME}:{i}")
-                    if result:
-                        items.append(result)
+def date_score(value: datetime.date) -> int:
+    """Вес даты в индексах: ГГГГММДД"""
+    return value.year * 10000 + value.month * 100 + value.day
 
-            self.render(f'templates/{self.MODEL_NAME}.html', items=items)
-        except redis.exceptions.ConnectionError as e:
-            self.handle_redis_error(e)
 
-    def post(self):
-        # Получаем аргументы
-        data = {
-            'surname': self.get_argument('surname'),
-            'profession': self.get_argument('profession'),
-            'hospital_ID': self.get_argument('hospital_ID')
-        }
+class IndexFormatter(string.Formatter):
+    """Подстановка полей в команды индексов
 
-        # Проверяем обязательные поля
-        if not self.validate_required_fields(self.get_argument, self.REQUIRED_FIELDS):
-            self.set_status(400)
-            self.write("Surname and profession required")
-            return
+    '{поле!l}' - значение в нижнем регистре, '{поле!d}' - дата ГГГГ-ММ-ДД
+    как вес ГГГГММДД (ValueError для некорректной даты). Хеш-теги HASH_TAGS
+    остаются без изменений: '{patient}' - тег модели, '{patient:{patient_ID}}' -
+    тег записи пациента с ID из поля.
+    """
 
-        logging.debug(f"{data['surname']} {data['profession']}")
+    def get_value(self, key, args, kwargs):
+        if key in HASH_TAGS:
+            return HashTag(key)
+        return super().get_value(key, args, kwargs)
 
-        try:
-            auto_id = self.get_redis().get(f"{self.MODEL_NAME}:autoID").decode()
+    def convert_field(self, value, conversion):
+        if conversion == "l":
+            return value.lower()
+        if conversion == "d":
+            return str(date_score(parse_date(value)))
+        return super().convert_field(value, conversion)
 
-            # Проверяем существование больницы, если указан ID
-            if data['hospital_ID']:
-                hospital = self.get_redis().hgetall(f"hospital:{data['hospital_ID']}")
-                if not hospital:
-                    self.set_status(400)
-                    self.write("No hospital with such ID")
-                    return
 
-            # Сохраняем данные
-            fields_set = 0
-            fields_set += self.get_redis().hset(f"{self.MODEL_NAME}:{auto_id}", "surname", data['surname'])
-            fields_set += self.get_redis().hset(f"{self.MODEL_NAME}:{auto_id}", "profession", data['profession'])
-            fields_set += self.get_redis().hset(f"{self.MODEL_NAME}:{auto_id}", "hospital_ID", data['hospital_ID'])
+class HashTag(str):
+    """Хеш-тег в шаблоне ключа: спецификация формата - ID записи"""
+
+    def __format__(self, spec):
+        tag = str.__str__(self)
+        return f"{{{tag}:{spec}}}" if spec else f"{{{tag}}}"
+
+
+index_formatter = IndexFormatter()
+
+
+def template_fields(template: str) -> List[str]:
+    """Поля записи, подставляемые в шаблон (включая ID в хеш-тегах)"""
+    fields = []
+    for _, name, spec, _ in index_formatter.parse(template):
+        if name in HASH_TAGS:
+            fields += template_fields(spec or "")
+        elif name:
+            fields.append(name)
+    return fields
+
+
+def key_tag(key: str) -> str:
+    """Хеш-тег ключа, по которому Redis Cluster выбирает слот, или сам ключ без тега"""
+    start = key.find("{")
+    end = key.find("}", start + 1)
+    if start == -1 or end <= start + 1:
+        return key
+    return key[start + 1:end]
+
+
+class IdSuffix(str):
+    """Аргумент команды индекса, к которому при создании дописывается ID записи
+
+    Позиции подстановки задаются типом аргумента шаблона, а не его
+    значением, поэтому данные пользователя ('$id' в названии или номере
+    полиса) никогда не заменяются.
+    """
+
+
+class RefSuffix(str):
+    """Аргумент команды FANOUT, к которому дописывается значение из хеша"""
+
+
+# ID новой записи как отдельный аргумент команды
+ENTITY_ID = IdSuffix("")
+
+
+# Результат создания записи с занятым значением уникального поля
+DUPLICATE = "duplicate"
+
+
+class Model:
+    """Описание модели: поля, проверки, связанная сущность и индексы
+
+    По описанию работают формы, массовый импорт, выгрузка, списки и
+    пересчет индексов. validators - функции data -> текст ошибки или None;
+    reference - (поле с ID связанной сущности, ее модель, ее поле для
+    ответа): связанная сущность проверяется при создании, если поле
+    заполнено. indexes - команды обновления индексов при создании: '{поле}'
+    в аргументах заменяется значением поля (команда пропускается, если оно
+    пустое), к аргументам IdSuffix (ENTITY_ID) дописывается ID новой
+    записи. unique - уникальные поля и хеши индексов "значение -> ID":
+    запись с занятым значением не создается (unique_message).
+    search_field - поле поиска по префиксу без учета регистра: индекс
+    SEARCH_KEY хранит элементы "значение в нижнем регистре\0ID" с
+    одинаковым весом.
+    """
+
+    # Записи модели читаются командой list_command
+    list_command = "hgetall"
+
+    def get_ids_update(self) -> tuple:
+        """Команда добавления записи в множество существующих ID (IDS_KEY),
+        по которому идут списки, выгрузка и пересчет"""
+        return ("ZADD", IDS_KEY.format(self.name), ENTITY_ID, ENTITY_ID)
+
+    def __init__(self, name: str, fields: List[str], required: List[str], required_message: str,
+                 created_message: str, validators=(), reference: Optional[Tuple[str, str, str]] = None,
+                 reference_message: str = "No such ID", indexes=(), unique: Optional[Dict[str, str]] = None,
+                 unique_message: str = "Duplicate value", search_field: Optional[str] = None):
+        self.name = name
+        self.fields = fields
+        self.required = required
+        self.required_message = required_message
+        self.created_message = created_message
+        self.validators = validators
+        self.reference = reference
+        self.reference_message = reference_message
+        self.indexes = list(indexes)
+        self.unique = unique or {}
+        self.unique_message = unique_message
+        for field, key in self.unique.items():
+            self.indexes.append(("HSETNX", key, f"{{{field}}}", ENTITY_ID))
+        self.search_field = search_field
+        if search_field:
+            self.indexes.append(("ZADD", SEARCH_KEY.format(name), 0, IdSuffix(f"{{{search_field}!l}}\0")))
+        self.indexes.insert(0, self.get_ids_update())
+
+    def validate(self, data: Dict[str, str]) -> Optional[str]:
+        """Текст ошибки или None, если данные корректны"""
+        for field in self.required:
+            if not data.get(field):
+                return self.required_message
+        for validator in self.validators:
+            error = validator(data)
+            if error:
+                return error
+        return None
+
+    @staticmethod
+    def format_command(command: tuple, data: Dict[str, str]) -> Optional[tuple]:
+        """Подстановка полей в команду индекса; None, если поле пустое или
+        не преобразуется (записи, созданные до появления проверки)"""
+        formatted = []
+        for arg in command:
+            if isinstance(arg, str) and "{" in arg:
+                if not all(data.get(field) for field in template_fields(arg)):
+                    return None
+                try:
+                    # Тип аргумента (IdSuffix, RefSuffix) сохраняется
+                    arg = type(arg)(index_formatter.format(arg, **data))
+                except ValueError:
+                    return None
+            formatted.append(arg)
+        return tuple(formatted)
+
+    @staticmethod
+    def pack_commands(commands: List[tuple], entity_id) -> Tuple[List[str], list]:
+        """Ключи и группы аргументов скрипта (run_groups) с подставленным ID
+
+        Ключ команды передается в KEYS, группа - длина, команда и аргументы
+        после ключа. Команды FANOUT передаются скрипту уже развернутыми.
+        """
+        keys, args = [], []
+        for command in commands:
+            command = [substitute_id(arg, entity_id) for arg in command]
+            keys.append(command[1])
+            args += [len(command) - 1, command[0], *command[2:]]
+        return keys, args
+
+    def get_index_updates(self, data: Dict[str, str]) -> List[tuple]:
+        """Команды обновления счетчиков и индексов при создании записи"""
+        updates = [("INCRBY", ENTITY_COUNT_KEY.format(self.name), 1)]
+        for command in self.indexes:
+            command = self.format_command(command, data)
+            if command:
+                updates.append(command)
+        return updates
+
+    def get_create_commands(self, data: Dict[str, str]) -> List[tuple]:
+        """Команды создания записи: кроме счетчиков и индексов увеличивается
+        версия модели, чтобы сбросить кэш страниц ее списка"""
+        return [("INCRBY", CACHE_VERSION_KEY.format(self.name), 1)] + self.get_index_updates(data)
+
+    def get_fanouts(self, data: Dict[str, str]) -> List[tuple]:
+        """Аргументы команд FANOUT записи: их разворачивает приложение (expand_fanout)"""
+        return [command[1:] for command in self.get_index_updates(data) if command[0] == "FANOUT"]
+
+    def get_create_call(self, data: Dict[str, str], entity_id, fanout_commands: List[tuple] = ()):
+        """Lua-скрипт, ключи и аргументы атомарного создания записи
+
+        ID записи выделен заранее (prepare_creates), поэтому все ключи, в
+        которые пишет скрипт, передаются в KEYS. Связанная сущность
+        проверяется по множеству ID ее модели. Команды FANOUT передаются
+        развернутыми. Скрипт обращается к ключам разных слотов, поэтому в
+        режиме кластера запись создается по шагам (ClusterCreate).
+        """
+        keys = [f"{self.name}:{entity_id}"]
+        ref_id = ref_label = ""
+        if self.reference and data.get(self.reference[0]):
+            field, ref_model, ref_label = self.reference
+            ref_id = data[field]
+            keys += [IDS_KEY.format(ref_model), f"{ref_model}:{ref_id}"]
+
+        args = [entity_id, ref_id, ref_label, len(data)]
+        for field, value in data.items():
+            args += [field, value]
+        commands = [command for command in self.get_create_commands(data) if command[0] != "FANOUT"]
+        group_keys, group_args = self.pack_commands(commands + list(fanout_commands), entity_id)
+
+        return create_entity_script, keys + group_keys, args + group_args
+
+    def get_cluster_commands(self, data: Dict[str, str]):
+        """Команды создания в режиме кластера, разделенные по слотам
+
+        Возвращает пары (хеш, значение) уникальных индексов, команды слота модели
+        (выполняются скриптом COMMIT_ENTITY_LUA), команды индексов отдельных
+        сущностей (идемпотентные SADD в слотах этих сущностей) и аргументы
+        команд FANOUT (разворачиваются приложением, expand_fanout).
+        """
+        unique, model_commands, entity_commands, fanouts = [], [], [], []
+        for command in self.get_create_commands(data):
+            if command[0] == "HSETNX":
+                unique.append((command[1], command[2]))
+            elif command[0] == "FANOUT":
+                fanouts.append(command[1:])
+            elif key_tag(command[1]) == self.name:
+                model_commands.append(command)
+            else:
+                entity_commands.append(command)
+        return unique, model_commands, entity_commands, fanouts
+
+    def get_reference_checks(self, data: Dict[str, str]) -> List[Tuple[str, str]]:
+        """Связанные сущности для проверки: (множество ID модели, ID)"""
+        if self.reference and data.get(self.reference[0]):
+            return [(IDS_KEY.format(self.reference[1]), data[self.reference[0]])]
+        return []
+
+    def get_existing_check(self, data: Dict[str, str]) -> Optional[tuple]:
+        """Шаг 1 ClusterCreate: команда проверки, что запись уже сохранена -
+        тогда она не попадает в журнал; у сущностей с ID такой проверки нет"""
+        return None
+
+    def get_reserve_command(self, data: Dict[str, str], entry: str, unique: List[Tuple[str, str]]) -> tuple:
+        """Шаг 2 ClusterCreate: выделение ID и запись журнала (RESERVE_ENTITY_LUA)"""
+        return ("EVALSHA", reserve_entity_script.sha, 2 + len(unique), AUTO_ID_KEY.format(self.name),
+                PENDING_KEY.format(self.name), *(key for key, _ in unique), entry, *(value for _, value in unique))
+
+    def parse_reserve(self, reply, data: Dict[str, str]):
+        """ID записи в журнале или DUPLICATE"""
+        if int(reply[0]) == -1:
+            return DUPLICATE
+        return int(reply[0])
+
+    def get_commit_mode(self, entity_replies) -> str:
+        """Режим COMMIT_ENTITY_LUA по ответам на команды индексов отдельных сущностей"""
+        return "guarded"
+
+    def get_exists_command(self, entity_id, data: Dict[str, str]) -> tuple:
+        """Команда проверки, сохранена ли запись из журнала (recover_pending)"""
+        return ("EXISTS", f"{self.name}:{entity_id}")
+
+    def get_record_commands(self, entity_id, data: Dict[str, str]) -> List[tuple]:
+        """Команды записи новой сущности и чтения поля связанной сущности
+        для ответа: в режиме кластера их выполняет приложение (ClusterCreate)"""
+        pairs = [item for field_value in data.items() for item in field_value]
+        commands = [("HSET", f"{self.name}:{entity_id}", *pairs)]
+        if self.reference and self.reference[2] and data.get(self.reference[0]):
+            field, ref_model, ref_label = self.reference
+            commands.append(("HGET", f"{ref_model}:{data[field]}", ref_label))
+        return commands
+
+    def parse_record_replies(self, result, replies):
+        """Результат создания после выполнения get_record_commands"""
+        label = replies[1] if len(replies) > 1 else None
+        return result[0], int(replies[0]) == len(self.fields), label
+
+    def parse_result(self, result):
+        """Результат скрипта создания: (ID, все ли поля записаны, поле связанной
+        сущности), None, если связанная сущность не найдена, или DUPLICATE,
+        если значение уникального поля занято"""
+        if result is None:
+            return None
+        if int(result[0]) == -1:
+            return DUPLICATE
+        auto_id, fields_set, label = result
+        return int(auto_id), int(fields_set) == len(self.fields), label
+
+    def format_created(self, entity_id, data: Dict[str, str], label) -> str:
+        label = (label or b'Unknown').decode()
+        return self.created_message.format(id=entity_id, label=label, **data)
+
+
+class LinkModel(Model):
+    """Связь врач-пациент: множество doctor-patient:{ID врача} без собственного ID"""
+
+    list_command = "smembers"
+
+    def get_ids_update(self):
+        # Связи хранятся по ID врача: в множестве - врачи, у которых есть пациенты
+        return ("ZADD", IDS_KEY.format(self.name), "{doctor_ID}", "{doctor_ID}")
+
+    def get_create_call(self, data, entity_id=None, fanout_commands=()):
+        doctor_ID, patient_ID = data['doctor_ID'], data['patient_ID']
+        keys = [IDS_KEY.format("doctor"), IDS_KEY.format("patient"), PATIENT_DOCTORS_KEY.format(patient_ID),
+                f"doctor-patient:{doctor_ID}"]
+        group_keys, args = self.pack_commands(self.get_create_commands(data), "")
+        return link_doctor_patient_script, keys + group_keys, [doctor_ID, patient_ID, *args]
+
+    def get_reference_checks(self, data):
+        return [(IDS_KEY.format("doctor"), data['doctor_ID']), (IDS_KEY.format("patient"), data['patient_ID'])]
+
+    def get_existing_check(self, data):
+        # Существующая связь не попадает в журнал: recover_pending завершает
+        # только новые связи, поэтому повтор не учитывается в счетчиках дважды
+        return ("SISMEMBER", PATIENT_DOCTORS_KEY.format(data['patient_ID']), data['doctor_ID'])
+
+    def get_reserve_command(self, data, entry, unique):
+        # Связь записывается в журнал под парой ID, счетчик ID не нужен
+        return ("HSET", PENDING_KEY.format(self.name), f"{data['doctor_ID']}:{data['patient_ID']}", entry)
+
+    def parse_reserve(self, reply, data):
+        return f"{data['doctor_ID']}:{data['patient_ID']}"
+
+    def get_commit_mode(self, entity_replies):
+        # Первая команда - SADD в множество врачей пациента, как в LINK_DOCTOR_PATIENT_LUA
+        return "always" if entity_replies and entity_replies[0] == 1 else "skip"
+
+    def get_exists_command(self, entity_id, data):
+        return ("SISMEMBER", f"doctor-patient:{data['doctor_ID']}", data['patient_ID'])
+
+    def parse_result(self, result):
+        if result is None:
+            return None
+        return None, True, None
+
+    def get_record_commands(self, entity_id, data):
+        # Повторное добавление существующей связи ничего не меняет
+        return [("SADD", f"doctor-patient:{data['doctor_ID']}", data['patient_ID'])]
+
+    def parse_record_replies(self, result, replies):
+        return None, True, None
+
+
+# Реестр моделей
+MODELS = {model.name: model for model in (
+    Model("hospital",
+          fields=["name", "address", "phone", "beds_number"],
+          required=["name", "address"],
+          required_message="Hospital name and address required",
+          created_message="OK: ID {id} for {name}",
+          # Название больницы нужно аналитике без чтения всех хешей hospital:*
+          indexes=[("HSET", HOSPITAL_NAMES_KEY, ENTITY_ID, "{name}")]),
+    Model("doctor",
+          fields=["surname", "profession", "hospital_ID"],
+          required=["surname", "profession"],
+          required_message="Surname and profession required",
+          created_message="OK: ID {id} for {surname}",
+          search_field="profession",
+          # Больница проверяется, только если указан ее ID
+          reference=("hospital_ID", "hospital", ""),
+          reference_message="No hospital with such ID",
+          indexes=[("HINCRBY", HOSPITAL_DOCTORS_COUNT_KEY, "{hospital_ID}", 1),
+                   ("SADD", HOSPITAL_DOCTORS_KEY.format("{hospital_ID}"), ENTITY_ID),
+                   # Больница врача для FANOUT без чтения записей врачей
+                   ("HSET", DOCTOR_HOSPITALS_KEY, ENTITY_ID, "{hospital_ID}")]),
+    Model("patient",
+          fields=["surname", "born_date", "sex", "mpn"],
+          required=["surname", "born_date", "sex", "mpn"],
+          required_message="All fields required",
+          created_message="OK: ID {id} for {surname}",
+          validators=[validate_sex, validate_born_date],
+          indexes=[("ZADD", PATIENT_BORN_KEY, "{born_date!d}", ENTITY_ID)],
+          # По номеру полиса пациент ищется страховыми запросами
+          unique={"mpn": PATIENT_MPN_KEY},
+          unique_message="Patient with such MPN already exists",
+          search_field="surname"),
+    Model("diagnosis",
+          fields=["patient_ID", "type", "information"],
+          required=["patient_ID", "type"],
+          required_message="Patiend ID and diagnosis type required",
+          created_message="OK: ID {id} for patient {label}",
+          # В ответе возвращается фамилия пациента
+          reference=("patient_ID", "patient", "surname"),
+          reference_message="No patient with such ID",
+          indexes=[("HINCRBY", PATIENT_DIAGNOSES_COUNT_KEY, "{patient_ID}", 1),
+                   ("SADD", PATIENT_DIAGNOSES_KEY.format("{patient_ID}"), ENTITY_ID),
+                   # Частота типов диагнозов: всего и по больницам лечащих
+                   # врачей пациента на момент постановки диагноза
+                   ("ZINCRBY", DIAGNOSIS_TYPES_KEY, 1, "{type!l}"),
+                   ("FANOUT", PATIENT_DOCTORS_KEY.format("{patient_ID}"), DOCTOR_HOSPITALS_KEY,
+                    DIAGNOSIS_HOSPITALS_KEY, ENTITY_ID, "ZINCRBY", RefSuffix(HOSPITAL_DIAGNOSIS_TYPES_KEY.format("")), 1, "{type!l}")]),
+    LinkModel("doctor-patient",
+              fields=["doctor_ID", "patient_ID"],
+              required=["doctor_ID", "patient_ID"],
+              required_message="ID required",
+              created_message="OK: doctor ID: {doctor_ID}, patient ID: {patient_ID}",
+              reference_message="No such ID for doctor or patient",
+              indexes=[("SADD", PATIENT_DOCTORS_KEY.format("{patient_ID}"), "{doctor_ID}")]),
+)}
+
+
+def has_fanout(model: Model) -> bool:
+    """Есть ли у модели команды FANOUT"""
+    return any(command[0] == "FANOUT" for command in model.indexes)
+
+
+def expand_fanout(args: tuple, refs) -> List[tuple]:
+    """Команды FANOUT (аргументы: множество, хеш, хеш атрибуции, ID записи,
+    команда...) для значений хеша refs по элементам множества и запись этих
+    значений в хеш атрибуции"""
+    refs = [ref.decode() if isinstance(ref, bytes) else ref for ref in dict.fromkeys(refs) if ref]
+    commands = [tuple(f"{arg}{ref}" if isinstance(arg, RefSuffix) else arg for arg in args[4:]) for ref in refs]
+    commands.append(("HSET", args[2], args[3], ",".join(refs)))
+    return commands
+
+
+async def resolve_fanouts(redis_conn, fanouts: List[tuple]) -> List[List[tuple]]:
+    """Развертывание команд FANOUT приложением: элементы множеств и значения
+    хешей читаются двумя pipeline для всего списка"""
+    pipe = redis_conn.pipeline(transaction=False)
+    for args in fanouts:
+        pipe.smembers(args[0])
+    members = await pipe.execute() if fanouts else []
+
+    pipe = redis_conn.pipeline(transaction=False)
+    for args, ids in zip(fanouts, members):
+        if ids:
+            pipe.hmget(args[1], *sorted(ids))
+    refs = iter(await pipe.execute() if any(members) else [])
+    return [expand_fanout(args, next(refs) if ids else []) for args, ids in zip(fanouts, members)]
+
+
+async def prepare_creates(redis_conn, model: Model, rows: List[Dict[str, str]]) -> Tuple[list, List[List[tuple]]]:
+    """ID и развернутые команды FANOUT записей пакета до их создания (без кластера)
+
+    Одним pipeline счетчик ID модели увеличивается на размер пакета, а
+    скрипт FANOUT_REFS_LUA читает значения хеша по элементам множества
+    каждой команды FANOUT. ID заранее нужны, чтобы скрипт создания получал
+    ключ записи в KEYS; ID строк, отклоненных скриптом, остаются пропусками.
+    Связям ID не нужен - без FANOUT обращений нет. Скрипт, которого нет в
+    кэше Redis (NOSCRIPT), загружается и вызывается повторно.
+    """
+    fanouts = [model.get_fanouts(data) for data in rows]
+    allocate = not isinstance(model, LinkModel)
+    calls = [args for row_fanouts in fanouts for args in row_fanouts]
+    ids = [None] * len(rows)
+    if not allocate and not calls:
+        return ids, [[] for _ in rows]
+
+    pipe = redis_conn.pipeline(transaction=False)
+    if allocate:
+        pipe.incrby(AUTO_ID_KEY.format(model.name), len(rows))
+    for args in calls:
+        pipe.evalsha(fanout_refs_script.sha, 2, args[0], args[1])
+    replies = await pipe.execute(raise_on_error=False)
+    if allocate:
+        next_id = replies.pop(0)
+        if isinstance(next_id, Exception):
+            raise next_id
+        ids = list(range(int(next_id) - len(rows), int(next_id)))
+
+    refs = []
+    for args, reply in zip(calls, replies):
+        if isinstance(reply, redis.exceptions.NoScriptError):
+            reply = await fanout_refs_script(keys=list(args[:2]), client=redis_conn)
+        elif isinstance(reply, Exception):
+            raise reply
+        refs.append(reply)
+    refs = iter(refs)
+    return ids, [[command for args in row_fanouts for command in expand_fanout(args, next(refs))]
+                 for row_fanouts in fanouts]
+
+
+class PendingCreate:
+    """Создание одной записи между шагами ClusterCreate"""
+
+    def __init__(self, model: Model, data: Dict[str, str], entity_id=None):
+        self.data = data
+        self.entity_id = entity_id
+        self.unique, self.model_commands, self.entity_commands, self.fanouts = model.get_cluster_commands(data)
+        self.fanout_members = [[] for _ in self.fanouts]
+        self.fanout_commands = []
+        self.record_replies = []
+        self.entity_replies = []
+        self.exists = False
+        # Запись уже сохранена (get_existing_check): журнал и шаг 4 не нужны
+        self.existing = False
+        self.done = False
+        # Результат в формате parse_result или исключение
+        self.result = None
+
+    def finish(self, result):
+        self.done = True
+        self.result = result
+
+    def check_reference(self, reply):
+        if reply is None or isinstance(reply, Exception):
+            self.finish(reply)
+
+    def set_existing(self, reply):
+        if isinstance(reply, Exception):
+            self.finish(reply)
+        else:
+            self.existing = bool(reply)
 
-            self.get_redis().incr(f"{self.MODEL_NAME}:autoID")
-        except redis.exceptions.ConnectionError as e:
-            self.handle_redis_error(e)
+    def set_fanout_members(self, i: int, reply):
+        if isinstance(reply, Exception):
+            self.finish(reply)
+        elif reply:
+            self.fanout_members[i] = sorted(reply)
         else:
-            if fields_set != 3:
-                self.set_status(500)
-                self.write("Something went terribly wrong")
+            # Значений нет: сохраняется только пустая атрибуция
+            self.fanout_commands += expand_fanout(self.fanouts[i], [])
+
+    def add_fanout_refs(self, args: tuple, reply):
+        if isinstance(reply, Exception):
+            self.finish(reply)
+        else:
+            self.fanout_commands += expand_fanout(args, reply)
+
+    def get_entity_commands(self) -> List[tuple]:
+        """Команды индексов отдельных сущностей с ID записи"""
+        return [tuple(substitute_id(arg, self.entity_id) for arg in command) for command in self.entity_commands]
+
+
+class ClusterCreate:
+    """Создание записей модели в режиме Redis Cluster
+
+    Счетчики и общие индексы модели лежат в слоте ее тега, а запись и
+    индексы отдельных сущностей - в слотах этих сущностей, поэтому одним
+    скриптом запись не создать. Создание идет по шагам, каждый - один
+    pipeline на весь пакет:
+    1. проверка связанных сущностей по множествам ID их моделей и чтение
+       множеств FANOUT; уже существующая связь не попадает в журнал, для
+       нее выполняется только шаг 3;
+    2. RESERVE_ENTITY_LUA в слоте модели: проверка и занятие уникальных
+       значений, выделение ID и запись в журнал PENDING_KEY (время и данные);
+    3. запись сущности и индексов отдельных сущностей (HSET и SADD -
+       повторное выполнение ничего не меняет), чтение поля для ответа;
+    4. COMMIT_ENTITY_LUA в слоте модели: удаление из журнала и, только если
+       запись в нем была, обновление счетчиков и общих индексов модели.
+    Если создание прервано после шага 2, запись остается в журнале, и
+    recover_pending не раньше чем через PENDING_TIMEOUT завершает его
+    (шаги 3-4, если запись сущности сохранена) или откатывает: освобождает
+    уникальные значения и удаляет элементы индексов отдельных сущностей.
+    Поэтому PENDING_TIMEOUT должен превышать время любого создания.
+    """
+
+    def __init__(self, model: Model, redis_conn=None):
+        self.model = model
+        self.redis = redis_conn or r
+        self.pending_key = PENDING_KEY.format(model.name)
+
+    async def run(self, calls: List[Tuple[tuple, Any]]):
+        """Выполнение команд одним pipeline: calls - пары (команда, обработчик ответа)
+
+        Узел без скрипта в кэше (после перезапуска) отвечает NOSCRIPT: такой
+        скрипт не выполнялся, он загружается и вызывается повторно.
+        """
+        if not calls:
+            return
+        pipe = self.redis.pipeline(transaction=False)
+        for command, _ in calls:
+            pipe.execute_command(*command)
+        replies = await pipe.execute(raise_on_error=False)
+        for (command, handler), reply in zip(calls, replies):
+            if isinstance(reply, redis.exceptions.NoScriptError):
+                script = CLUSTER_SCRIPTS[command[1]]
+                numkeys = command[2]
+                reply = await script(keys=list(command[3:3 + numkeys]), args=list(command[3 + numkeys:]),
+                                     client=self.redis)
+            handler(reply)
+
+    @staticmethod
+    def fanout_calls(entries: List[PendingCreate], step: int) -> List[Tuple[tuple, Any]]:
+        """Чтение множеств FANOUT (шаг 1) и значений хешей по их элементам (шаг 2)"""
+        calls = []
+        for entry in entries:
+            for i, args in enumerate(entry.fanouts):
+                if step == 1:
+                    calls.append((("SMEMBERS", args[0]),
+                                  lambda reply, entry=entry, i=i: entry.set_fanout_members(i, reply)))
+                elif entry.fanout_members[i]:
+                    calls.append((("HMGET", args[1], *entry.fanout_members[i]),
+                                  lambda reply, entry=entry, args=args: entry.add_fanout_refs(args, reply)))
+        return calls
+
+    async def create(self, rows: List[Dict[str, str]]) -> list:
+        """Создание пакета записей; результаты - в порядке строк, в формате
+        parse_result или исключение, если команда строки завершилась ошибкой"""
+        model = self.model
+        entries = [PendingCreate(model, data) for data in rows]
+
+        calls = [(("ZSCORE", key, member), entry.check_reference)
+                 for entry in entries for key, member in model.get_reference_checks(entry.data)]
+        for entry in entries:
+            command = model.get_existing_check(entry.data)
+            if command:
+                calls.append((command, entry.set_existing))
+        await self.run(calls + self.fanout_calls(entries, 1))
+
+        def reserve(entry, reply):
+            if isinstance(reply, Exception):
+                entry.finish(reply)
+                return
+            entry.entity_id = model.parse_reserve(reply, entry.data)
+            if entry.entity_id == DUPLICATE:
+                entry.finish(DUPLICATE)
+
+        entries_left = [entry for entry in entries if not entry.done and not entry.existing]
+        calls = []
+        for entry in entries_left:
+            pending = json.dumps({'time': time.time(), 'data': entry.data})
+            calls.append((model.get_reserve_command(entry.data, pending, entry.unique),
+                          lambda reply, entry=entry: reserve(entry, reply)))
+        await self.run(calls + self.fanout_calls(entries_left, 2))
+
+        await self.finish([entry for entry in entries if not entry.done])
+        return [entry.result for entry in entries]
+
+    async def finish(self, entries: List[PendingCreate], recovery: bool = False):
+        """Шаги 3-4 для записей из журнала; откат recover_pending, случившийся
+        раньше шага 4, отменяет и запись сущности"""
+        model = self.model
+
+        def collect(replies, reply):
+            replies.append(reply)
+
+        calls = []
+        for entry in entries:
+            for command in model.get_record_commands(entry.entity_id, entry.data):
+                calls.append((command, lambda reply, entry=entry: collect(entry.record_replies, reply)))
+            for command in entry.get_entity_commands():
+                calls.append((command, lambda reply, entry=entry: collect(entry.entity_replies, reply)))
+        await self.run(calls)
+
+        rolled_back = []
+
+        def commit(entry, reply):
+            if isinstance(reply, Exception):
+                entry.finish(reply)
+            elif reply == 0 and not isinstance(model, LinkModel):
+                rolled_back.append(entry)
+                entry.finish(redis.exceptions.RedisError("Interrupted create was rolled back"))
             else:
-                self.write(f'OK: ID {auto_id} for {data["surname"]}')
+                entry.finish(model.parse_record_replies((entry.entity_id,), entry.record_replies))
+
+        calls = []
+        for entry in entries:
+            failed = [reply for reply in entry.record_replies + entry.entity_replies if isinstance(reply, Exception)]
+            if failed:
+                # Запись остается в журнале: ее завершит или откатит recover_pending
+                entry.finish(failed[0])
+                continue
+            if entry.existing:
+                # Повторная запись существующей связи ничего не меняет
+                entry.finish(model.parse_record_replies((entry.entity_id,), entry.record_replies))
+                continue
+            mode = "guarded" if recovery else model.get_commit_mode(entry.entity_replies)
+            keys, args = model.pack_commands(entry.model_commands + entry.fanout_commands, entry.entity_id)
+            calls.append((("EVALSHA", commit_entity_script.sha, 2 + len(keys), self.pending_key,
+                           IDS_KEY.format(model.name), *keys, entry.entity_id, mode, *args),
+                          lambda reply, entry=entry: commit(entry, reply)))
+        await self.run(calls)
+
+        if rolled_back:
+            pipe = self.redis.pipeline(transaction=False)
+            for entry in rolled_back:
+                pipe.delete(f"{model.name}:{entry.entity_id}")
+                for command in entry.get_entity_commands():
+                    pipe.srem(*command[1:])
+            await pipe.execute()
+
+    async def recover(self, timeout: float) -> Tuple[int, int]:
+        """Завершение или откат созданий, прерванных больше timeout секунд
+        назад. Возвращает количество завершенных и откаченных записей."""
+        model = self.model
+        now = time.time()
+        entries = []
+        for field, value in (await self.redis.hgetall(self.pending_key)).items():
+            value = json.loads(value)
+            if now - value['time'] >= timeout:
+                entries.append(PendingCreate(model, value['data'], field.decode()))
+        if not entries:
+            return 0, 0
+
+        def set_exists(entry, reply):
+            # Запись с ошибкой проверки остается в журнале до следующего раза
+            if isinstance(reply, Exception):
+                entry.finish(reply)
+            entry.exists = bool(reply)
+
+        await self.run([(model.get_exists_command(entry.entity_id, entry.data),
+                         lambda reply, entry=entry: set_exists(entry, reply)) for entry in entries])
+        finished = [entry for entry in entries if entry.exists and not entry.done]
+        released = [entry for entry in entries if not entry.exists and not entry.done]
+
+        fanouts = [args for entry in finished for args in entry.fanouts]
+        commands = iter(await resolve_fanouts(self.redis, fanouts))
+        for entry in finished:
+            for _ in entry.fanouts:
+                entry.fanout_commands += next(commands)
+        await self.finish(finished, recovery=True)
+
+        # Элементы индексов отдельных сущностей удаляются до записи журнала:
+        # прерванный откат повторится
+        pipe = self.redis.pipeline(transaction=False)
+        for entry in released:
+            for command in entry.get_entity_commands():
+                pipe.srem(*command[1:])
+        await pipe.execute()
+        await self.run([(("EVALSHA", release_entity_script.sha, 1 + len(entry.unique), self.pending_key,
+                          *(key for key, _ in entry.unique), entry.entity_id, *(value for _, value in entry.unique)),
+                         lambda reply: None) for entry in released])
+        return len(finished), len(released)
+
+
+CLUSTER_SCRIPTS = {script.sha: script for script in (reserve_entity_script, commit_entity_script,
+                                                     release_entity_script)}
+
+
+async def create_records(model: Model, rows: List[Dict[str, str]], redis_conn=None) -> list:
+    """Создание пакета записей модели: выделение ID (prepare_creates) и
+    скрипты создания одним pipeline (в режиме кластера - ClusterCreate)
+
+    Результаты - в порядке строк, в формате parse_result или исключение,
+    если команда строки завершилась ошибкой. Скрипты создания должны быть
+    загружены заранее: pipeline вызывает их через EVALSHA.
+    """
+    redis_conn = redis_conn or r
+    if CLUSTER_MODE:
+        return await ClusterCreate(model, redis_conn).create(rows)
+    ids, fanouts = await prepare_creates(redis_conn, model, rows)
+    pipe = redis_conn.pipeline(transaction=False)
+    for data, entity_id, fanout_commands in zip(rows, ids, fanouts):
+        script, keys, args = model.get_create_call(data, entity_id, fanout_commands)
+        pipe.evalsha(script.sha, len(keys), *keys, *args)
+    return [result if isinstance(result, Exception) else model.parse_result(result)
+            for result in await pipe.execute(raise_on_error=False)]
+
+
+async def recover_pending(timeout: Optional[float] = None) -> Dict[str, Tuple[int, int]]:
+    """Завершение или откат созданий режима кластера, прерванных сбоем (ClusterCreate)
+
+    Выполняется при старте и каждые PENDING_TIMEOUT секунд; одновременно -
+    только в одном процессе (блокировка RECOVERY_LOCK_KEY). Возвращает
+    количество завершенных и откаченных записей по моделям.
+    """
+    timeout = PENDING_TIMEOUT if timeout is None else timeout
+    if not await r.set(RECOVERY_LOCK_KEY, 1, nx=True, ex=max(int(PENDING_TIMEOUT), 1)):
+        return {}
+    try:
+        recovered = {}
+        for model in MODELS.values():
+            finished, released = await ClusterCreate(model).recover(timeout)
+            if finished or released:
+                logging.warning(f"Interrupted {model.name} creates: {finished} finished, {released} rolled back")
+                recovered[model.name] = (finished, released)
+        return recovered
+    finally:
+        await r.delete(RECOVERY_LOCK_KEY)
 
 
-class PatientHandler(BaseHandler):
-    MODEL_NAME = "patient"
-    REQUIRED_FIELDS = ["surname", "born_date", "sex", "mpn"]
+class BaseHandler(tornado.web.RequestHandler):
+    """Базовый обработчик с общими методами"""
+
+    # GET-запросы обработчика можно читать с реплик (см. get_redis)
+    REPLICA_READS = True
+
+    def initialize(self):
+        self._redis = None
+        self.replica_reads = False
+        # Учет обращений к Redis в рамках запроса
+        self.redis_commands = {}
+        self.redis_round_trips = 0
+        self.redis_time = 0.0
+
+    def get_redis(self):
+        """Клиент Redis, учитывающий команды запроса и метрики процесса"""
+        if self._redis is None:
+            self._redis = InstrumentedRedis(self.route_redis(), self.record_redis)
+        return self._redis
+
+    def route_redis(self):
+        """Выбор сервера для запроса, если заданы реплики
+
+        GET и HEAD обработчиков с REPLICA_READS читают с реплики. Остальные
+        запросы идут на primary и отмечают время записи в cookie клиента:
+        в течение окна read_primary_after_write его чтения тоже идут на
+        primary, поэтому клиент видит свои записи несмотря на отставание
+        реплик.
+        """
+        if not redis_manager.replicas:
+            return r
+        window = redis_manager.settings['read_primary_after_write']
+        if self.request.method not in ("GET", "HEAD"):
+            self.set_cookie(LAST_WRITE_COOKIE, f"{time.time():.3f}", max_age=int(window) + 1)
+            return r
+        if not self.REPLICA_READS or self.wrote_recently(window):
+            return r
+        redis_conn = redis_manager.get_read_connection(r)
+        self.replica_reads = redis_conn is not r
+        return redis_conn
+
+    def wrote_recently(self, window: float) -> bool:
+        """Была ли запись клиента не раньше window секунд назад"""
+        try:
+            last_write = float(self.get_cookie(LAST_WRITE_COOKIE, "0"))
+        except ValueError:
+            return False
+        return time.time() - last_write < window
+
+    def record_redis(self, round_trip: str, commands: List[str], duration: float):
+        for command in commands:
+            self.redis_commands[command] = self.redis_commands.get(command, 0) + 1
+        self.redis_round_trips += 1
+        self.redis_time += duration
+        metrics.observe_redis(round_trip, commands, duration)
+
+    def format_redis_commands(self) -> str:
+        """Команды запроса по убыванию количества: 'HGETALL=500, GET=1'"""
+        return ", ".join(f"{command}={count}" for command, count in
+                         sorted(self.redis_commands.items(), key=lambda item: -item[1]))
+
+    def flush(self, include_footers: bool = False):
+        # В режиме отладки обращения к Redis видны в заголовках ответа
+        if self.settings.get('debug') and not self._headers_written:
+            self.set_header("X-Redis-Commands", str(sum(self.redis_commands.values())))
+            self.set_header("X-Redis-Round-Trips", str(self.redis_round_trips))
+            self.set_header("X-Redis-Time-Ms", f"{self.redis_time * 1000:.2f}")
+        return super().flush(include_footers)
+
+    def on_finish(self):
+        duration = self.request.request_time()
+        metrics.observe_request(type(self).__name__, self.request.method, self.get_status(), duration)
+
+        commands = sum(self.redis_commands.values())
+        if duration * 1000 > SLOW_REQUEST_MS or self.redis_round_trips > SLOW_REQUEST_ROUND_TRIPS:
+            logging.warning(
+                f"Slow request: {self.request.method} {self.request.uri} {duration * 1000:.1f} ms, "
+                f"{commands} Redis commands in {self.redis_round_trips} round trips "
+                f"({self.redis_time * 1000:.1f} ms): {self.format_redis_commands()}")
+
+    def handle_redis_error(self, error: Exception, message: str = "Redis connection refused"):
+        """Обработка ошибок Redis"""
+        logging.error(f"Redis error: {str(error)}")
+        self.set_status(400)
+        self.write(message)
+
+    async def create_entity(self, model: Model, data: Dict[str, str]):
+        """Атомарное создание записи модели за два round trip
+
+        ID выделяется заранее (prepare_creates), в том же pipeline для модели
+        с FANOUT (диагноз) читаются больницы врачей пациента. Проверка
+        связанной сущности, запись всех полей и обновление счетчиков и
+        индексов выполняются одним Lua-скриптом; связь врач-пациент
+        создается только им. В режиме кластера запись создается по шагам
+        (ClusterCreate).
+        Возвращает кортеж (ID, все ли поля записаны, поле связанной
+        сущности для ответа) или None, если связанная сущность не найдена.
+        """
+        if CLUSTER_MODE:
+            result, = await ClusterCreate(model, self.get_redis()).create([data])
+            if isinstance(result, Exception):
+                logging.error(f"Cluster create of {model.name} failed: {result}")
+                return None, False, None
+        else:
+            (entity_id,), (fanout_commands,) = await prepare_creates(self.get_redis(), model, [data])
+            script, keys, args = model.get_create_call(data, entity_id, fanout_commands)
+            result = model.parse_result(await script(keys=keys, args=args, client=self.get_redis()))
+        if result not in (None, DUPLICATE) and result[0] is not None:
+            # Новая запись известна целиком - помещаем ее в кэш процесса,
+            # заменяя устаревшую запись с тем же ID (после очистки базы)
+            entity_cache.set(f"{model.name}:{result[0]}", dict(data))
+        return result
+
+    async def get_entity_records(self, model: str, ids: List[int]) -> Dict[int, Dict[str, str]]:
+        """Записи модели по ID: из кэша процесса, недостающие - пакетами
+        через pipeline. Несуществующим ID соответствует пустая запись."""
+        records = {entity_id: entity_cache.get(f"{model}:{entity_id}") for entity_id in ids}
+        missing = [entity_id for entity_id, record in records.items() if record is None]
+        for start in range(0, len(missing), PIPELINE_BATCH_SIZE):
+            batch = missing[start:start + PIPELINE_BATCH_SIZE]
+            pipe = self.get_redis().pipeline(transaction=False)
+            for entity_id in batch:
+                pipe.hgetall(f"{model}:{entity_id}")
+            for entity_id, record in zip(batch, await pipe.execute()):
+                record = {field.decode(): value.decode() for field, value in record.items()}
+                if record:
+                    entity_cache.set(f"{model}:{entity_id}", record)
+                records[entity_id] = record
+        return records
+
+    def get_page_args(self):
+        """Разбор параметров пагинации cursor и limit"""
+        cursor = int(self.get_argument('cursor', '0'))
+        if cursor < 0:
+            raise ValueError("cursor must be positive")
+        return cursor, self.get_limit()
+
+    def get_limit(self) -> int:
+        """Разбор параметра limit страницы"""
+        limit = int(self.get_argument('limit', str(DEFAULT_PAGE_LIMIT)))
+        if limit < 1:
+            raise ValueError("limit must be positive")
+        return min(limit, MAX_PAGE_LIMIT)
+
+    async def fetch_page(self, cursor: int, limit: int, command: str = "hgetall"):
+        """Выборка страницы записей пакетами через pipeline
+
+        ID страницы (начиная с cursor) читаются из множества существующих
+        ID модели, поэтому пропуски в нумерации не требуют обращений.
+        Возвращает список пар (ID, значение) и курсор следующей страницы
+        (None, если страница последняя). Количество обращений к Redis:
+        ZRANGEBYSCORE + ceil(limit / PIPELINE_BATCH_SIZE).
+        """
+        # Лишний ID - курсор следующей страницы
+        ids = await self.get_redis().zrangebyscore(IDS_KEY.format(self.MODEL_NAME), cursor, "+inf",
+                                                   start=0, num=limit + 1)
+        ids = [int(entity_id) for entity_id in ids]
+        next_cursor = ids[limit] if len(ids) > limit else None
+        ids = ids[:limit]
 
-    def get(self):
         items = []
+        for start in range(0, len(ids), PIPELINE_BATCH_SIZE):
+            batch = ids[start:start + PIPELINE_BATCH_SIZE]
+            pipe = self.get_redis().pipeline(transaction=False)
+            for i in batch:
+                getattr(pipe, command)(f"{self.MODEL_NAME}:{i}")
+            for i, result in zip(batch, await pipe.execute()):
+                if result:
+                    items.append((i, result))
+
+        return items, next_cursor
+
+    async def render_list_page(self, command: str = "hgetall"):
+        """Отрисовка страницы списка сущностей
+
+        Страница зависит только от версии модели. Версия читается одной
+        командой: если она не менялась, страница отдается из кэша процесса
+        без чтения записей, а клиенту с совпадающим If-None-Match
+        возвращается 304.
+        """
         try:
-            auto_id = self.get_redis().get(f"{self.MODEL_NAME}:autoID")
-            if auto_id:
-                auto_id = auto_id.decode()
+            cursor, limit = self.get_page_args()
+        except ValueError:
+            self.set_status(400)
+            self.write("Invalid cursor or limit")
+            return
 
-                for i in range(int(auto_id)):
-                    result = self.get_redis().hgetall(f"{self.MODEL_NAME}:{i}")
-                    if result:
-                        items.append(result)
+        try:
+            models = [self.MODEL_NAME]
+            versions = [await self.get_redis().get(CACHE_VERSION_KEY.format(model)) for model in models]
+            versions = tuple(int(version) if version else 0 for version in versions)
+            self.set_header("Etag", '"{}-{}-{}"'.format(
+                "-".join(f"{model}.{version}" for model, version in zip(models, versions)), cursor, limit))
+            if self.check_etag_header():
+                self.set_status(304)
+                return
 
-            self.render(f'templates/{self.MODEL_NAME}.html', items=items)
-        except redis.exceptions.ConnectionError as e:
+            cache_key = (self.MODEL_NAME, cursor, limit)
+            cached = response_cache.get(cache_key)
+            if cached and cached[0] == versions:
+                _, page, next_cursor = cached
+            else:
+                items, next_cursor = await self.fetch_page(cursor, limit, command)
+                page = self.render_string(f'templates/{self.MODEL_NAME}.html', items=items,
+                                          limit=limit, next_cursor=next_cursor)
+                response_cache.set(cache_key, (versions, page, next_cursor))
+
+            if next_cursor is not None:
+                self.set_header("X-Next-Cursor", str(next_cursor))
+            self.write(page)
+        except REDIS_ERRORS as e:
+            self.clear_header("Etag")
             self.handle_redis_error(e)
 
-    def post(self):
+
+class MainHandler(BaseHandler):
+    def get(self):
+        self.render('templates/index.html')
+
+
+class EntityHandler(BaseHandler):
+    """Список и создание записей модели MODEL_NAME по ее описанию в MODELS"""
+
+    MODEL_NAME = ""
+
+    @property
+    def model(self) -> Model:
+        return MODELS[self.MODEL_NAME]
+
+    async def get(self):
+        await self.render_list_page(self.model.list_command)
+
+    async def post(self):
+        model = self.model
         # Получаем аргументы
-        data = {
-            'surname': self.get_argument('surname'),
-            'born_date': self.get_argument('born_date'),
-            'sex': self.get_argument('sex'),
-            'mpn': self.get_argument('mpn')
-        }
+        data = {field: self.get_argument(field) for field in model.fields}
 
         # Проверяем обязательные поля
-        if not self.validate_required_fields(self.get_argument, self.REQUIRED_FIELDS):
+        error = model.validate(data)
+        if error:
             self.set_status(400)
-            self.write("All fields required")
+            self.write(error)
             return
 
-        # Проверяем пол
-        if data['sex'] not in ['M', 'F']:
-            self.set_status(400)
-            self.write("Sex must be 'M' or 'F'")
-            return
-
-        logging.debug(f"{data['surname']} {data['born_date']} {data['sex']} {data['mpn']}")
+        logging.debug(" ".join(data.values()))
 
         try:
-            auto_id = self.get_redis().get(f"{self.MODEL_NAME}:autoID").decode()
-
-            # Сохраняем данные
-            fields_set = 0
-            fields_set += self.get_redis().hset(f"{self.MODEL_NAME}:{auto_id}", "surname", data['surname'])
-            fields_set += self.get_redis().hset(f"{self.MODEL_NAME}:{auto_id}", "born_date", data['born_date'])
-            fields_set += self.get_redis().hset(f"{self.MODEL_NAME}:{auto_id}", "sex", data['sex'])
-            fields_set += self.get_redis().hset(f"{self.MODEL_NAME}:{auto_id}", "mpn", data['mpn'])
+            # Проверяем связанную сущность, выделяем ID и сохраняем данные
+            # одной атомарной операцией
+            result = await self.create_entity(model, data)
+            if result is None:
+                self.set_status(400)
+                self.write(model.reference_message)
+                return
+            if result == DUPLICATE:
+                self.set_status(409)
+                self.write(model.unique_message)
+                return
 
-            self.get_redis().incr(f"{self.MODEL_NAME}:autoID")
-        except redis.exceptions.ConnectionError as e:
+            auto_id, complete, label = result
+        except REDIS_ERRORS as e:
             self.handle_redis_error(e)
         else:
-            if fields_set != 4:
+            if not complete:
                 self.set_status(500)
                 self.write("Something went terribly wrong")
             else:
-                self.write(f'OK: ID {auto_id} for {data["surname"]}')
+                self.write(model.format_created(auto_id, data, label))
 
 
-class DiagnosisHandler(BaseHandler):
-    MODEL_NAME = "diagnosis"
-    REQUIRED_FIELDS = ["patient_ID", "type"]
+class HospitalHandler(EntityHandler):
+    MODEL_NAME = "hospital"
 
-    def get(self):
-        items = []
+
+class DoctorHandler(EntityHandler):
+    MODEL_NAME = "doctor"
+
+
+class PatientHandler(EntityHandler):
+    MODEL_NAME = "patient"
+
+
+class HospitalDoctorsHandler(BaseHandler):
+    """Список врачей больницы по индексу {hospital:ID}:doctors (HOSPITAL_DOCTORS_KEY)"""
+
+    # Поля врача, возвращаемые в списке
+    DOCTOR_FIELDS = ["surname", "profession"]
+
+    async def get(self, hospital_id):
         try:
-            auto_id = self.get_redis().get(f"{self.MODEL_NAME}:autoID")
-            if auto_id:
-                auto_id = auto_id.decode()
+            redis_conn = self.get_redis()
 
-                for i in range(int(auto_id)):
-                    result = self.get_redis().hgetall(f"{self.MODEL_NAME}:{i}")
-                    if result:
-                        items.append(result)
+            # Название больницы и ID ее врачей - одним round trip
+            pipe = redis_conn.pipeline(transaction=False)
+            pipe.hget(f"hospital:{hospital_id}", "name")
+            pipe.smembers(HOSPITAL_DOCTORS_KEY.format(hospital_id))
+            hospital_name, doctor_ids = await pipe.execute()
 
-            self.render(f'templates/{self.MODEL_NAME}.html', items=items)
-        except redis.exceptions.ConnectionError as e:
+            if hospital_name is None:
+                self.set_status(404)
+                self.write("No hospital with such ID")
+                return
+
+            doctor_ids = sorted(int(doctor_id) for doctor_id in doctor_ids)
+            records = await self.get_entity_records("doctor", doctor_ids)
+
+            doctors = []
+            for doctor_id in doctor_ids:
+                doctor = {'id': doctor_id}
+                for field in self.DOCTOR_FIELDS:
+                    doctor[field] = records[doctor_id].get(field)
+                doctors.append(doctor)
+
+            self.write({
+                'hospital_ID': int(hospital_id),
+                'name': hospital_name.decode(),
+                'doctors': doctors
+            })
+        except REDIS_ERRORS as e:
             self.handle_redis_error(e)
 
-    def post(self):
-        # Получаем аргументы
-        data = {
-            'patient_ID': self.get_argument('patient_ID'),
-            'type': self.get_argument('type'),
-            'information': self.get_argument('information')
-        }
 
-        # Проверяем обязательные поля
-        if not self.validate_required_fields(self.get_argument, self.REQUIRED_FIELDS):
-            self.set_status(400)
-            self.write("Patiend ID and diagnosis type required")
-            return
+class PatientChartHandler(BaseHandler):
+    """Карта пациента: данные пациента, его диагнозы и лечащие врачи"""
 
-        logging.debug(f"{data['patient_ID']} {data['type']} {data['information']}")
+    DIAGNOSIS_FIELDS = ["type", "information"]
+    DOCTOR_FIELDS = ["surname", "profession", "hospital_ID"]
 
+    async def get(self, patient_id):
         try:
-            auto_id = self.get_redis().get(f"{self.MODEL_NAME}:autoID").decode()
+            redis_conn = self.get_redis()
+            if CLUSTER_MODE or self.replica_reads:
+                patient, diagnoses, doctors = await self.fetch_chart_by_ids(patient_id)
+            else:
+                # Вся карта собирается одним pipeline: SORT ... GET читает поля
+                # диагнозов и врачей по обратным индексам на стороне Redis
+                pipe = redis_conn.pipeline(transaction=False)
+                pipe.hgetall(f"patient:{patient_id}")
+                pipe.sort(PATIENT_DIAGNOSES_KEY.format(patient_id), groups=True,
+                          get=["#"] + [f"diagnosis:*->{field}" for field in self.DIAGNOSIS_FIELDS])
+                pipe.sort(PATIENT_DOCTORS_KEY.format(patient_id), groups=True,
+                          get=["#"] + [f"doctor:*->{field}" for field in self.DOCTOR_FIELDS])
+                patient, diagnoses, doctors = await pipe.execute()
+                diagnoses = self.rows_to_dicts(diagnoses, self.DIAGNOSIS_FIELDS)
+                doctors = self.rows_to_dicts(doctors, self.DOCTOR_FIELDS)
 
-            # Проверяем существование пациента
-            patient = self.get_redis().hgetall(f"patient:{data['patient_ID']}")
             if not patient:
-                self.set_status(400)
+                self.set_status(404)
                 self.write("No patient with such ID")
                 return
 
-            # Сохраняем данные
-            fields_set = 0
-            fields_set += self.get_redis().hset(f"{self.MODEL_NAME}:{auto_id}", "patient_ID", data['patient_ID'])
-            fields_set += self.get_redis().hset(f"{self.MODEL_NAME}:{auto_id}", "type", data['type'])
-            fields_set += self.get_redis().hset(f"{self.MODEL_NAME}:{auto_id}", "information", data['information'])
-
-            self.get_redis().incr(f"{self.MODEL_NAME}:autoID")
-        except redis.exceptions.ConnectionError as e:
+            self.write({
+                'patient_ID': int(patient_id),
+                'patient': {field.decode(): value.decode() for field, value in patient.items()},
+                'diagnoses': diagnoses,
+                'doctors': doctors,
+            })
+        except REDIS_ERRORS as e:
             self.handle_redis_error(e)
-        else:
-            if fields_set != 3:
-                self.set_status(500)
-                self.write("Something went terribly wrong")
+
+    async def fetch_chart_by_ids(self, patient_id):
+        """Карта пациента в режиме кластера и при чтении с реплики
+
+        SORT ... GET не читает записи из других слотов кластера, а реплика
+        не выполняет SORT (команда записи из-за STORE): ID диагнозов и
+        врачей читаются вместе с записью пациента, их записи - из кэша
+        процесса или пакетами через pipeline.
+        """
+        pipe = self.get_redis().pipeline(transaction=False)
+        pipe.hgetall(f"patient:{patient_id}")
+        pipe.smembers(PATIENT_DIAGNOSES_KEY.format(patient_id))
+        pipe.smembers(PATIENT_DOCTORS_KEY.format(patient_id))
+        patient, diagnosis_ids, doctor_ids = await pipe.execute()
+        if not patient:
+            return patient, [], []
+
+        charts = []
+        for model, ids, fields in (("diagnosis", diagnosis_ids, self.DIAGNOSIS_FIELDS),
+                                   ("doctor", doctor_ids, self.DOCTOR_FIELDS)):
+            ids = sorted(int(entity_id) for entity_id in ids)
+            records = await self.get_entity_records(model, ids)
+            rows = []
+            for entity_id in ids:
+                row = {'id': entity_id}
+                for field in fields:
+                    row[field] = records[entity_id].get(field)
+                rows.append(row)
+            charts.append(rows)
+        return patient, charts[0], charts[1]
+
+    @staticmethod
+    def rows_to_dicts(rows, fields: List[str]) -> List[Dict[str, Any]]:
+        """Преобразование строк SORT ... GET # GET ... в словари"""
+        result = []
+        for row in rows:
+            item = {'id': int(row[0])}
+            for field, value in zip(fields, row[1:]):
+                item[field] = value.decode() if value is not None else None
+            result.append(item)
+        return result
+
+
+class PatientByMpnHandler(BaseHandler):
+    """Пациент по номеру полиса (MPN) через уникальный индекс"""
+
+    async def get(self, mpn):
+        try:
+            if CLUSTER_MODE:
+                record = await self.lookup_cluster(mpn)
             else:
-                patient_surname = patient.get(b'surname', b'Unknown').decode()
-                self.write(f'OK: ID {auto_id} for patient {patient_surname}')
+                # ID по индексу и данные пациента - одним Lua-скриптом
+                record = await lookup_unique_script(keys=[PATIENT_MPN_KEY], args=[mpn, "patient"],
+                                                    client=self.get_redis())
+        except REDIS_ERRORS as e:
+            self.handle_redis_error(e)
+            return
 
+        if not record or len(record) < 2:
+            self.set_status(404)
+            self.write("No patient with such MPN")
+            return
 
-class DoctorPatientHandler(BaseHandler):
-    MODEL_NAME = "doctor-patient"
+        patient_id, fields = record[0], record[1:]
+        self.write({
+            'patient_ID': int(patient_id),
+            'patient': {field.decode(): value.decode() for field, value in zip(fields[::2], fields[1::2])},
+        })
+
+    async def lookup_cluster(self, mpn):
+        """Поиск в режиме кластера: ID по индексу, запись - из кэша процесса
+        или отдельной командой. Результат - в формате LOOKUP_UNIQUE_LUA."""
+        patient_id = await self.get_redis().hget(PATIENT_MPN_KEY, mpn)
+        if patient_id is None:
+            return None
+        patient = (await self.get_entity_records("patient", [int(patient_id)]))[int(patient_id)]
+        if not patient:
+            return None
+        return [patient_id] + [item.encode() for field_value in patient.items() for item in field_value]
+
+
+class PatientBornHandler(BaseHandler):
+    """Пациенты с датой рождения в диапазоне [from, to] по индексу дат рождения
+
+    Страница ID читается скриптом ZSET_PAGE_LUA после курсора "вес:ID" -
+    даты рождения и ID последнего пациента прошлой страницы, поэтому время
+    не зависит от номера страницы. Записи - из кэша процесса или пакетами
+    через pipeline.
+    """
+
+    async def get(self):
+        try:
+            limit = self.get_limit()
+            cursor = self.get_argument('cursor', '')
+            # Вес и ID проверяются как числа, скрипту передаются строками
+            cursor = [str(int(part)) for part in cursor.split(':')] if cursor else ["", ""]
+            if len(cursor) != 2:
+                raise ValueError("cursor must be score:ID")
+            born_from = self.get_argument('from', '')
+            born_to = self.get_argument('to', '')
+            min_score = date_score(parse_date(born_from)) if born_from else "-inf"
+            max_score = date_score(parse_date(born_to)) if born_to else "+inf"
+        except ValueError:
+            self.set_status(400)
+            self.write("Invalid cursor, limit or dates (YYYY-MM-DD)")
+            return
 
-    def get(self):
-        items = {}
         try:
-            auto_id = self.get_redis().get("doctor:autoID")
-            if auto_id:
-                auto_id = auto_id.decode()
+            # Лишний ID показывает, есть ли следующая страница
+            page = await zset_page_script(keys=[PATIENT_BORN_KEY], args=[min_score, limit + 1, *cursor],
+                                          client=self.get_redis())
+            page = [(int(patient_id), int(float(score))) for patient_id, score in zip(page[::2], page[1::2])
+                    if float(score) <= float(max_score)]
+            next_cursor = None
+            if len(page) > limit:
+                patient_id, score = page[limit - 1]
+                next_cursor = f"{score}:{patient_id}"
+            ids = [patient_id for patient_id, _ in page[:limit]]
+            records = await self.get_entity_records("patient", ids)
+        except REDIS_ERRORS as e:
+            self.handle_redis_error(e)
+            return
 
-                for i in range(int(auto_id)):
-                    result = self.get_redis().smembers(f"doctor-patient:{i}")
-                    if result:
-                        items[i] = result
+        patients = []
+        for patient_id in ids:
+            patient = {'id': patient_id}
+            for field in MODELS["patient"].fields:
+                patient[field] = records[patient_id].get(field)
+            patients.append(patient)
 
-            self.render(f'templates/{self.MODEL_NAME}.html', items=items)
-        except redis.exceptions.ConnectionError as e:
-            self.handle_redis_error(e)
+        if next_cursor is not None:
+            self.set_header("X-Next-Cursor", next_cursor)
+        self.write({'from': born_from or None, 'to': born_to or None, 'patients': patients})
 
-    def post(self):
-        # Получаем аргументы
-        doctor_ID = self.get_argument('doctor_ID')
-        patient_ID = self.get_argument('patient_ID')
 
-        if not doctor_ID or not patient_ID:
-            self.set_status(400)
-            self.write("ID required")
-            return
+class DiagnosisHandler(EntityHandler):
+    MODEL_NAME = "diagnosis"
 
-        logging.debug(f"{doctor_ID} {patient_ID}")
 
-        try:
-            patient = self.get_redis().hgetall(f"patient:{patient_ID}")
-            doctor = self.get_redis().hgetall(f"doctor:{doctor_ID}")
+class DoctorPatientHandler(EntityHandler):
+    MODEL_NAME = "doctor-patient"
 
-            if not patient or not doctor:
-                self.set_status(400)
-                self.write("No such ID for doctor or patient")
-                return
 
-            self.get_redis().sadd(f"doctor-patient:{doctor_ID}", patient_ID)
+class SearchHandler(BaseHandler):
+    """Поиск записей по префиксу поля поиска модели (search_field)
+
+    Префикс ищется без учета регистра одной командой ZRANGEBYLEX по
+    индексу SEARCH_KEY - время не зависит от количества записей. Записи
+    найденных ID берутся из кэша процесса или пакетами через pipeline.
+    """
 
-        except redis.exceptions.ConnectionError as e:
+    async def get(self, model_name):
+        model = MODELS[model_name]
+        query = self.get_argument('q', '').strip().lower()
+        try:
+            limit = int(self.get_argument('limit', str(DEFAULT_SEARCH_LIMIT)))
+        except ValueError:
+            limit = 0
+        if not query or limit < 1:
+            self.set_status(400)
+            self.write("Search query and positive limit required")
+            return
+        limit = min(limit, MAX_SEARCH_LIMIT)
+
+        try:
+            # Элементы "значение\0ID": все значения с префиксом лежат между
+            # "[префикс" и "[префикс\xff" (байт 0xff не встречается в UTF-8)
+            prefix = query.encode()
+            members = await self.get_redis().zrangebylex(
+                SEARCH_KEY.format(model.name), b"[" + prefix, b"[" + prefix + b"\xff", start=0, num=limit)
+            ids = [int(member.rsplit(b"\0", 1)[1]) for member in members]
+            records = await self.get_entity_records(model.name, ids)
+        except REDIS_ERRORS as e:
             self.handle_redis_error(e)
-        else:
-            self.write(f"OK: doctor ID: {doctor_ID}, patient ID: {patient_ID}")
+            return
+
+        results = []
+        for entity_id in ids:
+            result = {'id': entity_id}
+            for field in model.fields:
+                result[field] = records[entity_id].get(field)
+            results.append(result)
+
+        self.write({'model': model.name, 'query': query, 'results': results})
 
 
 class AnalyticsHandler(BaseHandler):
     """Обработчик для аналитики"""
 
-    def get(self):
-        """Получение аналитической информации"""
+    async def get(self):
+        """Получение аналитической информации
+
+        Все показатели читаются из инкрементально поддерживаемых счетчиков
+        одним pipeline, независимо от объема данных.
+        """
         try:
-            analytics = {}
+            pipe = self.get_redis().pipeline(transaction=False)
+            for model in MODELS:
+                pipe.get(ENTITY_COUNT_KEY.format(model))
+            pipe.hgetall(HOSPITAL_DOCTORS_COUNT_KEY)
+            pipe.hgetall(HOSPITAL_NAMES_KEY)
+            pipe.hlen(PATIENT_DIAGNOSES_COUNT_KEY)
+            # Возрастные группы считаются по индексу дат рождения: ZCOUNT
+            # по диапазону дат каждой группы в том же pipeline
+            age_buckets = self.get_age_buckets(datetime.date.today())
+            for _, min_score, max_score in age_buckets:
+                pipe.zcount(PATIENT_BORN_KEY, min_score, max_score)
+            results = await pipe.execute()
+            counts = dict(zip(MODELS, results[:len(MODELS)]))
+            hospital_doctors, hospital_names, patients_with_diagnoses, *age_counts = results[len(MODELS):]
 
-            # Подсчет количества сущностей
-            analytics['hospital_count'] = int(r.get("hospital:autoID").decode()) - 1 if r.get("hospital:autoID") else 0
-            analytics['doctor_count'] = int(r.get("doctor:autoID").decode()) - 1 if r.get("doctor:autoID") else 0
-            analytics['patient_count'] = int(r.get("patient:autoID").decode()) - 1 if r.get("patient:autoID") else 0
-            analytics['diagnosis_count'] = int(r.get("diagnosis:autoID").decode()) - 1 if r.get("diagnosis:autoID") else 0
+            analytics = {}
 
-            # Подсчет связей врач-пациент
-            doctor_auto_id = int(r.get("doctor:autoID").decode()) if r.get("doctor:autoID") else 0
-            doctor_patient_count = 0
-            for i in range(doctor_auto_id):
-                connections = r.smembers(f"doctor-patient:{i}")
-                doctor_patient_count += len(connections)
+            # Количество сущностей
+            for model in ENTITY_MODELS:
+                analytics[f'{model}_count'] = int(counts[model] or 0)
 
-            analytics['doctor_patient_connections'] = doctor_patient_count
+            # Связи врач-пациент
+            analytics['doctor_patient_connections'] = int(counts['doctor-patient'] or 0)
 
             # Дополнительная аналитика
             analytics['total_entities'] = (
@@ -405,68 +2316,741 @@ class AnalyticsHandler(BaseHandler):
             else:
                 analytics['avg_diagnoses_per_patient'] = 0
 
-            # Подсчет количества сущностей в каждой больнице
+            analytics['patients_with_diagnoses'] = patients_with_diagnoses
+
+            # Количество врачей в каждой больнице
             hospitals_with_stats = []
-            for i in range(analytics['hospital_count']):
-                hospital = r.hgetall(f"hospital:{i}")
-                if hospital:
-                    hospital_name = hospital.get(b'name', b'Unknown').decode()
-
-                    # Подсчет врачей в этой больнице
-                    doctors_in_hospital = 0
-                    for j in range(analytics['doctor_count']):
-                        doctor = r.hgetall(f"doctor:{j}")
-                        if doctor and doctor.get(b'hospital_ID', b'').decode() == str(i):
-                            doctors_in_hospital += 1
-
-                    hospitals_with_stats.append({
-                        'id': i,
-                        'name': hospital_name,
-                        'doctors_count': doctors_in_hospital
-                    })
+            for hospital_id in sorted(hospital_names, key=int):
+                hospitals_with_stats.append({
+                    'id': int(hospital_id),
+                    'name': hospital_names[hospital_id].decode(),
+                    'doctors_count': int(hospital_doctors.get(hospital_id, 0))
+                })
 
             analytics['hospitals_with_stats'] = hospitals_with_stats
 
+            # Количество пациентов по возрастным группам
+            analytics['age_distribution'] = {
+                label: count for (label, _, _), count in zip(age_buckets, age_counts)
+            }
+
             self.set_header("Content-Type", "application/json")
             self.write(analytics)
 
         except Exception as e:
             self.handle_redis_error(e, "Error retrieving analytics")
 
+    @staticmethod
+    def get_age_buckets(today: datetime.date) -> List[Tuple[str, Any, Any]]:
+        """Возрастные группы AGE_BUCKETS: (название, мин. и макс. вес даты рождения)
+
+        Возраст не меньше lo лет - родился не позже, чем lo лет назад;
+        меньше hi лет - строго позже, чем hi лет назад. Вес ГГГГММДД
+        сдвигается на целые годы, поэтому 29 февраля не требует поправок.
+        """
+        today_score = date_score(today)
+        buckets = []
+        for lo, hi in zip(AGE_BUCKETS, AGE_BUCKETS[1:] + (None,)):
+            label = f"{lo}-{hi - 1}" if hi else f"{lo}+"
+            min_score = f"({today_score - hi * 10000}" if hi else "-inf"
+            buckets.append((label, min_score, today_score - lo * 10000))
+        return buckets
+
+
+class TopDiagnosesHandler(BaseHandler):
+    """Самые частые типы диагнозов: всего или по больнице (hospital)
+
+    Рейтинг читается из sorted set счетчиков одной командой ZREVRANGE,
+    независимо от количества диагнозов. Диагноз относится к больницам
+    лечащих врачей пациента на момент постановки.
+    """
+
+    async def get(self):
+        hospital_id = self.get_argument('hospital', '')
+        try:
+            n = int(self.get_argument('n', str(DEFAULT_TOP_DIAGNOSES)))
+        except ValueError:
+            n = 0
+        if n < 1 or (hospital_id and not hospital_id.isdigit()):
+            self.set_status(400)
+            self.write("Positive n and numeric hospital ID required")
+            return
+        n = min(n, MAX_TOP_DIAGNOSES)
 
-def init_db():
-    """Инициализация базы данных"""
-    db_initiated = r.get("db_initiated")
-    if not db_initiated:
-        r.set("hospital:autoID", 1)
-        r.set("doctor:autoID", 1)
-        r.set("patient:autoID", 1)
-        r.set("diagnosis:autoID", 1)
-        r.set("db_initiated", 1)
+        try:
+            pipe = self.get_redis().pipeline(transaction=False)
+            if hospital_id:
+                pipe.hget(HOSPITAL_NAMES_KEY, hospital_id)
+                pipe.zrevrange(HOSPITAL_DIAGNOSIS_TYPES_KEY.format(hospital_id), 0, n - 1, withscores=True)
+                hospital_name, top = await pipe.execute()
+                if hospital_name is None:
+                    self.set_status(404)
+                    self.write("No hospital with such ID")
+                    return
+            else:
+                pipe.zrevrange(DIAGNOSIS_TYPES_KEY, 0, n - 1, withscores=True)
+                top, = await pipe.execute()
+        except REDIS_ERRORS as e:
+            self.handle_redis_error(e)
+            return
+
+        self.write({
+            'hospital_ID': int(hospital_id) if hospital_id else None,
+            'top': [{'type': diagnosis_type.decode(), 'count': int(count)} for diagnosis_type, count in top],
+        })
 
 
-def make_app():
+class ExportHandler(BaseHandler):
+    """Потоковая выгрузка всех записей модели в NDJSON или CSV
+
+    Записи читаются пакетами и отправляются клиенту по мере чтения,
+    поэтому расход памяти не зависит от объема данных.
+    """
+
+    CONTENT_TYPES = {
+        'ndjson': 'application/x-ndjson',
+        'csv': 'text/csv; charset=utf-8',
+    }
+
+    async def get(self, model):
+        export_format = self.get_argument('format', 'ndjson')
+        if export_format not in self.CONTENT_TYPES:
+            self.set_status(400)
+            self.write("Format must be 'ndjson' or 'csv'")
+            return
+
+        self.set_header("Content-Type", self.CONTENT_TYPES[export_format])
+        self.set_header("Content-Disposition", f'attachment; filename="{model}.{export_format}"')
+
+        fields = MODELS[model].fields
+        columns = fields if model == "doctor-patient" else ['id'] + fields
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        if export_format == 'csv':
+            writer.writerow(columns)
+
+        flushed = False
+        buffered_rows = 0
+        try:
+            async for row in self.iterate_rows(model):
+                if export_format == 'csv':
+                    writer.writerow(row)
+                else:
+                    buffer.write(json.dumps(dict(zip(columns, row)), ensure_ascii=False) + "\n")
+
+                buffered_rows += 1
+                if buffered_rows >= PIPELINE_BATCH_SIZE:
+                    self.write(buffer.getvalue())
+                    buffer.seek(0)
+                    buffer.truncate()
+                    buffered_rows = 0
+                    # Ждем отправки клиенту, чтобы не копить данные в памяти
+                    await self.flush()
+                    flushed = True
+
+            self.write(buffer.getvalue())
+        except REDIS_ERRORS as e:
+            if flushed:
+                # Заголовки уже отправлены и статус изменить нельзя: соединение
+                # закрывается без завершающего чанка, чтобы клиент увидел обрыв
+                # выгрузки, а не получил усеченный файл как полный
+                logging.error(f"Redis error during {model} export: {str(e)}")
+                self.request.connection.close()
+            else:
+                self.clear()
+                self.handle_redis_error(e)
+
+    async def iterate_rows(self, model: str):
+        """Строки выгрузки: ID и значения полей модели"""
+        redis_conn = self.get_redis()
+        if model == "doctor-patient":
+            async for doctor_id, patient_ids in iterate_entities("doctor-patient", "smembers", redis_conn):
+                for patient_id in sorted(patient_ids, key=int):
+                    yield [doctor_id, int(patient_id)]
+            return
+
+        fields = [field.encode() for field in MODELS[model].fields]
+        async for entity_id, entity in iterate_entities(model, "hgetall", redis_conn=redis_conn):
+            yield [entity_id] + [entity[field].decode() if field in entity else None for field in fields]
+
+
+@tornado.web.stream_request_body
+class ImportHandler(BaseHandler):
+    """Потоковый массовый импорт записей модели из NDJSON
+
+    Тело запроса читается по частям: каждая строка - JSON-объект с полями
+    модели. Строки проверяются теми же правилами, что и формы (validate),
+    и создаются теми же Lua-скриптами, пакетами по PIPELINE_BATCH_SIZE
+    команд в одном pipeline (create_records; в режиме кластера - по шагам
+    ClusterCreate, pipeline на шаг). В ответе - отчет с количеством
+    созданных записей, ошибками по номерам строк и скоростью импорта.
+
+    При ошибке Redis импорт прекращается, а отчет о строках до сбоя
+    возвращается со статусом 400. В last_committed_line - номер строки,
+    до которой включительно все строки обработаны (созданы или попали в
+    errors). Строки после нее могли быть частично записаны, импорт
+    продолжается с last_committed_line + 1.
+    """
+
+    async def prepare(self):
+        self.request.connection.set_max_body_size(IMPORT_MAX_BODY_SIZE)
+        self.model = self.path_args[0]
+        self.model_handler = MODELS[self.model]
+        self.buffer = b""
+        self.batch = []
+        self.line_number = 0
+        self.committed_line = 0
+        self.rows = 0
+        self.created = 0
+        self.failed = 0
+        self.errors = []
+        self.redis_error = None
+        self.started = time.monotonic()
+
+        # В pipeline используется EVALSHA, поэтому скрипты загружаются заранее
+        try:
+            redis_conn = self.get_redis()
+            await redis_conn.script_load(CREATE_ENTITY_LUA)
+            await redis_conn.script_load(LINK_DOCTOR_PATIENT_LUA)
+            if has_fanout(self.model_handler):
+                await redis_conn.script_load(FANOUT_REFS_LUA)
+        except REDIS_ERRORS as e:
+            self.redis_error = e
+
+    async def data_received(self, chunk: bytes):
+        if self.redis_error:
+            return
+
+        lines = (self.buffer + chunk).split(b"\n")
+        self.buffer = lines.pop()
+        for line in lines:
+            self.add_line(line)
+            if len(self.batch) >= PIPELINE_BATCH_SIZE:
+                await self.flush_batch()
+                if self.redis_error:
+                    return
+
+    async def post(self, model):
+        if not self.redis_error:
+            if self.buffer:
+                self.add_line(self.buffer)
+            await self.flush_batch()
+
+        seconds = time.monotonic() - self.started
+        report = {
+            'model': model,
+            'rows': self.rows,
+            'created': self.created,
+            'failed': self.failed,
+            'errors': self.errors,
+            'last_committed_line': self.committed_line,
+            'seconds': round(seconds, 3),
+            'rows_per_second': round(self.rows / seconds, 1) if seconds else None,
+        }
+        if self.redis_error:
+            logging.error(f"Redis error during {model} import: {str(self.redis_error)}")
+            self.set_status(400)
+            report['error'] = "Redis connection refused"
+        self.write(report)
+
+    def add_line(self, line: bytes):
+        """Разбор и проверка строки NDJSON; корректные строки попадают в пакет"""
+        self.line_number += 1
+        line = line.strip()
+        if not line:
+            return
+
+        self.rows += 1
+        try:
+            row = json.loads(line)
+        except ValueError:
+            self.add_error(self.line_number, "Invalid JSON")
+            return
+        if not isinstance(row, dict):
+            self.add_error(self.line_number, "Row must be a JSON object")
+            return
+
+        data = {field: "" if row.get(field) is None else str(row[field]) for field in self.model_handler.fields}
+        error = self.model_handler.validate(data)
+        if error:
+            self.add_error(self.line_number, error)
+            return
+
+        self.batch.append((self.line_number, data))
+
+    def add_error(self, line_number: int, message: str):
+        self.failed += 1
+        if len(self.errors) < IMPORT_MAX_ERRORS:
+            self.errors.append({'line': line_number, 'error': message})
+
+    async def flush_batch(self):
+        """Создание накопленных записей одним pipeline"""
+        if not self.batch:
+            self.committed_line = self.line_number
+            return
+
+        batch, self.batch = self.batch, []
+        try:
+            results = await create_records(self.model_handler, [data for _, data in batch], self.get_redis())
+        except REDIS_ERRORS as e:
+            self.redis_error = e
+            return
+
+        for (line_number, _), result in zip(batch, results):
+            if isinstance(result, Exception):
+                self.add_error(line_number, str(result))
+            elif result is None:
+                self.add_error(line_number, self.model_handler.reference_message)
+            elif result == DUPLICATE:
+                self.add_error(line_number, self.model_handler.unique_message)
+            else:
+                self.created += 1
+        # Пакет заполняется строками подряд, поэтому обработаны все прочитанные строки
+        self.committed_line = self.line_number
+
+
+class HealthHandler(BaseHandler):
+    """Проверка доступности Redis и состояние пула соединений"""
+
+    # Проверяется primary; доступность реплик - по последним обращениям
+    REPLICA_READS = False
+
+    async def get(self):
+        status = {'redis_pool': redis_manager.pool_stats()}
+        if redis_manager.replicas:
+            status['redis_replicas'] = redis_manager.replica_stats()
+        try:
+            await self.get_redis().ping()
+            status['redis'] = 'ok'
+        except redis.exceptions.RedisError as e:
+            logging.error(f"Redis error: {str(e)}")
+            self.set_status(503)
+            status['redis'] = 'unavailable'
+
+        self.write(status)
+
+
+class MetricsHandler(BaseHandler):
+    """Метрики в текстовом формате Prometheus (в production - всех рабочих процессов)"""
+
+    def get(self):
+        self.set_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.write(metrics.render())
+
+
+async def init_db():
+    """Инициализация базы данных"""
+    db_initiated = await r.get(DB_INITIATED_KEY)
+    if not db_initiated and await r.get(LEGACY_DB_INITIATED_KEY):
+        # База создана до раскладки ключей с хеш-тегами: переносим на месте
+        await migrate_layout()
+        db_initiated = True
+    if not db_initiated:
+        for model in ENTITY_MODELS:
+            await r.set(AUTO_ID_KEY.format(model), 1)
+        await r.set(DB_INITIATED_KEY, 1)
+
+    # Счетчики и индексы появились позже данных: перестраиваем их один раз
+    # для каждой новой версии схемы индексов
+    index_version = await r.get(INDEX_VERSION_KEY)
+    if not index_version or int(index_version) < INDEX_VERSION:
+        await migrate_meta_keys()
+        await rebuild_indexes()
+
+    if CLUSTER_MODE:
+        await recover_pending()
+
+
+def substitute_id(arg, entity_id):
+    """Подстановка ID записи в аргумент команды индекса (аргументы IdSuffix)"""
+    if isinstance(arg, IdSuffix):
+        return f"{arg}{entity_id}"
+    return arg
+
+
+async def iterate_records(model: Model):
+    """Обход сохраненных записей модели: пары (ID, поля записи)
+
+    Для связей врач-пациент ID нет, поля - doctor_ID и patient_ID.
+    """
+    if isinstance(model, LinkModel):
+        async for doctor_id, patient_ids in probe_entities("doctor", "smembers", key_prefix=model.name):
+            for patient_id in sorted(patient_ids, key=int):
+                yield None, {'doctor_ID': str(doctor_id), 'patient_ID': patient_id.decode()}
+        return
+
+    async for entity_id, entity in probe_entities(model.name, "hgetall"):
+        entity = {field.decode(): value.decode() for field, value in entity.items()}
+        yield entity_id, {field: entity.get(field, "") for field in model.fields}
+
+
+def rebuild_command(command: tuple, entity_id) -> tuple:
+    """Команда индекса записи для пересчета: ID подставлен, ключ заменен
+    временным; команды FANOUT разворачивает replay_fanouts"""
+    command = tuple(substitute_id(arg, entity_id) for arg in command)
+    if command[0] == "FANOUT":
+        return command
+    return (command[0], command[1] + REBUILD_SUFFIX) + command[2:]
+
+
+async def replay_fanouts(fanouts: List[tuple]) -> List[tuple]:
+    """Команды FANOUT пакета записей для пересчета
+
+    Значения берутся из хеша атрибуции, сохраненного при создании записи,
+    поэтому пересчет дает те же счетчики, что и запись. У записей, созданных
+    до появления атрибуции, значения читаются из уже пересчитанных
+    временных индексов (текущие связи) и сохраняются.
+    """
+    pipe = r.pipeline(transaction=False)
+    for args in fanouts:
+        pipe.hget(args[2], args[3])
+    stored = await pipe.execute() if fanouts else []
+
+    missing = [(args[0] + REBUILD_SUFFIX, args[1] + REBUILD_SUFFIX) + args[2:]
+               for args, refs in zip(fanouts, stored) if refs is None]
+    resolved = iter(await resolve_fanouts(r, missing))
+    commands = []
+    for args, refs in zip(fanouts, stored):
+        commands += expand_fanout(args, refs.split(b",")) if refs is not None else next(resolved)
+    return commands
+
+
+async def write_rebuild_batch(commands: List[tuple], fanouts: List[tuple]):
+    """Запись пакета команд пересчета во временные ключи и продление блокировки"""
+    pipe = r.pipeline(transaction=False)
+    pipe.expire(REBUILD_LOCK_KEY, REBUILD_LOCK_TIMEOUT)
+    for command in commands:
+        pipe.execute_command(*command)
+    for command in await replay_fanouts(fanouts):
+        pipe.execute_command(command[0], command[1] + REBUILD_SUFFIX, *command[2:])
+    await pipe.execute()
+
+
+async def scan_batches(pattern: str):
+    """Ключи по шаблону пакетами по PIPELINE_BATCH_SIZE"""
+    keys = []
+    async for key in r.scan_iter(match=pattern, count=PIPELINE_BATCH_SIZE):
+        keys.append(key.decode())
+        if len(keys) >= PIPELINE_BATCH_SIZE:
+            yield keys
+            keys = []
+    if keys:
+        yield keys
+
+
+async def drain_rebuild_keys(rename: bool):
+    """Переименование временных ключей пересчета на место прежних или их удаление
+
+    Ключи лежат в разных слотах, поэтому каждый обрабатывается отдельной
+    командой. Обход повторяется, пока временные ключи остаются: ключи
+    меняются во время обхода SCAN.
+    """
+    found = True
+    while found:
+        found = False
+        async for keys in scan_batches(f"*{REBUILD_SUFFIX}"):
+            found = True
+            pipe = r.pipeline(transaction=False)
+            pipe.expire(REBUILD_LOCK_KEY, REBUILD_LOCK_TIMEOUT)
+            for key in keys:
+                if rename:
+                    pipe.rename(key, key[:-len(REBUILD_SUFFIX)])
+                else:
+                    pipe.delete(key)
+            for reply in await pipe.execute(raise_on_error=False):
+                # SCAN может вернуть уже переименованный ключ повторно
+                if isinstance(reply, Exception) and "no such key" not in str(reply):
+                    raise reply
+
+
+async def rebuild_indexes():
+    """Пересчет счетчиков аналитики и вторичных индексов по сохраненным данным
+
+    Выполняется однократно при старте на базе, созданной до появления
+    текущей версии индексов; дальше они обновляются при записи. Команды
+    индексов берутся из описаний моделей (get_index_updates), как при
+    создании записи, и выполняются пакетами по PIPELINE_BATCH_SIZE записей
+    во временные ключи; затем каждый временный ключ переименовывается на
+    место прежнего. Записи, созданные во время пересчета, в индексы не
+    попадут, поэтому запись в базу на это время должна быть остановлена.
+    Команды FANOUT повторяются по сохраненной при создании атрибуции
+    (replay_fanouts); модели с FANOUT пересчитываются последними, чтобы
+    записи без атрибуции учитывались по уже пересчитанным связям.
+    """
+    if not await r.set(REBUILD_LOCK_KEY, 1, nx=True, ex=REBUILD_LOCK_TIMEOUT):
+        raise RuntimeError("Index rebuild is already running in another process")
+    try:
+        # Временные ключи прерванного пересчета
+        await drain_rebuild_keys(rename=False)
+
+        counts = {}
+        # Модели с FANOUT - последними: записи без атрибуции учитываются по пересчитанным связям
+        for model in sorted(MODELS.values(), key=has_fanout):
+            counts[model.name] = 0
+            commands, fanouts = [], []
+            async for entity_id, data in iterate_records(model):
+                counts[model.name] += 1
+                for command in model.get_index_updates(data):
+                    command = rebuild_command(command, entity_id)
+                    if command[0] == "FANOUT":
+                        fanouts.append(command[1:])
+                    else:
+                        commands.append(command)
+                if counts[model.name] % PIPELINE_BATCH_SIZE == 0:
+                    await write_rebuild_batch(commands, fanouts)
+                    commands, fanouts = [], []
+            await write_rebuild_batch(commands, fanouts)
+
+        # Ключи без пересчитанных данных удаляются: счетчики моделей без
+        # записей и ключи FANOUT (зависят от данных, ищутся по префиксу RefSuffix)
+        stale = [ENTITY_COUNT_KEY.format(model) for model in MODELS]
+        for pattern in {f"{arg}*" for model in MODELS.values() for command in model.indexes
+                        if command[0] == "FANOUT" for arg in command if isinstance(arg, RefSuffix)}:
+            async for keys in scan_batches(pattern):
+                stale += [key for key in keys if not key.endswith(REBUILD_SUFFIX)]
+        for start in range(0, len(stale), PIPELINE_BATCH_SIZE):
+            keys = stale[start:start + PIPELINE_BATCH_SIZE]
+            pipe = r.pipeline(transaction=False)
+            for key in keys:
+                pipe.exists(key + REBUILD_SUFFIX)
+            rebuilt = await pipe.execute()
+            pipe = r.pipeline(transaction=False)
+            for key, exists in zip(keys, rebuilt):
+                if not exists:
+                    pipe.delete(key)
+            await pipe.execute()
+
+        # RENAME заменяет ключ атомарно: читатели видят прежний или новый индекс
+        await drain_rebuild_keys(rename=True)
+
+        await r.set(INDEX_VERSION_KEY, INDEX_VERSION)
+        logging.info(f"Analytics counters and indexes rebuilt: {counts}")
+    finally:
+        await r.delete(REBUILD_LOCK_KEY)
+
+
+async def migrate_layout(source=None) -> int:
+    """Перенос базы из раскладки ключей без хеш-тегов
+
+    Записи сущностей и связей копируются из source в текущую базу r (DUMP
+    и RESTORE пакетами через pipeline), счетчики ID переносятся в ключи с
+    хеш-тегом, индексы и счетчики аналитики перестраиваются по записям.
+    Без source база переносится на месте: записи остаются, старые
+    служебные ключи удаляются. Возвращает количество скопированных записей.
+    """
+    pipe = (source or r).pipeline(transaction=False)
+    for model in ENTITY_MODELS:
+        pipe.get(f"{model}:autoID")
+    auto_ids = await pipe.execute()
+
+    copied = 0
+    if source is not None:
+        for model in MODELS:
+            copied += await copy_records(source, model)
+
+    # Счетчики переносятся до удаления старых ключей, чтобы прерванный
+    # перенос не привел к повторной выдаче ID
+    for model, auto_id in zip(ENTITY_MODELS, auto_ids):
+        await r.set(AUTO_ID_KEY.format(model), auto_id or 1)
+    await r.set(DB_INITIATED_KEY, 1)
+
+    if source is None:
+        for pattern in LEGACY_KEY_PATTERNS:
+            keys = [key async for key in r.scan_iter(match=pattern)
+                    if not key.startswith(b"{")]
+            for start in range(0, len(keys), PIPELINE_BATCH_SIZE):
+                await r.delete(*keys[start:start + PIPELINE_BATCH_SIZE])
+
+    await rebuild_indexes()
+    logging.info(f"Key layout migrated: {copied} records copied")
+    return copied
+
+
+async def migrate_meta_keys():
+    """Перенос счетчиков ID и версий из раскладки с общим тегом '{meta}'
+
+    Остальные ключи этой раскладки удаляются: индексы и счетчики
+    аналитики затем перестраивает rebuild_indexes. В базе без таких
+    ключей ничего не меняется.
+    """
+    pipe = r.pipeline(transaction=False)
+    for model in ENTITY_MODELS:
+        pipe.get(META_AUTO_ID_KEY.format(model))
+    pipe.hgetall(META_CACHE_VERSIONS_KEY)
+    *auto_ids, versions = await pipe.execute()
+
+    # Счетчики переносятся до удаления старых ключей, чтобы прерванный
+    # перенос не привел к повторной выдаче ID
+    for model, auto_id in zip(ENTITY_MODELS, auto_ids):
+        if auto_id:
+            await r.set(AUTO_ID_KEY.format(model), auto_id)
+    for model, version in versions.items():
+        await r.set(CACHE_VERSION_KEY.format(model.decode()), version)
+
+    for pattern in META_KEY_PATTERNS:
+        keys = [key async for key in r.scan_iter(match=pattern)]
+        # Все ключи - в слоте тега '{meta}'
+        for start in range(0, len(keys), PIPELINE_BATCH_SIZE):
+            await r.delete(*keys[start:start + PIPELINE_BATCH_SIZE])
+
+
+async def copy_records(source, model: str) -> int:
+    """Копирование записей модели из source в r пакетами DUMP/RESTORE"""
+    copied = 0
+    keys = []
+    async for key in source.scan_iter(match=f"{model}:*", count=PIPELINE_BATCH_SIZE):
+        # Служебные ключи старой раскладки (autoID, ids) не копируются
+        if key.split(b":", 1)[1].isdigit():
+            keys.append(key)
+        if len(keys) >= PIPELINE_BATCH_SIZE:
+            copied += await restore_records(source, keys)
+            keys = []
+    if keys:
+        copied += await restore_records(source, keys)
+    return copied
+
+
+async def restore_records(source, keys: List[bytes]) -> int:
+    """Копирование пакета записей: DUMP из source и RESTORE в r"""
+    pipe = source.pipeline(transaction=False)
+    for key in keys:
+        pipe.dump(key)
+    dumps = await pipe.execute()
+
+    pipe = r.pipeline(transaction=False)
+    for key, dump in zip(keys, dumps):
+        if dump is not None:
+            pipe.restore(key, 0, dump, replace=True)
+    await pipe.execute()
+    return sum(1 for dump in dumps if dump is not None)
+
+
+async def iterate_entities(model: str, command: str, redis_conn=None):
+    """Обход всех записей модели пакетами через pipeline
+
+    ID берутся из множества существующих ID модели (IDS_KEY): ID
+    следующего пакета читаются в том же pipeline, что и записи текущего,
+    поэтому обход занимает 1 + ceil(записей / PIPELINE_BATCH_SIZE) round
+    trip. Возвращает пары (ID, результат команды) для непустых записей.
+    В памяти одновременно находится не больше PIPELINE_BATCH_SIZE записей.
+    """
+    redis_conn = redis_conn or r
+    ids_key = IDS_KEY.format(model)
+    ids = await redis_conn.zrangebyscore(ids_key, "-inf", "+inf", start=0, num=PIPELINE_BATCH_SIZE)
+
+    while ids:
+        ids = [int(entity_id) for entity_id in ids]
+        pipe = redis_conn.pipeline(transaction=False)
+        for i in ids:
+            getattr(pipe, command)(f"{model}:{i}")
+        more = len(ids) == PIPELINE_BATCH_SIZE
+        if more:
+            pipe.zrangebyscore(ids_key, f"({ids[-1]}", "+inf", start=0, num=PIPELINE_BATCH_SIZE)
+        results = await pipe.execute()
+        next_ids = results.pop() if more else []
+        for i, result in zip(ids, results):
+            if result:
+                yield i, result
+        ids = next_ids
+
+
+async def probe_entities(counter_model: str, command: str, key_prefix: Optional[str] = None):
+    """Обход записей модели перебором ID до счетчика ID модели
+
+    Нужен только пересчету индексов: в базе, созданной до появления
+    множеств существующих ID, их еще нет.
+    """
+    key_prefix = key_prefix or counter_model
+    auto_id = await r.get(AUTO_ID_KEY.format(counter_model))
+    auto_id = int(auto_id.decode()) if auto_id else 0
+
+    for start in range(0, auto_id, PIPELINE_BATCH_SIZE):
+        ids = range(start, min(start + PIPELINE_BATCH_SIZE, auto_id))
+        pipe = r.pipeline(transaction=False)
+        for i in ids:
+            getattr(pipe, command)(f"{key_prefix}:{i}")
+        for i, result in zip(ids, await pipe.execute()):
+            if result:
+                yield i, result
+
+
+# Настройки приложения для режимов запуска
+DEVELOPMENT_SETTINGS = {
+    'autoreload': True,
+    'debug': True,
+    'compiled_template_cache': False,
+    'serve_traceback': True,
+}
+PRODUCTION_SETTINGS = {
+    'autoreload': False,
+    'debug': False,
+    'compiled_template_cache': True,
+    'static_hash_cache': True,
+    'serve_traceback': False,
+}
+
+
+def make_app(production: bool = False):
     """Создание приложения"""
+    settings = PRODUCTION_SETTINGS if production else DEVELOPMENT_SETTINGS
     return tornado.web.Application([
         (r"/", MainHandler),
         (r'/static/(.*)', tornado.web.StaticFileHandler, {'path': 'static/'}),
         (r"/hospital", HospitalHandler),
+        (r"/hospital/(\d+)/doctors", HospitalDoctorsHandler),
         (r"/doctor", DoctorHandler),
         (r"/patient", PatientHandler),
+        (r"/patient/(\d+)/chart", PatientChartHandler),
+        (r"/patient/by-mpn/([^/]+)", PatientByMpnHandler),
+        (r"/patient/born", PatientBornHandler),
         (r"/diagnosis", DiagnosisHandler),
         (r"/doctor-patient", DoctorPatientHandler),
-        (r"/analytics", AnalyticsHandler)  # Новый эндпоинт для аналитики
-    ],
-    autoreload=True,
-    debug=True,
-    compiled_template_cache=False,
-    serve_traceback=True)
+        (r"/search/(doctor|patient)", SearchHandler),
+        (r"/analytics", AnalyticsHandler),
+        (r"/analytics/diagnoses/top", TopDiagnosesHandler),  # Новый эндпоинт для аналитики
+        (r"/export/(hospital|doctor|patient|diagnosis|doctor-patient)", ExportHandler),
+        (r"/import/(hospital|doctor|patient|diagnosis|doctor-patient)", ImportHandler),
+        (r"/health", HealthHandler),
+        (r"/metrics", MetricsHandler)
+    ], **settings)
+
+
+def main():
+    """Запуск сервера в выбранном режиме (--mode или APP_MODE)"""
+    parse_command_line()
+    if options.mode not in ("development", "production"):
+        raise SystemExit("Mode must be 'development' or 'production'")
+
+    if options.mode == "production":
+        # Инициализация базы выполняется один раз до fork в отдельном event loop,
+        # который не становится текущим: рабочие процессы создают свои
+        init_loop = asyncio.new_event_loop()
+        init_loop.run_until_complete(init_db())
+        init_loop.close()
+        # Снимки метрик прошлого запуска удаляются
+        os.makedirs(METRICS_DIR, exist_ok=True)
+        for file_name in os.listdir(METRICS_DIR):
+            if file_name.startswith("worker-"):
+                os.remove(os.path.join(METRICS_DIR, file_name))
+        sockets = tornado.netutil.bind_sockets(PORT)
+        tornado.process.fork_processes(options.workers)
+        redis_manager.reset_after_fork()
+        metrics.start_worker(METRICS_DIR, tornado.process.task_id())
+        tornado.ioloop.PeriodicCallback(metrics.save_snapshot, METRICS_FLUSH_INTERVAL * 1000).start()
+        server = tornado.httpserver.HTTPServer(make_app(production=True))
+        server.add_sockets(sockets)
+        logging.info(f"Worker {tornado.process.task_id()} listening on {PORT}")
+    else:
+        tornado.ioloop.IOLoop.current().run_sync(init_db)
+        make_app().listen(PORT)
+        logging.info("Listening on " + str(PORT))
+
+    if CLUSTER_MODE:
+        # Прерванные создания записей завершаются или откатываются (ClusterCreate)
+        tornado.ioloop.PeriodicCallback(lambda: tornado.ioloop.IOLoop.current().add_callback(recover_pending),
+                                        PENDING_TIMEOUT * 1000).start()
+    tornado.ioloop.IOLoop.current().start()
 
 
 if __name__ == "__main__":
-    init_db()
-    app = make_app()
-    app.listen(PORT)
-    tornado.options.parse_command_line()
-    logging.info("Listening on " + str(PORT))
-    tornado.ioloop.IOLoop.current().start()
\ No newline at end of file
+    main()
\ No newline at end of file
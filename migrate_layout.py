@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+"""
+Перенос базы в раскладку ключей с хеш-тегами (в том числе в Redis Cluster)
+
+Записи сущностей и связей копируются из исходного Redis (--source) в
+базу, заданную переменными REDIS_* (при REDIS_CLUSTER=1 - в кластер),
+счетчики ID переносятся в ключи с хеш-тегом, а индексы и счетчики
+аналитики перестраиваются по скопированным записям. Исходная база не
+изменяется. Без --source база REDIS_* переносится на месте - то же
+делает init_db при первом запуске новой версии приложения.
+
+Примеры:
+    REDIS_CLUSTER=1 REDIS_HOST=redis-1 python migrate_layout.py --source redis://old-redis:6379/0
+    python migrate_layout.py
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+import redis.asyncio as aioredis
+
+# Импортируем наше приложение
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import main
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Migrate the database to the hash-tagged key layout")
+    parser.add_argument("--source", help="URL of the Redis with the old key layout, e.g. redis://host:6379/0 "
+                                         "(default: migrate the REDIS_* database in place)")
+    parser.add_argument("--force", action="store_true",
+                        help="copy even if the target database is already initialized")
+    return parser.parse_args(argv)
+
+
+async def run(args):
+    source = aioredis.from_url(args.source) if args.source else None
+    if source is not None:
+        if not await source.get(main.LEGACY_DB_INITIATED_KEY):
+            raise SystemExit("Source database has no data in the old key layout")
+        if await main.r.get(main.DB_INITIATED_KEY) and not args.force:
+            raise SystemExit("Target database is already initialized; use --force to copy anyway")
+    elif not await main.r.get(main.LEGACY_DB_INITIATED_KEY):
+        raise SystemExit("Database has no data in the old key layout")
+
+    started = time.monotonic()
+    copied = await main.migrate_layout(source)
+    print(f"Migrated in {time.monotonic() - started:.1f} s, {copied} records copied")
+
+
+if __name__ == "__main__":
+    asyncio.run(run(parse_args()))
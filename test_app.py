@@ -4,8 +4,9 @@ Unit-тесты для приложения hospital management
 """
 import os
 import unittest
-from unittest.mock import patch, MagicMock, Mock
+from unittest.mock import patch, call, MagicMock, Mock, AsyncMock
 import redis
+from redis.asyncio.cluster import RedisCluster
 import tornado.testing
 import sys
 import tempfile
@@ -14,12 +15,52 @@ from tornado.web import Application
 from tornado.httpserver import HTTPServer
 from tornado.httputil import HTTPConnection
 import asyncio
+import itertools
+import json
+import math
+import time
+
+try:
+    # Redis в памяти с поддержкой Lua-скриптов (requirements-dev.txt)
+    import fakeredis
+    import lupa
+except ImportError:
+    fakeredis = None
 
 # Импортируем наше приложение
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 import main
 
 
+def make_redis_mock():
+    """Создание мок-объекта асинхронного клиента Redis
+
+    Команды клиента - корутины, а pipeline() возвращает объект
+    синхронно, и только его execute() требует await. По умолчанию
+    мок описывает уже инициализированную базу с индексами текущей версии.
+    Кэши процесса очищаются, так как относятся к прежним данным.
+    """
+    main.response_cache.clear()
+    main.entity_cache.clear()
+    mock_redis = AsyncMock()
+    mock_redis.get.return_value = str(main.INDEX_VERSION).encode()
+    mock_redis.pipeline = Mock(return_value=Mock(execute=AsyncMock(return_value=[])))
+    return mock_redis
+
+
+def run(coroutine):
+    """Выполнение корутины обработчика в отдельном event loop"""
+    return asyncio.run(coroutine)
+
+
+async def create_row(redis_conn, model: str, data):
+    """Создание записи скриптом без кластера, как в EntityHandler.create_entity"""
+    model = main.MODELS[model]
+    (entity_id,), (fanout_commands,) = await main.prepare_creates(redis_conn, model, [data])
+    script, keys, args = model.get_create_call(data, entity_id, fanout_commands)
+    return await script(keys=keys, args=args, client=redis_conn)
+
+
 class TestHospitalHandler(unittest.TestCase):
     """Тесты для обработчика больниц"""
     
@@ -28,11 +69,11 @@ class TestHospitalHandler(unittest.TestCase):
         self.original_redis = main.r
         
         # Создаем мок-объект для Redis
-        self.mock_redis = Mock()
+        self.mock_redis = make_redis_mock()
         main.r = self.mock_redis
         
         # Инициализируем тестовую базу данных
-        main.init_db()
+        run(main.init_db())
         
     def tearDown(self):
         # Восстанавливаем оригинальное соединение
@@ -49,6 +90,7 @@ class TestHospitalHandler(unittest.TestCase):
         request.method = "GET"
         request.uri = "/hospital"
         request.headers = {}
+        request.arguments = {}
         
         # Создаем обработчик
         app = Application()
@@ -56,34 +98,37 @@ class TestHospitalHandler(unittest.TestCase):
         
         # Мокаем методы для избежания HTTP-ответа
         handler.write = MagicMock()
-        handler.render = MagicMock()
+        handler.render_string = MagicMock(return_value=b"<table></table>")
         
         # Вызываем метод get
-        handler.get()
+        run(handler.get())
         
-        # Проверяем, что render был вызван
-        handler.render.assert_called_once()
-        args, kwargs = handler.render.call_args
+        # Проверяем, что шаблон был отрисован
+        handler.render_string.assert_called_once()
+        args, kwargs = handler.render_string.call_args
         self.assertEqual(args[0], 'templates/hospital.html')
         self.assertIn('items', kwargs)
         self.assertEqual(len(kwargs['items']), 0)
         
     def test_get_hospitals_with_data(self):
         """Тест получения списка больниц с данными"""
-        # Настраиваем мок для возврата ID и данных
-        self.mock_redis.get.return_value = b'1'
-        self.mock_redis.hgetall.return_value = {
-            b'name': b'TestHospital',
-            b'address': b'TestAddress',
-            b'phone': b'123456789',
-            b'beds_number': b'50'
-        }
+        # Настраиваем мок для возврата существующих ID и данных
+        self.mock_redis.zrangebyscore.return_value = [b'1']
+        self.mock_redis.pipeline.return_value.execute.return_value = [
+            {
+                b'name': b'TestHospital',
+                b'address': b'TestAddress',
+                b'phone': b'123456789',
+                b'beds_number': b'50'
+            }
+        ]
         
         # Создаем мок-запрос
         request = Mock()
         request.method = "GET"
         request.uri = "/hospital"
         request.headers = {}
+        request.arguments = {}
         
         # Создаем обработчик
         app = Application()
@@ -91,24 +136,93 @@ class TestHospitalHandler(unittest.TestCase):
         
         # Мокаем методы для избежания HTTP-ответа
         handler.write = MagicMock()
-        handler.render = MagicMock()
+        handler.render_string = MagicMock(return_value=b"<table></table>")
         
         # Вызываем метод get
-        handler.get()
+        run(handler.get())
         
-        # Проверяем, что render был вызван
-        handler.render.assert_called_once()
-        args, kwargs = handler.render.call_args
+        # Проверяем, что шаблон был отрисован
+        handler.render_string.assert_called_once()
+        args, kwargs = handler.render_string.call_args
         self.assertEqual(args[0], 'templates/hospital.html')
         self.assertIn('items', kwargs)
         self.assertEqual(len(kwargs['items']), 1)
+        self.assertEqual(kwargs['items'][0][0], 1)
+        self.assertIsNone(kwargs['next_cursor'])
+
+        # Записи читаются одним pipeline, а не отдельным hgetall на каждый ID,
+        # и только существующие - по множеству ID
+        self.mock_redis.hgetall.assert_not_called()
+        self.mock_redis.pipeline.return_value.execute.assert_called_once()
+        self.mock_redis.zrangebyscore.assert_awaited_once_with(
+            "{hospital}:ids", 0, "+inf", start=0, num=main.DEFAULT_PAGE_LIMIT + 1)
+
+    def test_get_hospitals_paginated(self):
+        """Тест постраничного получения списка больниц"""
+        # ID 4 пропущен в нумерации; лишний ID 7 - курсор следующей страницы
+        self.mock_redis.zrangebyscore.return_value = [b'3', b'5', b'7']
+        self.mock_redis.pipeline.return_value.execute.return_value = [
+            {b'name': b'H3'}, {b'name': b'H4'}
+        ]
+
+        # Создаем мок-запрос с параметрами пагинации
+        request = Mock()
+        request.method = "GET"
+        request.uri = "/hospital?cursor=3&limit=2"
+        request.headers = {}
+        request.arguments = {'cursor': [b'3'], 'limit': [b'2']}
+
+        # Создаем обработчик
+        app = Application()
+        handler = main.HospitalHandler(app, request)
+
+        # Мокаем методы для избежания HTTP-ответа
+        handler.write = MagicMock()
+        handler.render_string = MagicMock(return_value=b"<table></table>")
+
+        # Вызываем метод get
+        run(handler.get())
+
+        # Проверяем, что выбраны только ID 3 и 5 и возвращен следующий курсор
+        args, kwargs = handler.render_string.call_args
+        self.assertEqual([item_id for item_id, _ in kwargs['items']], [3, 5])
+        self.assertEqual(kwargs['next_cursor'], 7)
+        self.assertEqual(handler._headers['X-Next-Cursor'], '7')
+        self.mock_redis.zrangebyscore.assert_awaited_once_with("{hospital}:ids", 3, "+inf", start=0, num=3)
+        pipe = self.mock_redis.pipeline.return_value
+        pipe.hgetall.assert_any_call("hospital:3")
+        pipe.hgetall.assert_any_call("hospital:5")
+        self.assertEqual(pipe.hgetall.call_count, 2)
+
+    def test_get_hospitals_invalid_cursor(self):
+        """Тест получения списка больниц с некорректным курсором"""
+        # Создаем мок-запрос
+        request = Mock()
+        request.method = "GET"
+        request.uri = "/hospital?cursor=abc"
+        request.headers = {}
+        request.arguments = {'cursor': [b'abc']}
+
+        # Создаем обработчик
+        app = Application()
+        handler = main.HospitalHandler(app, request)
+
+        # Мокаем методы для проверки результата
+        handler.write = MagicMock()
+        handler.set_status = MagicMock()
+
+        # Вызываем метод get
+        run(handler.get())
+
+        # Проверяем, что был установлен статус 400
+        handler.set_status.assert_called_with(400)
+        handler.write.assert_called_once_with("Invalid cursor or limit")
         
     def test_create_hospital_success(self):
         """Тест успешного создания больницы"""
         # Настраиваем мок для возврата ID
-        self.mock_redis.get.return_value = b'0'
-        self.mock_redis.incr.return_value = 1
-        self.mock_redis.hset.side_effect = [1, 1, 1, 1]  # name, address, phone, beds_number
+        self.mock_redis.pipeline.return_value.execute.return_value = [1]  # Выделен ID 0
+        self.mock_redis.evalsha.return_value = [0, 4, None]  # ID, записано полей, поле ссылки
         
         # Создаем мок-запрос
         request = Mock()
@@ -133,7 +247,7 @@ class TestHospitalHandler(unittest.TestCase):
         handler.set_status = MagicMock()
         
         # Вызываем метод post
-        handler.post()
+        run(handler.post())
         
         # Проверяем, что write был вызван с правильным сообщением
         handler.write.assert_called_once()
@@ -141,9 +255,23 @@ class TestHospitalHandler(unittest.TestCase):
         self.assertIn('OK: ID 0 for TestHospital', args[0])
         
         # Проверяем, что были вызваны методы Redis
-        self.mock_redis.get.assert_called_with("hospital:autoID")
-        self.assertEqual(self.mock_redis.hset.call_count, 4)  # name, address, phone, beds_number
-        self.mock_redis.incr.assert_called_with("hospital:autoID")
+        # ID выделяется заранее, создание выполняется одним вызовом Lua-скрипта
+        self.mock_redis.pipeline.return_value.incrby.assert_called_once_with("{hospital}:autoID", 1)
+        self.mock_redis.evalsha.assert_called_once_with(
+            # Все ключи, в которые пишет скрипт, передаются в KEYS
+            main.create_entity_script.sha, 5, "hospital:0", "{hospital}:cache:version",
+            "{hospital}:analytics:count", "{hospital}:ids", "{hospital}:analytics:names",
+            0, "", "", 4,
+            "name", "TestHospital", "address", "TestAddress",
+            "phone", "123456789", "beds_number", "50",
+            # Счетчики аналитики обновляются тем же скриптом, ID записи
+            # подставлен приложением
+            2, "INCRBY", 1,
+            2, "INCRBY", 1,
+            3, "ZADD", "0", "0",
+            3, "HSET", "0", "TestHospital")
+        self.mock_redis.hset.assert_not_called()
+        self.mock_redis.incr.assert_not_called()
         
     def test_create_hospital_missing_required_fields(self):
         """Тест создания больницы с отсутствующими обязательными полями"""
@@ -170,7 +298,7 @@ class TestHospitalHandler(unittest.TestCase):
         handler.set_status = MagicMock()
         
         # Вызываем метод post
-        handler.post()
+        run(handler.post())
         
         # Проверяем, что был установлен статус 400
         handler.set_status.assert_called_with(400)
@@ -185,11 +313,11 @@ class TestDoctorHandler(unittest.TestCase):
         self.original_redis = main.r
         
         # Создаем мок-объект для Redis
-        self.mock_redis = Mock()
+        self.mock_redis = make_redis_mock()
         main.r = self.mock_redis
         
         # Инициализируем тестовую базу данных
-        main.init_db()
+        run(main.init_db())
         
     def tearDown(self):
         # Восстанавливаем оригинальное соединение
@@ -198,10 +326,8 @@ class TestDoctorHandler(unittest.TestCase):
     def test_create_doctor_success(self):
         """Тест успешного создания врача"""
         # Настраиваем мок для возврата ID
-        self.mock_redis.get.return_value = b'0'
-        self.mock_redis.incr.return_value = 1
-        self.mock_redis.hset.side_effect = [1, 1, 1]  # surname, profession, hospital_ID
-        self.mock_redis.hgetall.return_value = {}  # Пустой результат для проверки больницы
+        self.mock_redis.pipeline.return_value.execute.return_value = [1]  # Выделен ID 0
+        self.mock_redis.evalsha.return_value = [0, 3, None]  # ID, записано полей, поле ссылки
         
         # Создаем мок-запрос
         request = Mock()
@@ -225,7 +351,7 @@ class TestDoctorHandler(unittest.TestCase):
         handler.set_status = MagicMock()
         
         # Вызываем метод post
-        handler.post()
+        run(handler.post())
         
         # Проверяем, что write был вызван с правильным сообщением
         handler.write.assert_called_once()
@@ -233,17 +359,21 @@ class TestDoctorHandler(unittest.TestCase):
         self.assertIn('OK: ID 0 for TestDoctor', args[0])
         
         # Проверяем, что были вызваны методы Redis
-        self.mock_redis.get.assert_called_with("doctor:autoID")
-        self.assertEqual(self.mock_redis.hset.call_count, 3)  # surname, profession, hospital_ID
-        self.mock_redis.incr.assert_called_with("doctor:autoID")
+        # Без ID больницы проверка ссылки не передается в скрипт
+        args, kwargs = self.mock_redis.evalsha.call_args
+        self.assertEqual(args[2], "doctor:0")
+        self.assertEqual(args[2 + args[1]:2 + args[1] + 3], (0, "", ""))
+        self.mock_redis.hset.assert_not_called()
+
+        # Созданная запись сразу попадает в кэш процесса
+        self.assertEqual(main.entity_cache.get("doctor:0"),
+                         {'surname': 'TestDoctor', 'profession': 'Surgeon', 'hospital_ID': ''})
         
     def test_create_doctor_with_valid_hospital(self):
         """Тест создания врача с указанием существующей больницы"""
         # Настраиваем мок для возврата ID и существующей больницы
-        self.mock_redis.get.return_value = b'0'
-        self.mock_redis.incr.return_value = 1
-        self.mock_redis.hset.side_effect = [1, 1, 1]  # surname, profession, hospital_ID
-        self.mock_redis.hgetall.return_value = {b'name': b'ValidHospital'}  # Существующая больница
+        self.mock_redis.pipeline.return_value.execute.return_value = [1]  # Выделен ID 0
+        self.mock_redis.evalsha.return_value = [0, 3, None]  # Больница существует
         
         # Создаем мок-запрос
         request = Mock()
@@ -267,18 +397,33 @@ class TestDoctorHandler(unittest.TestCase):
         handler.set_status = MagicMock()
         
         # Вызываем метод post
-        handler.post()
+        run(handler.post())
         
         # Проверяем, что write был вызван с правильным сообщением
         handler.write.assert_called_once()
         args, kwargs = handler.write.call_args
         self.assertIn('OK: ID 0 for TestDoctor', args[0])
+
+        # Существование больницы проверяется внутри скрипта по множеству ID больниц
+        args, kwargs = self.mock_redis.evalsha.call_args
+        self.assertEqual(args[2:5], ("doctor:0", "{hospital}:ids", "hospital:0"))
+        self.assertEqual(args[2 + args[1]:2 + args[1] + 4], (0, "0", "", 3))
+        self.mock_redis.hgetall.assert_not_called()
+
+        # Счетчик и индексы врачей больницы и поисковый индекс профессий
+        # обновляются тем же скриптом
+        self.assertEqual(args[-15:], (3, "HINCRBY", "0", 1,
+                                      2, "SADD", "0",
+                                      3, "HSET", "0", "0",
+                                      3, "ZADD", 0, "surgeon\x000"))
+        self.assertEqual(args[args[1] - 2:args[1] + 2], ("{doctor}:analytics:hospital-doctors", "{hospital:0}:doctors",
+                                                         "{doctor}:index:hospital", "{doctor}:search"))
         
     def test_create_doctor_with_invalid_hospital(self):
         """Тест создания врача с указанием несуществующей больницы"""
         # Настраиваем мок для возврата ID и пустой больницы
-        self.mock_redis.get.return_value = b'0'
-        self.mock_redis.hgetall.return_value = {}  # Пустой результат для несуществующей больницы
+        self.mock_redis.pipeline.return_value.execute.return_value = [1]  # Выделен ID 0
+        self.mock_redis.evalsha.return_value = None  # Скрипт не нашел больницу
         
         # Создаем мок-запрос
         request = Mock()
@@ -302,7 +447,7 @@ class TestDoctorHandler(unittest.TestCase):
         handler.set_status = MagicMock()
         
         # Вызываем метод post
-        handler.post()
+        run(handler.post())
         
         # Проверяем, что был установлен статус 400
         handler.set_status.assert_called_with(400)
@@ -332,13 +477,95 @@ class TestDoctorHandler(unittest.TestCase):
         handler.set_status = MagicMock()
         
         # Вызываем метод post
-        handler.post()
+        run(handler.post())
         
         # Проверяем, что был установлен статус 400
         handler.set_status.assert_called_with(400)
         handler.write.assert_called_once_with("Surname and profession required")
 
 
+class TestHospitalDoctorsHandler(unittest.TestCase):
+    """Тесты для списка врачей больницы"""
+
+    def setUp(self):
+        # Сохраняем оригинальное соединение с Redis
+        self.original_redis = main.r
+
+        # Создаем мок-объект для Redis
+        self.mock_redis = make_redis_mock()
+        main.r = self.mock_redis
+
+    def tearDown(self):
+        # Восстанавливаем оригинальное соединение
+        main.r = self.original_redis
+
+    def make_handler(self):
+        request = Mock()
+        request.method = "GET"
+        request.uri = "/hospital/1/doctors"
+        request.headers = {}
+
+        handler = main.HospitalDoctorsHandler(Application(), request)
+        handler.write = MagicMock()
+        handler.set_status = MagicMock()
+        return handler
+
+    def test_get_hospital_doctors(self):
+        """Тест получения врачей больницы по индексу"""
+        pipe = self.mock_redis.pipeline.return_value
+        pipe.execute.side_effect = [
+            [b'TestHospital', {b'5', b'2'}],
+            [{b'surname': b'Second', b'profession': b'Surgeon', b'hospital_ID': b'1'},
+             {b'surname': b'Fifth', b'profession': b'Therapist', b'hospital_ID': b'1'}],
+        ]
+
+        handler = self.make_handler()
+        run(handler.get('1'))
+
+        handler.write.assert_called_once_with({
+            'hospital_ID': 1,
+            'name': 'TestHospital',
+            'doctors': [
+                {'id': 2, 'surname': 'Second', 'profession': 'Surgeon'},
+                {'id': 5, 'surname': 'Fifth', 'profession': 'Therapist'},
+            ]
+        })
+
+        # Читаются только врачи из индекса, без обхода всех doctor:*
+        pipe.smembers.assert_called_once_with("{hospital:1}:doctors")
+        pipe.hgetall.assert_any_call("doctor:2")
+        pipe.hgetall.assert_any_call("doctor:5")
+        self.assertEqual(pipe.hgetall.call_count, 2)
+        self.mock_redis.get.assert_not_called()
+
+    def test_get_hospital_doctors_from_cache(self):
+        """Тест чтения известных процессу врачей без обращения к Redis"""
+        main.entity_cache.set("doctor:2", {'surname': 'Second', 'profession': 'Surgeon', 'hospital_ID': '1'})
+        pipe = self.mock_redis.pipeline.return_value
+        pipe.execute.side_effect = [
+            [b'TestHospital', {b'5', b'2'}],
+            [{b'surname': b'Fifth', b'profession': b'Therapist', b'hospital_ID': b'1'}],
+        ]
+
+        handler = self.make_handler()
+        run(handler.get('1'))
+
+        doctors = handler.write.call_args[0][0]['doctors']
+        self.assertEqual([doctor['surname'] for doctor in doctors], ['Second', 'Fifth'])
+        pipe.hgetall.assert_called_once_with("doctor:5")
+        self.assertEqual(main.entity_cache.get("doctor:5")['profession'], 'Therapist')
+
+    def test_get_hospital_doctors_no_hospital(self):
+        """Тест получения врачей несуществующей больницы"""
+        self.mock_redis.pipeline.return_value.execute.return_value = [None, set()]
+
+        handler = self.make_handler()
+        run(handler.get('999'))
+
+        handler.set_status.assert_called_with(404)
+        handler.write.assert_called_once_with("No hospital with such ID")
+
+
 class TestPatientHandler(unittest.TestCase):
     """Тесты для обработчика пациентов"""
     
@@ -347,11 +574,11 @@ class TestPatientHandler(unittest.TestCase):
         self.original_redis = main.r
         
         # Создаем мок-объект для Redis
-        self.mock_redis = Mock()
+        self.mock_redis = make_redis_mock()
         main.r = self.mock_redis
         
         # Инициализируем тестовую базу данных
-        main.init_db()
+        run(main.init_db())
         
     def tearDown(self):
         # Восстанавливаем оригинальное соединение
@@ -360,9 +587,8 @@ class TestPatientHandler(unittest.TestCase):
     def test_create_patient_success(self):
         """Тест успешного создания пациента"""
         # Настраиваем мок для возврата ID
-        self.mock_redis.get.return_value = b'0'
-        self.mock_redis.incr.return_value = 1
-        self.mock_redis.hset.side_effect = [1, 1, 1, 1]  # surname, born_date, sex, mpn
+        self.mock_redis.pipeline.return_value.execute.return_value = [1]  # Выделен ID 0
+        self.mock_redis.evalsha.return_value = [0, 4, None]  # ID, записано полей, поле ссылки
         
         # Создаем мок-запрос
         request = Mock()
@@ -387,7 +613,7 @@ class TestPatientHandler(unittest.TestCase):
         handler.set_status = MagicMock()
         
         # Вызываем метод post
-        handler.post()
+        run(handler.post())
         
         # Проверяем, что write был вызван с правильным сообщением
         handler.write.assert_called_once()
@@ -395,9 +621,65 @@ class TestPatientHandler(unittest.TestCase):
         self.assertIn('OK: ID 0 for TestPatient', args[0])
         
         # Проверяем, что были вызваны методы Redis
-        self.mock_redis.get.assert_called_with("patient:autoID")
-        self.assertEqual(self.mock_redis.hset.call_count, 4)  # surname, born_date, sex, mpn
-        self.mock_redis.incr.assert_called_with("patient:autoID")
+        self.mock_redis.evalsha.assert_called_once()
+        self.mock_redis.hset.assert_not_called()
+
+        # Номер полиса занимается в уникальном индексе, а фамилия в нижнем
+        # регистре попадает в поисковый индекс тем же скриптом
+        args, kwargs = self.mock_redis.evalsha.call_args
+        self.assertEqual(args[args[1]:args[1] + 2], ("{patient}:index:mpn", "{patient}:search"))
+        self.assertEqual(args[-8:], (3, "HSETNX", "123456", "0",
+                                     3, "ZADD", 0, "testpatient\x000"))
+
+    def test_create_patient_invalid_born_date(self):
+        """Тест создания пациента с датой рождения не в формате ГГГГ-ММ-ДД"""
+        request = Mock()
+        request.method = "POST"
+        request.uri = "/patient"
+        request.headers = {}
+
+        handler = main.PatientHandler(Application(), request)
+        handler.get_argument = lambda arg: {
+            'surname': 'TestPatient',
+            'born_date': '01.01.1990',
+            'sex': 'M',
+            'mpn': '123456'
+        }[arg]
+        handler.write = MagicMock()
+        handler.set_status = MagicMock()
+
+        run(handler.post())
+
+        handler.set_status.assert_called_once_with(400)
+        handler.write.assert_called_once_with("Born date must be YYYY-MM-DD")
+        self.mock_redis.evalsha.assert_not_called()
+
+    def test_create_patient_duplicate_mpn(self):
+        """Тест отказа в создании пациента с занятым номером полиса"""
+        self.mock_redis.pipeline.return_value.execute.return_value = [1]  # Выделен ID 0
+        # Скрипт нашел пациента с таким MPN и ничего не записал
+        self.mock_redis.evalsha.return_value = [-1, b'3']
+
+        request = Mock()
+        request.method = "POST"
+        request.uri = "/patient"
+        request.headers = {}
+
+        handler = main.PatientHandler(Application(), request)
+        handler.get_argument = lambda arg: {
+            'surname': 'TestPatient',
+            'born_date': '1990-01-01',
+            'sex': 'M',
+            'mpn': '123456'
+        }[arg]
+        handler.write = MagicMock()
+        handler.set_status = MagicMock()
+
+        run(handler.post())
+
+        handler.set_status.assert_called_once_with(409)
+        handler.write.assert_called_once_with("Patient with such MPN already exists")
+        self.assertIsNone(main.entity_cache.get("patient:-1"))
         
     def test_create_patient_invalid_sex(self):
         """Тест создания пациента с неправильным полом"""
@@ -424,7 +706,7 @@ class TestPatientHandler(unittest.TestCase):
         handler.set_status = MagicMock()
         
         # Вызываем метод post
-        handler.post()
+        run(handler.post())
         
         # Проверяем, что был установлен статус 400
         handler.set_status.assert_called_with(400)
@@ -455,13 +737,250 @@ class TestPatientHandler(unittest.TestCase):
         handler.set_status = MagicMock()
         
         # Вызываем метод post
-        handler.post()
+        run(handler.post())
         
         # Проверяем, что был установлен статус 400
         handler.set_status.assert_called_with(400)
         handler.write.assert_called_once_with("All fields required")
 
 
+class TestPatientByMpnHandler(unittest.TestCase):
+    """Тесты поиска пациента по номеру полиса"""
+
+    def setUp(self):
+        self.original_redis = main.r
+        self.mock_redis = make_redis_mock()
+        main.r = self.mock_redis
+
+    def tearDown(self):
+        main.r = self.original_redis
+
+    def make_handler(self):
+        request = Mock()
+        request.method = "GET"
+        request.uri = "/patient/by-mpn/123456"
+        request.headers = {}
+
+        handler = main.PatientByMpnHandler(Application(), request)
+        handler.write = MagicMock()
+        handler.set_status = MagicMock()
+        return handler
+
+    def test_get_by_mpn(self):
+        """Тест: индекс и данные пациента читаются одним скриптом"""
+        self.mock_redis.evalsha.return_value = [b'7', b'surname', b'TestPatient', b'mpn', b'123456']
+
+        handler = self.make_handler()
+        run(handler.get('123456'))
+
+        self.mock_redis.evalsha.assert_awaited_once_with(
+            main.lookup_unique_script.sha, 1, "{patient}:index:mpn", "123456", "patient")
+        handler.write.assert_called_once_with({
+            'patient_ID': 7,
+            'patient': {'surname': 'TestPatient', 'mpn': '123456'},
+        })
+
+    def test_get_by_mpn_not_found(self):
+        """Тест неизвестного номера полиса"""
+        self.mock_redis.evalsha.return_value = None
+
+        handler = self.make_handler()
+        run(handler.get('999'))
+
+        handler.set_status.assert_called_once_with(404)
+        handler.write.assert_called_once_with("No patient with such MPN")
+
+    def test_get_by_mpn_redis_error(self):
+        """Тест ошибки подключения к Redis"""
+        self.mock_redis.evalsha.side_effect = redis.exceptions.ConnectionError("Connection refused")
+
+        handler = self.make_handler()
+        run(handler.get('123456'))
+
+        handler.set_status.assert_called_once_with(400)
+        handler.write.assert_called_once_with("Redis connection refused")
+
+
+class TestPatientBornHandler(unittest.TestCase):
+    """Тесты выборки пациентов по диапазону дат рождения"""
+
+    def setUp(self):
+        self.original_redis = main.r
+        self.mock_redis = make_redis_mock()
+        main.r = self.mock_redis
+
+    def tearDown(self):
+        main.r = self.original_redis
+
+    def make_handler(self, **arguments):
+        request = Mock()
+        request.method = "GET"
+        request.uri = "/patient/born"
+        request.headers = {}
+
+        handler = main.PatientBornHandler(Application(), request)
+        handler.get_argument = lambda name, default=None: arguments.get(name, default)
+        handler.write = MagicMock()
+        handler.set_status = MagicMock()
+        handler.set_header = MagicMock()
+        return handler
+
+    def test_get_born_range(self):
+        """Тест страницы пациентов по индексу дат рождения"""
+        # Скрипт возвращает ID и веса; последний - за верхней границей
+        self.mock_redis.evalsha.return_value = [b'4', b'19500301', b'2', b'19550101', b'9', b'19700101']
+        pipe = self.mock_redis.pipeline.return_value
+        pipe.execute.return_value = [
+            {b'surname': b'Fourth', b'born_date': b'1950-03-01', b'sex': b'F', b'mpn': b'4'},
+            {b'surname': b'Second', b'born_date': b'1955-01-01', b'sex': b'M', b'mpn': b'2'},
+        ]
+
+        handler = self.make_handler(**{'from': '1950-01-01', 'to': '1960-12-31', 'limit': '2'})
+        run(handler.get())
+
+        # Лишний ID запрашивается, чтобы узнать о следующей странице
+        self.mock_redis.evalsha.assert_awaited_once_with(
+            main.zset_page_script.sha, 1, "{patient}:index:born", 19500101, 3, "", "")
+        handler.set_header.assert_not_called()
+        handler.write.assert_called_once_with({'from': '1950-01-01', 'to': '1960-12-31', 'patients': [
+            {'id': 4, 'surname': 'Fourth', 'born_date': '1950-03-01', 'sex': 'F', 'mpn': '4'},
+            {'id': 2, 'surname': 'Second', 'born_date': '1955-01-01', 'sex': 'M', 'mpn': '2'},
+        ]})
+
+    def test_get_born_next_cursor(self):
+        """Тест курсора следующей страницы: вес и ID последнего пациента"""
+        self.mock_redis.evalsha.return_value = [b'4', b'19500301', b'2', b'19550101', b'9', b'19550101']
+        self.mock_redis.pipeline.return_value.execute.return_value = [{}, {}]
+
+        handler = self.make_handler(cursor='19500101:7', limit='2')
+        run(handler.get())
+
+        self.mock_redis.evalsha.assert_awaited_once_with(
+            main.zset_page_script.sha, 1, "{patient}:index:born", "-inf", 3, "19500101", "7")
+        handler.set_header.assert_called_once_with("X-Next-Cursor", "19550101:2")
+
+    def test_get_born_open_range(self):
+        """Тест диапазона без границ и последней страницы"""
+        self.mock_redis.evalsha.return_value = []
+
+        handler = self.make_handler()
+        run(handler.get())
+
+        self.mock_redis.evalsha.assert_awaited_once_with(
+            main.zset_page_script.sha, 1, "{patient}:index:born", "-inf", main.DEFAULT_PAGE_LIMIT + 1, "", "")
+        handler.set_header.assert_not_called()
+        handler.write.assert_called_once_with({'from': None, 'to': None, 'patients': []})
+
+    def test_get_born_invalid_dates(self):
+        """Тест некорректных дат"""
+        for arguments in ({'from': '1950'}, {'to': '1950-13-01'}, {'cursor': '100'}, {'cursor': '1950:x'},
+                          {'limit': '0'}):
+            handler = self.make_handler(**arguments)
+            run(handler.get())
+            handler.set_status.assert_called_once_with(400)
+        self.mock_redis.evalsha.assert_not_called()
+
+    @unittest.skipIf(fakeredis is None, "fakeredis[lua] is not installed")
+    def test_get_born_pages_equal_dates(self):
+        """Тест: страницы с одинаковыми датами рождения идут без пропусков и повторов"""
+        redis_conn = fakeredis.FakeAsyncRedis(server=fakeredis.FakeServer())
+
+        async def fetch(**arguments):
+            handler = self.make_handler(to='1990-12-31', limit='3', **arguments)
+            await handler.get()
+            ids = [patient['id'] for patient in handler.write.call_args[0][0]['patients']]
+            cursor = handler.set_header.call_args[0][1] if handler.set_header.called else None
+            return ids, cursor
+
+        async def scenario():
+            await redis_conn.zadd(main.PATIENT_BORN_KEY, {str(i): 19900101 for i in range(1, 12)})
+            await redis_conn.zadd(main.PATIENT_BORN_KEY, {"12": 19800101, "13": 20000101})
+            ids, cursor = await fetch()
+            pages = [ids]
+            while cursor:
+                ids, cursor = await fetch(cursor=cursor)
+                pages.append(ids)
+            # ID пациента из курсора уже нет в индексе: продолжение по весу и ID
+            await redis_conn.zrem(main.PATIENT_BORN_KEY, "2")
+            after_removed, _ = await fetch(cursor="19900101:2")
+            return pages, after_removed
+
+        with patch.object(main, 'r', redis_conn):
+            pages, after_removed = run(scenario())
+
+        # Элементы с равным весом упорядочены по байтам: "10" < "11" < "2"
+        self.assertEqual(pages, [[12, 1, 10], [11, 2, 3], [4, 5, 6], [7, 8, 9]])
+        self.assertEqual(after_removed, [3, 4, 5])
+
+
+class TestPatientChartHandler(unittest.TestCase):
+    """Тесты для карты пациента"""
+
+    def setUp(self):
+        # Сохраняем оригинальное соединение с Redis
+        self.original_redis = main.r
+
+        # Создаем мок-объект для Redis
+        self.mock_redis = make_redis_mock()
+        main.r = self.mock_redis
+
+    def tearDown(self):
+        # Восстанавливаем оригинальное соединение
+        main.r = self.original_redis
+
+    def make_handler(self):
+        request = Mock()
+        request.method = "GET"
+        request.uri = "/patient/1/chart"
+        request.headers = {}
+
+        handler = main.PatientChartHandler(Application(), request)
+        handler.write = MagicMock()
+        handler.set_status = MagicMock()
+        return handler
+
+    def test_get_chart(self):
+        """Тест получения карты пациента одним pipeline"""
+        pipe = self.mock_redis.pipeline.return_value
+        pipe.execute.return_value = [
+            {b'surname': b'TestPatient', b'sex': b'F'},
+            [(b'3', b'Flu', b'Common flu'), (b'7', b'Cold', None)],
+            [(b'2', b'TestDoctor', b'Surgeon', b'1')],
+        ]
+
+        handler = self.make_handler()
+        run(handler.get('1'))
+
+        handler.write.assert_called_once_with({
+            'patient_ID': 1,
+            'patient': {'surname': 'TestPatient', 'sex': 'F'},
+            'diagnoses': [
+                {'id': 3, 'type': 'Flu', 'information': 'Common flu'},
+                {'id': 7, 'type': 'Cold', 'information': None},
+            ],
+            'doctors': [
+                {'id': 2, 'surname': 'TestDoctor', 'profession': 'Surgeon', 'hospital_ID': '1'},
+            ],
+        })
+
+        # Один round trip по обратным индексам
+        pipe.execute.assert_called_once()
+        pipe.sort.assert_any_call("{patient:1}:diagnoses", groups=True,
+                                  get=["#", "diagnosis:*->type", "diagnosis:*->information"])
+        pipe.sort.assert_any_call("{patient:1}:doctors", groups=True,
+                                  get=["#", "doctor:*->surname", "doctor:*->profession", "doctor:*->hospital_ID"])
+
+    def test_get_chart_no_patient(self):
+        """Тест получения карты несуществующего пациента"""
+        self.mock_redis.pipeline.return_value.execute.return_value = [{}, [], []]
+
+        handler = self.make_handler()
+        run(handler.get('999'))
+
+        handler.set_status.assert_called_with(404)
+        handler.write.assert_called_once_with("No patient with such ID")
+
+
 class TestDiagnosisHandler(unittest.TestCase):
     """Тесты для обработчика диагнозов"""
     
@@ -470,11 +989,11 @@ class TestDiagnosisHandler(unittest.TestCase):
         self.original_redis = main.r
         
         # Создаем мок-объект для Redis
-        self.mock_redis = Mock()
+        self.mock_redis = make_redis_mock()
         main.r = self.mock_redis
         
         # Инициализируем тестовую базу данных
-        main.init_db()
+        run(main.init_db())
         
     def tearDown(self):
         # Восстанавливаем оригинальное соединение
@@ -483,10 +1002,10 @@ class TestDiagnosisHandler(unittest.TestCase):
     def test_create_diagnosis_success(self):
         """Тест успешного создания диагноза"""
         # Настраиваем мок для возврата ID и существующего пациента
-        self.mock_redis.get.return_value = b'0'
-        self.mock_redis.incr.return_value = 1
-        self.mock_redis.hset.side_effect = [1, 1, 1]  # patient_ID, type, information
-        self.mock_redis.hgetall.return_value = {b'surname': b'TestPatient'}  # Существующий пациент
+        # ID и больницы врачей пациента (FANOUT_REFS_LUA) одним pipeline,
+        # затем ID и фамилия пациента из скрипта создания
+        self.mock_redis.pipeline.return_value.execute.return_value = [1, [b'1']]
+        self.mock_redis.evalsha.return_value = [0, 3, b'TestPatient']
         
         # Создаем мок-запрос
         request = Mock()
@@ -510,7 +1029,7 @@ class TestDiagnosisHandler(unittest.TestCase):
         handler.set_status = MagicMock()
         
         # Вызываем метод post
-        handler.post()
+        run(handler.post())
         
         # Проверяем, что write был вызван с правильным сообщением
         handler.write.assert_called_once()
@@ -518,15 +1037,29 @@ class TestDiagnosisHandler(unittest.TestCase):
         self.assertIn('OK: ID 0 for patient TestPatient', args[0])
         
         # Проверяем, что были вызваны методы Redis
-        self.mock_redis.get.assert_called_with("diagnosis:autoID")
-        self.assertEqual(self.mock_redis.hset.call_count, 3)  # patient_ID, type, information
-        self.mock_redis.incr.assert_called_with("diagnosis:autoID")
+        args, kwargs = self.mock_redis.evalsha.call_args
+        self.assertEqual(args[1:5], (11, "diagnosis:0", "{patient}:ids", "patient:0"))
+        self.assertEqual(args[13:16], (0, "0", "surname"))
+        self.mock_redis.hgetall.assert_not_called()
+
+        # Обратный индекс диагнозов пациента и частота типов (всего и по
+        # больницам врачей пациента, прочитанным до создания) обновляются
+        # тем же скриптом; больницы сохраняются в хеше атрибуции
+        self.assertEqual(args[9:13], ("{patient:0}:diagnoses", "{diagnosis}:analytics:types",
+                                      "{diagnosis}:analytics:hospital-types:1", "{diagnosis}:index:hospitals"))
+        self.assertEqual(args[-15:], (
+            2, "SADD", "0",
+            3, "ZINCRBY", 1, "flu",
+            3, "ZINCRBY", 1, "flu",
+            3, "HSET", "0", "1"))
+        args, kwargs = self.mock_redis.pipeline.return_value.evalsha.call_args
+        self.assertEqual(args[1:], (2, "{patient:0}:doctors", "{doctor}:index:hospital"))
         
     def test_create_diagnosis_with_invalid_patient(self):
         """Тест создания диагноза для несуществующего пациента"""
         # Настраиваем мок для возврата ID и пустого пациента
-        self.mock_redis.get.return_value = b'0'
-        self.mock_redis.hgetall.return_value = {}  # Пустой результат для несуществующего пациента
+        self.mock_redis.pipeline.return_value.execute.return_value = [1, []]
+        self.mock_redis.evalsha.return_value = None  # Скрипт не нашел пациента
         
         # Создаем мок-запрос
         request = Mock()
@@ -550,7 +1083,7 @@ class TestDiagnosisHandler(unittest.TestCase):
         handler.set_status = MagicMock()
         
         # Вызываем метод post
-        handler.post()
+        run(handler.post())
         
         # Проверяем, что был установлен статус 400
         handler.set_status.assert_called_with(400)
@@ -580,7 +1113,7 @@ class TestDiagnosisHandler(unittest.TestCase):
         handler.set_status = MagicMock()
         
         # Вызываем метод post
-        handler.post()
+        run(handler.post())
         
         # Проверяем, что был установлен статус 400
         handler.set_status.assert_called_with(400)
@@ -595,11 +1128,11 @@ class TestDoctorPatientHandler(unittest.TestCase):
         self.original_redis = main.r
         
         # Создаем мок-объект для Redis
-        self.mock_redis = Mock()
+        self.mock_redis = make_redis_mock()
         main.r = self.mock_redis
         
         # Инициализируем тестовую базу данных
-        main.init_db()
+        run(main.init_db())
         
     def tearDown(self):
         # Восстанавливаем оригинальное соединение
@@ -608,10 +1141,7 @@ class TestDoctorPatientHandler(unittest.TestCase):
     def test_create_doctor_patient_success(self):
         """Тест успешного создания связи врач-пациент"""
         # Настраиваем мок для возврата существующих врачей и пациентов
-        self.mock_redis.hgetall.side_effect = [
-            {b'surname': b'TestPatient'},  # Первый вызов - пациент
-            {b'surname': b'TestDoctor'}    # Второй вызов - врач
-        ]
+        self.mock_redis.evalsha.return_value = 1  # Связь добавлена
         
         # Создаем мок-запрос
         request = Mock()
@@ -634,21 +1164,29 @@ class TestDoctorPatientHandler(unittest.TestCase):
         handler.set_status = MagicMock()
         
         # Вызываем метод post
-        handler.post()
+        run(handler.post())
         
         # Проверяем, что write был вызван с правильным сообщением
         handler.write.assert_called_once_with("OK: doctor ID: 0, patient ID: 0")
         
         # Проверяем, что были вызваны методы Redis
-        self.mock_redis.sadd.assert_called_once_with("doctor-patient:0", "0")
+        self.mock_redis.evalsha.assert_called_once_with(
+            main.link_doctor_patient_script.sha, 8,
+            "{doctor}:ids", "{patient}:ids", "{patient:0}:doctors", "doctor-patient:0",
+            "{doctor-patient}:cache:version", "{doctor-patient}:analytics:count",
+            "{doctor-patient}:ids", "{patient:0}:doctors",
+            "0", "0",
+            # Счетчики и индекс пациента обновляются только для новой связи
+            2, "INCRBY", 1,
+            2, "INCRBY", 1,
+            3, "ZADD", "0", "0",
+            2, "SADD", "0")
+        self.mock_redis.sadd.assert_not_called()
         
     def test_create_doctor_patient_with_invalid_doctor(self):
         """Тест создания связи с несуществующим врачом"""
         # Настраиваем мок для возврата существующего пациента и пустого врача
-        self.mock_redis.hgetall.side_effect = [
-            {b'surname': b'TestPatient'},  # Первый вызов - пациент
-            {}                           # Второй вызов - пустой (несуществующий) врач
-        ]
+        self.mock_redis.evalsha.return_value = None  # Скрипт не нашел врача
         
         # Создаем мок-запрос
         request = Mock()
@@ -671,7 +1209,7 @@ class TestDoctorPatientHandler(unittest.TestCase):
         handler.set_status = MagicMock()
         
         # Вызываем метод post
-        handler.post()
+        run(handler.post())
         
         # Проверяем, что был установлен статус 400
         handler.set_status.assert_called_with(400)
@@ -680,10 +1218,7 @@ class TestDoctorPatientHandler(unittest.TestCase):
     def test_create_doctor_patient_with_invalid_patient(self):
         """Тест создания связи с несуществующим пациентом"""
         # Настраиваем мок для возврата пустого пациента и существующего врача
-        self.mock_redis.hgetall.side_effect = [
-            {},                           # Первый вызов - пустой (несуществующий) пациент
-            {b'surname': b'TestDoctor'}   # Второй вызов - врач
-        ]
+        self.mock_redis.evalsha.return_value = None  # Скрипт не нашел пациента
         
         # Создаем мок-запрос
         request = Mock()
@@ -706,7 +1241,7 @@ class TestDoctorPatientHandler(unittest.TestCase):
         handler.set_status = MagicMock()
         
         # Вызываем метод post
-        handler.post()
+        run(handler.post())
         
         # Проверяем, что был установлен статус 400
         handler.set_status.assert_called_with(400)
@@ -735,7 +1270,7 @@ class TestDoctorPatientHandler(unittest.TestCase):
         handler.set_status = MagicMock()
         
         # Вызываем метод post
-        handler.post()
+        run(handler.post())
         
         # Проверяем, что был установлен статус 400
         handler.set_status.assert_called_with(400)
@@ -750,11 +1285,11 @@ class TestRedisConnectionErrors(unittest.TestCase):
         self.original_redis = main.r
         
         # Создаем мок-объект для Redis
-        self.mock_redis = Mock()
+        self.mock_redis = make_redis_mock()
         main.r = self.mock_redis
         
         # Инициализируем тестовую базу данных
-        main.init_db()
+        run(main.init_db())
         
     def tearDown(self):
         # Восстанавливаем оригинальное соединение
@@ -763,13 +1298,14 @@ class TestRedisConnectionErrors(unittest.TestCase):
     def test_hospital_get_redis_error(self):
         """Тест ошибки подключения к Redis при получении списка больниц"""
         # Настраиваем мок для выбрасывания исключения
-        self.mock_redis.get.side_effect = redis.exceptions.ConnectionError()
+        self.mock_redis.zrangebyscore.side_effect = redis.exceptions.ConnectionError()
         
         # Создаем мок-запрос
         request = Mock()
         request.method = "GET"
         request.uri = "/hospital"
         request.headers = {}
+        request.arguments = {}
         
         # Создаем обработчик
         app = Application()
@@ -780,7 +1316,7 @@ class TestRedisConnectionErrors(unittest.TestCase):
         handler.set_status = MagicMock()
         
         # Вызываем метод get
-        handler.get()
+        run(handler.get())
         
         # Проверяем, что был установлен статус 400
         handler.set_status.assert_called_with(400)
@@ -788,10 +1324,9 @@ class TestRedisConnectionErrors(unittest.TestCase):
     
     def test_hospital_post_redis_error(self):
         """Тест ошибки подключения к Redis при создании больницы"""
-        # Настраиваем мок для возврата ID, но выбрасывания исключения при hset
-        self.mock_redis.get.return_value = b'0'
-        self.mock_redis.incr.return_value = 1
-        self.mock_redis.hset.side_effect = redis.exceptions.ConnectionError()
+        # Настраиваем мок для выбрасывания исключения при вызове скрипта
+        self.mock_redis.pipeline.return_value.execute.return_value = [1]  # Выделен ID 0
+        self.mock_redis.evalsha.side_effect = redis.exceptions.ConnectionError()
         
         # Создаем мок-запрос
         request = Mock()
@@ -816,200 +1351,2263 @@ class TestRedisConnectionErrors(unittest.TestCase):
         handler.set_status = MagicMock()
         
         # Вызываем метод post
-        handler.post()
+        run(handler.post())
         
         # Проверяем, что был установлен статус 400
         handler.set_status.assert_called_with(400)
         handler.write.assert_called_once_with("Redis connection refused")
 
+    def test_hospital_post_redis_timeout(self):
+        """Тест: таймаут Redis при создании больницы обрабатывается как ошибка подключения"""
+        self.mock_redis.pipeline.return_value.execute.return_value = [1]  # Выделен ID 0
+        self.mock_redis.evalsha.side_effect = redis.exceptions.TimeoutError()
 
-class TestMainHandler(unittest.TestCase):
-    """Тесты для главной страницы"""
+        request = Mock()
+        request.method = "POST"
+        request.uri = "/hospital"
+        request.headers = {}
+
+        handler = main.HospitalHandler(Application(), request)
+        handler.get_argument = lambda arg: {
+            'name': 'TestHospital',
+            'address': 'TestAddress',
+            'phone': '123456789',
+            'beds_number': '50'
+        }[arg]
+        handler.write = MagicMock()
+        handler.set_status = MagicMock()
+
+        run(handler.post())
+
+        # Скрипт создания после таймаута не повторяется
+        self.assertEqual(self.mock_redis.evalsha.await_count, 1)
+        handler.set_status.assert_called_with(400)
+        handler.write.assert_called_once_with("Redis connection refused")
+
+
+class TestInitDb(unittest.TestCase):
+    """Тесты инициализации базы данных"""
 
     def setUp(self):
         # Сохраняем оригинальное соединение с Redis
         self.original_redis = main.r
 
         # Создаем мок-объект для Redis
-        self.mock_redis = Mock()
+        self.mock_redis = make_redis_mock()
         main.r = self.mock_redis
 
-        # Инициализируем тестовую базу данных
-        main.init_db()
+        migrate_meta_keys = patch.object(main, 'migrate_meta_keys', new=AsyncMock())
+        self.migrate_meta_keys = migrate_meta_keys.start()
+        self.addCleanup(migrate_meta_keys.stop)
 
     def tearDown(self):
         # Восстанавливаем оригинальное соединение
         main.r = self.original_redis
 
-    def test_get_main_page(self):
-        """Тест получения главной страницы"""
-        # Создаем мок-запрос
-        request = Mock()
-        request.method = "GET"
-        request.uri = "/"
-        request.headers = {}
+    def test_init_db_rebuilds_indexes_once(self):
+        """Тест однократного пересчета счетчиков и индексов"""
+        self.mock_redis.get.side_effect = lambda key: b'1' if key == main.DB_INITIATED_KEY else None
 
-        # Создаем обработчик
-        app = Application()
-        handler = main.MainHandler(app, request)
+        with patch.object(main, 'rebuild_indexes', new=AsyncMock()) as rebuild:
+            run(main.init_db())
+            rebuild.assert_awaited_once()
 
-        # Мокаем методы для избежания HTTP-ответа
-        handler.write = MagicMock()
-        handler.render = MagicMock()
+    def test_init_db_migrates_legacy_layout(self):
+        """Тест переноса на месте базы в раскладке ключей без хеш-тегов"""
+        self.mock_redis.get.side_effect = lambda key: b'1' if key == "db_initiated" else None
 
-        # Вызываем метод get
-        handler.get()
+        with patch.object(main, 'migrate_layout', new=AsyncMock()) as migrate, \
+                patch.object(main, 'rebuild_indexes', new=AsyncMock()):
+            run(main.init_db())
+            migrate.assert_awaited_once_with()
+        # Счетчики ID переносятся, а не создаются заново
+        self.mock_redis.set.assert_not_called()
 
-        # Проверяем, что render был вызван
-        handler.render.assert_called_once_with('templates/index.html')
+    def test_init_db_rebuilds_outdated_indexes(self):
+        """Тест пересчета индексов устаревшей версии"""
+        self.mock_redis.get.side_effect = lambda key: b'1'
 
+        with patch.object(main, 'rebuild_indexes', new=AsyncMock()) as rebuild:
+            run(main.init_db())
+            rebuild.assert_awaited_once()
+        # Ключи раскладки с общим тегом '{meta}' переносятся до пересчета
+        self.migrate_meta_keys.assert_awaited_once_with()
+
+    def test_init_db_skips_rebuild(self):
+        """Тест пропуска пересчета, если индексы текущей версии"""
+        self.mock_redis.get.return_value = str(main.INDEX_VERSION).encode()
+
+        with patch.object(main, 'rebuild_indexes', new=AsyncMock()) as rebuild:
+            run(main.init_db())
+            rebuild.assert_not_awaited()
+        self.migrate_meta_keys.assert_not_awaited()
 
-class TestAnalyticsHandler(unittest.TestCase):
-    """Тесты для обработчика аналитики"""
+
+class TestExportHandler(unittest.TestCase):
+    """Тесты для потоковой выгрузки"""
 
     def setUp(self):
         # Сохраняем оригинальное соединение с Redis
         self.original_redis = main.r
 
         # Создаем мок-объект для Redis
-        self.mock_redis = Mock()
+        self.mock_redis = make_redis_mock()
         main.r = self.mock_redis
 
-        # Инициализируем тестовую базу данных
-        main.init_db()
-
     def tearDown(self):
         # Восстанавливаем оригинальное соединение
         main.r = self.original_redis
 
-    def test_get_analytics_success(self):
-        """Тест успешного получения аналитики"""
-        # Настраиваем мок для возврата значений
-        def get_side_effect(key):
-            if key == "hospital:autoID":
-                return b'1'
-            elif key == "doctor:autoID":
-                return b'1'
-            elif key == "patient:autoID":
-                return b'1'
-            elif key == "diagnosis:autoID":
-                return b'1'
-            else:
-                return None
-
-        self.mock_redis.get.side_effect = get_side_effect
-        self.mock_redis.hgetall.return_value = {}
-        self.mock_redis.smembers.return_value = set()
-
-        # Создаем мок-запрос
+    def make_handler(self, arguments):
         request = Mock()
         request.method = "GET"
-        request.uri = "/analytics"
+        request.uri = "/export/patient"
         request.headers = {}
+        request.arguments = arguments
 
-        # Создаем обработчик
-        app = Application()
-        handler = main.AnalyticsHandler(app, request)
-
-        # Мокаем методы для проверки результата
+        handler = main.ExportHandler(Application(), request)
         handler.write = MagicMock()
         handler.set_status = MagicMock()
-        handler.set_header = MagicMock()
+        handler.flush = AsyncMock()
+        return handler
 
-        # Вызываем метод get
-        handler.get()
+    def written(self, handler):
+        return ''.join(call[0][0] for call in handler.write.call_args_list)
 
-        # Проверяем, что write был вызван (возвращен JSON)
-        handler.write.assert_called_once()
-        # Проверяем, что заголовок Content-Type установлен
-        handler.set_header.assert_called_with("Content-Type", "application/json")
+    def test_export_ndjson_streams_batches(self):
+        """Тест выгрузки NDJSON с отправкой клиенту по пакетам"""
+        # Существующие ID 1, 2 и 5: ID следующего пакета читаются
+        # в том же pipeline, что и записи текущего
+        self.mock_redis.zrangebyscore.return_value = [b'1', b'2']
+        self.mock_redis.pipeline.return_value.execute.side_effect = [
+            [{b'surname': b'First', b'born_date': b'1990-01-01', b'sex': b'M', b'mpn': b'1'},
+             {b'surname': b'Second', b'born_date': b'1991-01-01', b'sex': b'F', b'mpn': b'2'},
+             [b'5']],
+            [{b'surname': b'Fifth', b'born_date': b'1992-01-01', b'sex': b'F', b'mpn': b'3'}],
+        ]
 
-    def test_get_analytics_with_data(self):
-        """Тест получения аналитики с данными"""
-        # Настраиваем мок для возврата значений с данными
-        def get_side_effect(key):
-            if key == "hospital:autoID":
-                return b'2'
-            elif key == "doctor:autoID":
-                return b'2'
-            elif key == "patient:autoID":
-                return b'2'
-            elif key == "diagnosis:autoID":
-                return b'2'
-            else:
-                return None
-
-        self.mock_redis.get.side_effect = get_side_effect
-
-        # Возвращаем разные данные в зависимости от ключа
-        def hgetall_side_effect(key):
-            if key == "hospital:0":
-                return {b'name': b'TestHospital', b'address': b'TestAddress'}
-            elif key == "hospital:1":
-                return {}
-            elif key == "doctor:0":
-                return {b'surname': b'TestDoctor', b'profession': b'Surgeon', b'hospital_ID': b'0'}
-            elif key == "doctor:1":
-                return {}
-            elif key == "patient:0":
-                return {b'surname': b'TestPatient', b'born_date': b'1990-01-01', b'sex': b'M', b'mpn': b'123456'}
-            elif key == "patient:1":
-                return {}
-            else:
-                return {}
-
-        self.mock_redis.hgetall.side_effect = hgetall_side_effect
-        self.mock_redis.smembers.return_value = {'0'}
+        handler = self.make_handler({})
+        with patch.object(main, 'PIPELINE_BATCH_SIZE', 2):
+            run(handler.get('patient'))
 
-        # Создаем мок-запрос
+        lines = self.written(handler).splitlines()
+        self.assertEqual(len(lines), 3)
+        self.assertEqual(json.loads(lines[0]), {
+            'id': 1, 'surname': 'First', 'born_date': '1990-01-01', 'sex': 'M', 'mpn': '1'
+        })
+        self.assertEqual(json.loads(lines[2])['id'], 5)
+        self.assertEqual(handler._headers['Content-Type'], 'application/x-ndjson')
+        pipe = self.mock_redis.pipeline.return_value
+        pipe.zrangebyscore.assert_called_once_with("{patient}:ids", "(2", "+inf", start=0, num=2)
+        self.assertEqual(pipe.hgetall.call_count, 3)
+
+        # Данные отправляются клиенту по мере чтения
+        handler.flush.assert_awaited()
+
+    def test_export_csv(self):
+        """Тест выгрузки CSV"""
+        self.mock_redis.zrangebyscore.return_value = [b'1']
+        self.mock_redis.pipeline.return_value.execute.return_value = [
+            {b'name': b'TestHospital', b'address': b'TestAddress', b'phone': b'1', b'beds_number': b'50'}
+        ]
+
+        handler = self.make_handler({'format': [b'csv']})
+        run(handler.get('hospital'))
+
+        self.assertEqual(self.written(handler).splitlines(), [
+            'id,name,address,phone,beds_number',
+            '1,TestHospital,TestAddress,1,50',
+        ])
+        self.assertEqual(handler._headers['Content-Type'], 'text/csv; charset=utf-8')
+
+    def test_export_redis_error_after_flush_aborts_connection(self):
+        """Тест: ошибка Redis после отправки части данных обрывает соединение"""
+        self.mock_redis.zrangebyscore.return_value = [b'1', b'2']
+        self.mock_redis.pipeline.return_value.execute.side_effect = [
+            [{b'surname': b'First'}, {b'surname': b'Second'}, [b'5']],
+            redis.exceptions.TimeoutError(),
+        ]
+
+        handler = self.make_handler({})
+        with patch.object(main, 'PIPELINE_BATCH_SIZE', 2):
+            run(handler.get('patient'))
+
+        handler.flush.assert_awaited()
+        handler.request.connection.close.assert_called_once_with()
+        handler.set_status.assert_not_called()
+
+    def test_export_redis_error_before_flush(self):
+        """Тест: ошибка Redis до отправки данных - статус 400"""
+        self.mock_redis.zrangebyscore.side_effect = redis.exceptions.ConnectionError()
+
+        handler = self.make_handler({})
+        run(handler.get('patient'))
+
+        handler.set_status.assert_called_with(400)
+        handler.write.assert_called_once_with("Redis connection refused")
+        handler.request.connection.close.assert_not_called()
+
+    def test_export_invalid_format(self):
+        """Тест выгрузки в неподдерживаемом формате"""
+        handler = self.make_handler({'format': [b'xml']})
+        run(handler.get('patient'))
+
+        handler.set_status.assert_called_with(400)
+        handler.write.assert_called_once_with("Format must be 'ndjson' or 'csv'")
+
+
+class TestImportHandler(unittest.TestCase):
+    """Тесты для потокового массового импорта"""
+
+    def setUp(self):
+        # Сохраняем оригинальное соединение с Redis
+        self.original_redis = main.r
+
+        # Создаем мок-объект для Redis
+        self.mock_redis = make_redis_mock()
+        main.r = self.mock_redis
+
+    def tearDown(self):
+        # Восстанавливаем оригинальное соединение
+        main.r = self.original_redis
+
+    def make_handler(self, model):
         request = Mock()
-        request.method = "GET"
-        request.uri = "/analytics"
+        request.method = "POST"
+        request.uri = f"/import/{model}"
         request.headers = {}
 
-        # Создаем обработчик
-        app = Application()
-        handler = main.AnalyticsHandler(app, request)
+        handler = main.ImportHandler(Application(), request)
+        handler.path_args = [model]
+        handler.write = MagicMock()
+        handler.set_status = MagicMock()
+        return handler
 
-        # Мокаем методы для проверки результата
+    def import_body(self, model, chunks):
+        handler = self.make_handler(model)
+        run(handler.prepare())
+        for chunk in chunks:
+            run(handler.data_received(chunk))
+        run(handler.post(model))
+        return handler
+
+    def test_import_pipelined_batches(self):
+        """Тест импорта пакетами с разбивкой строк между частями тела"""
+        pipe = self.mock_redis.pipeline.return_value
+        # Каждый пакет - pipeline выделения ID (INCRBY) и pipeline скриптов создания
+        pipe.execute.side_effect = [[2], [[0, 4, ""], [1, 4, ""]], [3], [[2, 4, ""]]]
+
+        rows = [json.dumps({'name': f'H{i}', 'address': 'A', 'phone': '1', 'beds_number': 10}) for i in range(3)]
+        body = ("\n".join(rows) + "\n").encode()
+        with patch.object(main, 'PIPELINE_BATCH_SIZE', 2):
+            handler = self.import_body('hospital', [body[:10], body[10:]])
+
+        report = handler.write.call_args[0][0]
+        self.assertEqual(report['rows'], 3)
+        self.assertEqual(report['created'], 3)
+        self.assertEqual(report['errors'], [])
+        self.assertEqual(report['last_committed_line'], 3)
+        self.assertEqual(pipe.execute.await_count, 4)
+        self.assertEqual(pipe.incrby.call_args_list, [call("{hospital}:autoID", 2), call("{hospital}:autoID", 1)])
+
+        # Строки записываются тем же скриптом и с теми же аргументами, что и форма
+        args = pipe.evalsha.call_args_list[0][0]
+        self.assertEqual(args[:3], (main.create_entity_script.sha, 5, "hospital:0"))
+        self.assertEqual(args[7:12], (0, "", "", 4, "name"))
+        self.assertEqual(args[-4:], (3, "HSET", "0", "H0"))
+        self.assertEqual(pipe.evalsha.call_args_list[2][0][2], "hospital:2")
+        self.mock_redis.script_load.assert_any_await(main.CREATE_ENTITY_LUA)
+
+    def test_import_reports_row_errors(self):
+        """Тест отчета об ошибках по номерам строк"""
+        self.mock_redis.pipeline.return_value.execute.side_effect = [
+            [2], [None, redis.exceptions.ResponseError("NOSCRIPT")]
+        ]
+
+        body = b'{"surname": "S", "profession": "P", "hospital_ID": "9"}\n' \
+               b'not json\n' \
+               b'{"surname": "S"}\n' \
+               b'\n' \
+               b'{"surname": "S", "profession": "P"}'
+        handler = self.import_body('doctor', [body])
+
+        report = handler.write.call_args[0][0]
+        self.assertEqual(report['rows'], 4)
+        self.assertEqual(report['created'], 0)
+        self.assertEqual(report['failed'], 4)
+        self.assertEqual(report['errors'], [
+            {'line': 2, 'error': 'Invalid JSON'},
+            {'line': 3, 'error': 'Surname and profession required'},
+            {'line': 1, 'error': 'No hospital with such ID'},
+            {'line': 5, 'error': 'NOSCRIPT'},
+        ])
+
+    def test_import_patient_validation(self):
+        """Тест проверки пациента при импорте теми же правилами, что и форма"""
+        body = b'{"surname": "S", "born_date": "2000-01-01", "sex": "X", "mpn": "1"}'
+        handler = self.import_body('patient', [body])
+
+        report = handler.write.call_args[0][0]
+        self.assertEqual(report['errors'], [{'line': 1, 'error': "Sex must be 'M' or 'F'"}])
+        self.mock_redis.pipeline.assert_not_called()
+
+    def test_import_connection_error(self):
+        """Тест обработки ошибки подключения к Redis при импорте"""
+        self.mock_redis.script_load.side_effect = redis.exceptions.ConnectionError("Connection refused")
+
+        handler = self.import_body('hospital', [b'{"name": "H", "address": "A"}'])
+
+        handler.set_status.assert_called_with(400)
+        report = handler.write.call_args[0][0]
+        self.assertEqual(report['error'], "Redis connection refused")
+        self.assertEqual(report['created'], 0)
+        self.assertEqual(report['last_committed_line'], 0)
+
+    def test_import_connection_error_mid_stream(self):
+        """Тест: при сбое Redis посреди импорта возвращается отчет о строках до сбоя"""
+        pipe = self.mock_redis.pipeline.return_value
+        pipe.execute.side_effect = [[2], [[0, 4, ""], [1, 4, ""]], [4], redis.exceptions.TimeoutError()]
+
+        rows = [json.dumps({'name': f'H{i}', 'address': 'A', 'phone': '1', 'beds_number': 10}) for i in range(6)]
+        rows.insert(1, 'not json')
+        body = ("\n".join(rows) + "\n").encode()
+        with patch.object(main, 'PIPELINE_BATCH_SIZE', 2):
+            handler = self.import_body('hospital', [body])
+
+        handler.set_status.assert_called_with(400)
+        report = handler.write.call_args[0][0]
+        self.assertEqual(report['error'], "Redis connection refused")
+        self.assertEqual(report['created'], 2)
+        self.assertEqual(report['failed'], 1)
+        self.assertEqual(report['errors'], [{'line': 2, 'error': 'Invalid JSON'}])
+        # Первый пакет - строки 1-3; второй (строки 4-5) не записан, остальные не читались
+        self.assertEqual(report['last_committed_line'], 3)
+        self.assertEqual(pipe.execute.await_count, 4)
+
+
+class TestMakeApp(unittest.TestCase):
+    """Тесты настроек приложения для режимов запуска"""
+
+    def test_development_settings(self):
+        """Тест режима разработки: autoreload и отладка включены"""
+        with patch('tornado.autoreload.start'):
+            app = main.make_app()
+
+        self.assertTrue(app.settings['autoreload'])
+        self.assertTrue(app.settings['debug'])
+        self.assertFalse(app.settings['compiled_template_cache'])
+
+    def test_production_settings(self):
+        """Тест production-режима: кэш шаблонов, без autoreload и отладки"""
+        app = main.make_app(production=True)
+
+        self.assertFalse(app.settings['autoreload'])
+        self.assertFalse(app.settings['debug'])
+        self.assertFalse(app.settings['serve_traceback'])
+        self.assertTrue(app.settings['compiled_template_cache'])
+
+
+class TestResponseCache(unittest.TestCase):
+    """Тесты кэша страниц списков и ETag"""
+
+    def setUp(self):
+        # Сохраняем оригинальное соединение с Redis
+        self.original_redis = main.r
+
+        # Создаем мок-объект для Redis
+        self.mock_redis = make_redis_mock()
+        main.r = self.mock_redis
+        self.mock_redis.zrangebyscore.return_value = [b'1']
+        self.mock_redis.pipeline.return_value.execute.return_value = [{b'name': b'H1'}]
+
+    def tearDown(self):
+        # Восстанавливаем оригинальное соединение
+        main.r = self.original_redis
+
+    def get_page(self, handler_class=main.HospitalHandler, headers=None):
+        request = Mock()
+        request.method = "GET"
+        request.uri = "/hospital"
+        request.headers = headers or {}
+        request.arguments = {}
+
+        handler = handler_class(Application(), request)
         handler.write = MagicMock()
         handler.set_status = MagicMock()
-        handler.set_header = MagicMock()
+        handler.render_string = MagicMock(return_value=b"<table></table>")
+        run(handler.get())
+        return handler
+
+    def test_cached_page_served_without_scan(self):
+        """Тест повторного запроса: страница отдается из кэша"""
+        self.mock_redis.get.return_value = b'3'
+
+        first = self.get_page()
+        second = self.get_page()
+
+        first.write.assert_called_once_with(b"<table></table>")
+        second.write.assert_called_once_with(b"<table></table>")
+        second.render_string.assert_not_called()
+        self.mock_redis.pipeline.return_value.execute.assert_called_once()
+        self.mock_redis.get.assert_called_with("{hospital}:cache:version")
+        self.assertEqual(second._headers['Etag'], '"hospital.3-0-100"')
+
+    def test_write_invalidates_page(self):
+        """Тест сброса кэша при изменении версии модели"""
+        self.mock_redis.get.return_value = b'3'
+        self.get_page()
+
+        self.mock_redis.get.return_value = b'4'
+        handler = self.get_page()
+
+        handler.render_string.assert_called_once()
+        self.assertEqual(self.mock_redis.pipeline.return_value.execute.call_count, 2)
+
+    def test_not_modified(self):
+        """Тест ответа 304 при совпадении If-None-Match"""
+        self.mock_redis.get.return_value = b'3'
+
+        handler = self.get_page(headers={'If-None-Match': '"hospital.3-0-100"'})
+
+        handler.set_status.assert_called_with(304)
+        handler.write.assert_not_called()
+        self.mock_redis.pipeline.assert_not_called()
+
+    def test_doctor_patient_depends_on_links_only(self):
+        """Тест версий страницы связей: только версия связей"""
+        self.mock_redis.get.return_value = b'2'
+        self.mock_redis.pipeline.return_value.execute.return_value = [{b'1'}]
+
+        handler = self.get_page(main.DoctorPatientHandler)
+
+        self.mock_redis.zrangebyscore.assert_called_with("{doctor-patient}:ids", 0, "+inf", start=0, num=101)
+        self.mock_redis.get.assert_called_with("{doctor-patient}:cache:version")
+        self.assertEqual(handler._headers['Etag'], '"doctor-patient.2-0-100"')
+
+
+class TestLRUCache(unittest.TestCase):
+    """Тесты кэша процесса"""
+
+    def test_evicts_least_recently_used(self):
+        """Тест вытеснения давно не использованной записи"""
+        cache = main.LRUCache(2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)
+
+        self.assertEqual(cache.get("a"), 1)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("c"), 3)
+
+    def test_ttl_expiry(self):
+        """Тест устаревания записей по времени жизни"""
+        cache = main.LRUCache(10, ttl=60)
+        with patch.object(main.time, 'monotonic', return_value=100.0):
+            cache.set("a", 1)
+        with patch.object(main.time, 'monotonic', return_value=150.0):
+            self.assertEqual(cache.get("a"), 1)
+        with patch.object(main.time, 'monotonic', return_value=161.0):
+            self.assertIsNone(cache.get("a"))
+
+
+class TestMetrics(unittest.TestCase):
+    """Тесты метрик процесса и эндпоинта /metrics"""
+
+    def setUp(self):
+        # Сохраняем оригинальное соединение с Redis и метрики
+        self.original_redis = main.r
+        self.original_metrics = main.metrics
+
+        # Создаем мок-объект для Redis и пустые метрики
+        self.mock_redis = make_redis_mock()
+        main.r = self.mock_redis
+        main.metrics = main.Metrics()
+
+    def tearDown(self):
+        # Восстанавливаем оригинальное соединение и метрики
+        main.r = self.original_redis
+        main.metrics = self.original_metrics
+
+    def make_handler(self, handler_class, method="GET"):
+        request = Mock()
+        request.method = method
+        request.uri = "/"
+        request.headers = {}
+        request.arguments = {}
+        request.request_time.return_value = 0.02
+
+        handler = handler_class(Application(), request)
+        handler.write = MagicMock()
+        return handler
+
+    def test_request_metrics(self):
+        """Тест учета запросов по обработчику, методу и статусу"""
+        handler = self.make_handler(main.AnalyticsHandler)
+        handler.set_status(500)
+        handler.on_finish()
+
+        text = main.metrics.render()
+        self.assertIn('http_requests_total{handler="AnalyticsHandler",method="GET",status="500"} 1', text)
+        self.assertIn('http_request_duration_seconds_bucket{handler="AnalyticsHandler",method="GET",le="0.01"} 0', text)
+        self.assertIn('http_request_duration_seconds_bucket{handler="AnalyticsHandler",method="GET",le="0.025"} 1', text)
+        self.assertIn('http_request_duration_seconds_bucket{handler="AnalyticsHandler",method="GET",le="+Inf"} 1', text)
+        self.assertIn('http_request_duration_seconds_count{handler="AnalyticsHandler",method="GET"} 1', text)
+
+    def test_redis_metrics(self):
+        """Тест учета команд Redis, включая команды pipeline"""
+        handler = self.make_handler(main.HospitalDoctorsHandler)
+        self.mock_redis.pipeline.return_value.execute.side_effect = [[b'H', {b'1'}], [{b'surname': b'S'}]]
+
+        run(handler.get('1'))
+
+        self.assertEqual(main.metrics.redis_commands, {'HGET': 1, 'SMEMBERS': 1, 'HGETALL': 1})
+        self.assertEqual(main.metrics.redis_durations['PIPELINE'].count, 2)
+
+    def test_metrics_endpoint(self):
+        """Тест вывода метрик в текстовом формате"""
+        main.metrics.observe_redis("GET", ["GET"], 0.001)
+        handler = self.make_handler(main.MetricsHandler)
 
-        # Вызываем метод get
         handler.get()
 
-        # Проверяем, что write был вызван
-        handler.write.assert_called_once()
-        # Проверяем, что заголовок Content-Type установлен
-        handler.set_header.assert_called_with("Content-Type", "application/json")
+        self.assertTrue(handler._headers['Content-Type'].startswith('text/plain; version=0.0.4'))
+        text = handler.write.call_args[0][0]
+        self.assertIn('# TYPE redis_commands_total counter', text)
+        self.assertIn('redis_commands_total{command="GET"} 1', text)
+        self.assertIn('redis_roundtrip_duration_seconds_count{command="GET"} 1', text)
 
-    def test_get_analytics_redis_error(self):
-        """Тест ошибки Redis при получении аналитики"""
-        # Настраиваем мок для выбрасывания исключения
-        self.mock_redis.get.side_effect = Exception("Redis connection failed")
+    def test_metrics_of_all_workers(self):
+        """Тест: /metrics любого рабочего процесса отдает метрики всех процессов с меткой worker"""
+        with tempfile.TemporaryDirectory() as directory:
+            first, second = main.Metrics(), main.Metrics()
+            first.start_worker(directory, 0)
+            second.start_worker(directory, 1)
+            second.observe_request("PatientHandler", "POST", 200, 0.004)
+            second.observe_redis("PIPELINE", ["HGET", "HGET"], 0.001)
+            second.save_snapshot()
+            # Свои метрики - текущие, без ожидания снимка
+            first.observe_redis("GET", ["GET"], 0.001)
+            # Недописанный снимок пропускается
+            with open(os.path.join(directory, "worker-2.json"), "w") as snapshot_file:
+                snapshot_file.write("{")
 
-        # Создаем мок-запрос
+            text = first.render()
+
+        self.assertIn('redis_commands_total{worker="0",command="GET"} 1', text)
+        self.assertIn('redis_commands_total{worker="1",command="HGET"} 2', text)
+        self.assertIn('http_requests_total{worker="1",handler="PatientHandler",method="POST",status="200"} 1', text)
+        self.assertIn('http_request_duration_seconds_bucket{worker="1",handler="PatientHandler",method="POST",'
+                      'le="0.005"} 1', text)
+        self.assertIn('redis_roundtrip_duration_seconds_count{worker="1",command="PIPELINE"} 1', text)
+        self.assertNotIn('worker="2"', text)
+        # Заголовки HELP/TYPE выводятся один раз на метрику
+        self.assertEqual(text.count('# TYPE redis_commands_total counter'), 1)
+
+
+class TestRedisAccounting(unittest.TestCase):
+    """Тесты учета обращений к Redis в рамках запроса"""
+
+    def setUp(self):
+        # Сохраняем оригинальное соединение с Redis
+        self.original_redis = main.r
+
+        # Создаем мок-объект для Redis
+        self.mock_redis = make_redis_mock()
+        main.r = self.mock_redis
+
+    def tearDown(self):
+        # Восстанавливаем оригинальное соединение
+        main.r = self.original_redis
+
+    def make_handler(self, debug=False, request_time=0.01):
+        # Врачи читаются из Redis, а не из кэша процесса
+        main.entity_cache.clear()
         request = Mock()
         request.method = "GET"
-        request.uri = "/analytics"
+        request.uri = "/hospital/1/doctors"
         request.headers = {}
+        request.request_time.return_value = request_time
 
-        # Создаем обработчик
         app = Application()
-        handler = main.AnalyticsHandler(app, request)
+        app.settings['debug'] = debug
+        handler = main.HospitalDoctorsHandler(app, request)
+        handler.write = MagicMock()
+        handler._transforms = []
+        self.mock_redis.pipeline.return_value.execute.side_effect = [
+            [b'H', {b'1', b'2'}], [{b'surname': b'A'}, {b'surname': b'B'}]
+        ]
+        run(handler.get('1'))
+        return handler
 
-        # Мокаем методы для проверки результата
+    def test_counts_commands_per_request(self):
+        """Тест подсчета команд и round trip запроса"""
+        handler = self.make_handler()
+
+        self.assertEqual(handler.redis_commands, {'HGET': 1, 'SMEMBERS': 1, 'HGETALL': 2})
+        self.assertEqual(handler.redis_round_trips, 2)
+        self.assertEqual(handler.format_redis_commands(), "HGETALL=2, HGET=1, SMEMBERS=1")
+
+    def test_debug_headers(self):
+        """Тест заголовков с обращениями к Redis в режиме отладки"""
+        handler = self.make_handler(debug=True)
+        handler.flush()
+
+        self.assertEqual(handler._headers['X-Redis-Commands'], '4')
+        self.assertEqual(handler._headers['X-Redis-Round-Trips'], '2')
+        self.assertIn('X-Redis-Time-Ms', handler._headers)
+
+    def test_no_debug_headers_in_production(self):
+        """Тест отсутствия заголовков вне режима отладки"""
+        handler = self.make_handler()
+        handler.flush()
+
+        self.assertNotIn('X-Redis-Commands', handler._headers)
+
+    def test_slow_request_logged(self):
+        """Тест журнала запросов, превысивших пороги"""
+        handler = self.make_handler(request_time=0.5)
+
+        with self.assertLogs(level='WARNING') as logs:
+            handler.on_finish()
+        self.assertIn("Slow request: GET /hospital/1/doctors 500.0 ms, 4 Redis commands in 2 round trips", logs.output[0])
+        self.assertIn("HGETALL=2", logs.output[0])
+
+        with patch.object(main, 'SLOW_REQUEST_ROUND_TRIPS', 1), self.assertLogs(level='WARNING'):
+            self.make_handler().on_finish()
+
+    def test_pipelined_commands_not_logged(self):
+        """Тест: много команд за несколько round trip не считаются медленным запросом"""
+        handler = self.make_handler()
+        handler.redis_commands = {'HGETALL': 500}
+
+        with patch.object(main.logging, 'warning') as warning:
+            handler.on_finish()
+        warning.assert_not_called()
+
+
+class TestRedisManager(unittest.TestCase):
+    """Тесты настроек пула соединений Redis"""
+
+    def test_default_settings(self):
+        """Тест настроек по умолчанию"""
+        manager = main.RedisManager({})
+
+        self.assertIsInstance(manager.pool, redis.asyncio.BlockingConnectionPool)
+        self.assertEqual(manager.pool.max_connections, 50)
+        self.assertEqual(manager.pool.connection_kwargs['host'], 'localhost')
+        self.assertEqual(manager.pool.connection_kwargs['port'], 6379)
+        self.assertEqual(manager.pool.connection_kwargs['socket_timeout'], 5.0)
+        self.assertEqual(manager.pool.connection_kwargs['socket_connect_timeout'], 2.0)
+
+    def test_settings_from_environment(self):
+        """Тест настроек пула из переменных окружения"""
+        manager = main.RedisManager({
+            'REDIS_HOST': 'redis',
+            'REDIS_PORT': '6380',
+            'REDIS_MAX_CONNECTIONS': '10',
+            'REDIS_POOL_TIMEOUT': '1.5',
+            'REDIS_SOCKET_TIMEOUT': '0.5',
+            'REDIS_CONNECT_TIMEOUT': '0.2',
+            'REDIS_HEALTH_CHECK_INTERVAL': '15',
+            'REDIS_RETRIES': '5',
+        })
+
+        self.assertEqual(manager.pool.max_connections, 10)
+        self.assertEqual(manager.pool.timeout, 1.5)
+        kwargs = manager.pool.connection_kwargs
+        self.assertEqual(kwargs['host'], 'redis')
+        self.assertEqual(kwargs['port'], 6380)
+        self.assertEqual(kwargs['socket_timeout'], 0.5)
+        self.assertEqual(kwargs['socket_connect_timeout'], 0.2)
+        self.assertEqual(kwargs['health_check_interval'], 15)
+        self.assertEqual(kwargs['retry']._retries, 5)
+
+    def test_unix_socket(self):
+        """Тест подключения через unix-сокет"""
+        manager = main.RedisManager({'REDIS_UNIX_SOCKET': '/var/run/redis.sock'})
+
+        self.assertIs(manager.pool.connection_class, redis.asyncio.UnixDomainSocketConnection)
+        self.assertEqual(manager.pool.connection_kwargs['path'], '/var/run/redis.sock')
+        self.assertNotIn('host', manager.pool.connection_kwargs)
+
+    def test_cluster_settings(self):
+        """Тест клиента Redis Cluster"""
+        manager = main.RedisManager({'REDIS_CLUSTER': '1', 'REDIS_HOST': 'redis-1',
+                                     'REDIS_MAX_CONNECTIONS': '10', 'REDIS_RETRIES': '5'})
+
+        self.assertTrue(manager.settings['cluster'])
+        self.assertIsNone(manager.pool)
+        self.assertIsInstance(manager.connection, RedisCluster)
+        self.assertEqual(manager.connection.connection_kwargs['max_connections'], 10)
+        self.assertEqual(manager.connection.connection_kwargs['retry']._retries, 5)
+        self.assertEqual(manager.connection.cluster_error_retry_attempts, 5)
+        # Таймаут не повторяется ни соединением, ни клиентом кластера
+        self.assertNotIn(redis.exceptions.TimeoutError, manager.connection.ERRORS_ALLOW_RETRY)
+        self.assertEqual(manager.connection.connection_kwargs['retry']._supported_errors,
+                         (redis.exceptions.ConnectionError,))
+        # Узлы еще не опрошены: соединений нет
+        self.assertEqual(manager.pool_stats()['created_connections'], 0)
+        manager.reset_after_fork()
+
+    def run_against_server(self, fail_first, retries, command):
+        """Команда через пул RedisManager к локальному серверу, который
+        рвет соединение на первых fail_first запросах ("hang" - не отвечает).
+        Возвращает (результат или исключение, количество запросов)."""
+        requests = []
+
+        async def serve(reader, writer):
+            while True:
+                header = await reader.readline()
+                if not header:
+                    return
+                for _ in range(int(header[1:]) * 2):
+                    await reader.readline()
+                requests.append(True)
+                if fail_first == "hang":
+                    await asyncio.sleep(1)
+                    return
+                if len(requests) <= fail_first:
+                    writer.close()
+                    return
+                writer.write(b"$2\r\nok\r\n")
+                await writer.drain()
+
+        async def scenario():
+            server = await asyncio.start_server(serve, "127.0.0.1", 0)
+            port = server.sockets[0].getsockname()[1]
+            manager = main.RedisManager({
+                'REDIS_HOST': '127.0.0.1', 'REDIS_PORT': str(port), 'REDIS_RETRIES': str(retries),
+                'REDIS_RETRY_BACKOFF_BASE': '0', 'REDIS_HEALTH_CHECK_INTERVAL': '0',
+                'REDIS_SOCKET_TIMEOUT': '0.2',
+            })
+            try:
+                return await command(manager.connection)
+            except redis.exceptions.RedisError as e:
+                return e
+            finally:
+                await manager.pool.disconnect()
+                server.close()
+
+        result = run(scenario())
+        return result, len(requests)
+
+    def test_commands_retried_on_connection_error(self):
+        """Тест: команда повторяется после разрыва соединения не более REDIS_RETRIES раз"""
+        result, requests = self.run_against_server(2, 3, lambda conn: conn.get("key"))
+        self.assertEqual(result, b"ok")
+        self.assertEqual(requests, 3)
+
+        result, requests = self.run_against_server(5, 2, lambda conn: conn.get("key"))
+        self.assertIsInstance(result, redis.exceptions.ConnectionError)
+        self.assertEqual(requests, 3)
+
+    def test_commands_not_retried_on_timeout(self):
+        """Тест: после таймаута команда не повторяется - она могла быть выполнена"""
+        result, requests = self.run_against_server("hang", 3, lambda conn: conn.incr("key"))
+        self.assertIsInstance(result, redis.exceptions.TimeoutError)
+        self.assertEqual(requests, 1)
+
+    def test_pool_stats(self):
+        """Тест статистики использования пула"""
+        manager = main.RedisManager({'REDIS_MAX_CONNECTIONS': '3'})
+        self.assertEqual(manager.pool_stats(), {
+            'max_connections': 3,
+            'created_connections': 0,
+            'in_use_connections': 0,
+            'idle_connections': 0,
+        })
+
+        # Имитируем выдачу соединения из пула
+        manager.pool.pool.get_nowait()
+        connection = manager.pool.make_connection()
+        self.assertEqual(manager.pool_stats()['in_use_connections'], 1)
+
+        # Возвращаем соединение в пул
+        manager.pool.pool.put_nowait(connection)
+        stats = manager.pool_stats()
+        self.assertEqual(stats['in_use_connections'], 0)
+        self.assertEqual(stats['idle_connections'], 1)
+
+
+class TestHealthHandler(unittest.TestCase):
+    """Тесты для проверки состояния Redis"""
+
+    def setUp(self):
+        # Сохраняем оригинальное соединение с Redis
+        self.original_redis = main.r
+
+        # Создаем мок-объект для Redis
+        self.mock_redis = make_redis_mock()
+        main.r = self.mock_redis
+
+    def tearDown(self):
+        # Восстанавливаем оригинальное соединение
+        main.r = self.original_redis
+
+    def make_handler(self):
+        request = Mock()
+        request.method = "GET"
+        request.uri = "/health"
+        request.headers = {}
+
+        handler = main.HealthHandler(Application(), request)
         handler.write = MagicMock()
         handler.set_status = MagicMock()
-        handler.set_header = MagicMock()
+        return handler
 
-        # Вызываем метод get
-        handler.get()
+    def test_health_ok(self):
+        """Тест успешной проверки состояния"""
+        handler = self.make_handler()
 
-        # Проверяем, что был установлен статус 400 и сообщение об ошибке
-        handler.set_status.assert_called_with(400)
-        handler.write.assert_called_once_with("Error retrieving analytics")
+        run(handler.get())
+
+        handler.set_status.assert_not_called()
+        status = handler.write.call_args[0][0]
+        self.assertEqual(status['redis'], 'ok')
+        self.assertIn('in_use_connections', status['redis_pool'])
+
+    def test_health_redis_unavailable(self):
+        """Тест проверки состояния при недоступном Redis"""
+        self.mock_redis.ping.side_effect = redis.exceptions.ConnectionError()
+        handler = self.make_handler()
+
+        run(handler.get())
+
+        handler.set_status.assert_called_with(503)
+        self.assertEqual(handler.write.call_args[0][0]['redis'], 'unavailable')
+
+
+class TestMainHandler(unittest.TestCase):
+    """Тесты для главной страницы"""
+
+    def setUp(self):
+        # Сохраняем оригинальное соединение с Redis
+        self.original_redis = main.r
+
+        # Создаем мок-объект для Redis
+        self.mock_redis = make_redis_mock()
+        main.r = self.mock_redis
+
+        # Инициализируем тестовую базу данных
+        run(main.init_db())
+
+    def tearDown(self):
+        # Восстанавливаем оригинальное соединение
+        main.r = self.original_redis
+
+    def test_get_main_page(self):
+        """Тест получения главной страницы"""
+        # Создаем мок-запрос
+        request = Mock()
+        request.method = "GET"
+        request.uri = "/"
+        request.headers = {}
+
+        # Создаем обработчик
+        app = Application()
+        handler = main.MainHandler(app, request)
+
+        # Мокаем методы для избежания HTTP-ответа
+        handler.write = MagicMock()
+        handler.render = MagicMock()
+
+        # Вызываем метод get
+        handler.get()
+
+        # Проверяем, что render был вызван
+        handler.render.assert_called_once_with('templates/index.html')
+
+
+class TestAnalyticsHandler(unittest.TestCase):
+    """Тесты для обработчика аналитики"""
+
+    def setUp(self):
+        # Сохраняем оригинальное соединение с Redis
+        self.original_redis = main.r
+
+        # Создаем мок-объект для Redis
+        self.mock_redis = make_redis_mock()
+        main.r = self.mock_redis
+
+        # Инициализируем тестовую базу данных
+        run(main.init_db())
+
+    def tearDown(self):
+        # Восстанавливаем оригинальное соединение
+        main.r = self.original_redis
+
+    def make_handler(self):
+        # Создаем мок-запрос
+        request = Mock()
+        request.method = "GET"
+        request.uri = "/analytics"
+        request.headers = {}
+
+        # Создаем обработчик
+        app = Application()
+        handler = main.AnalyticsHandler(app, request)
+
+        # Мокаем методы для проверки результата
+        handler.write = MagicMock()
+        handler.set_status = MagicMock()
+        handler.set_header = MagicMock()
+        return handler
+
+    def test_get_analytics_success(self):
+        """Тест успешного получения аналитики"""
+        # Счетчики еще не созданы
+        self.mock_redis.pipeline.return_value.execute.return_value = (
+            [None] * len(main.MODELS) + [{}, {}, 0] + [0] * len(main.AGE_BUCKETS))
+
+        handler = self.make_handler()
+
+        # Вызываем метод get
+        run(handler.get())
+
+        # Проверяем, что write был вызван (возвращен JSON)
+        handler.write.assert_called_once()
+        analytics = handler.write.call_args[0][0]
+        self.assertEqual(analytics['total_entities'], 0)
+        self.assertEqual(analytics['avg_patients_per_doctor'], 0)
+        self.assertEqual(analytics['hospitals_with_stats'], [])
+        # Проверяем, что заголовок Content-Type установлен
+        handler.set_header.assert_called_with("Content-Type", "application/json")
+
+    def test_get_analytics_with_data(self):
+        """Тест получения аналитики с данными"""
+        # Возвращаем значения счетчиков (по моделям в порядке MODELS)
+        self.mock_redis.pipeline.return_value.execute.return_value = [
+            b'2', b'3', b'4', b'6', b'6',
+            {b'1': b'2', b'2': b'1'},
+            {b'2': b'Second', b'1': b'First'},
+            3,
+            # Пациенты по возрастным группам
+            1, 0, 2, 0, 1, 0,
+        ]
+
+        handler = self.make_handler()
+
+        # Вызываем метод get
+        run(handler.get())
+
+        # Проверяем рассчитанные показатели
+        handler.write.assert_called_once()
+        analytics = handler.write.call_args[0][0]
+        self.assertEqual(analytics['hospital_count'], 2)
+        self.assertEqual(analytics['doctor_count'], 3)
+        self.assertEqual(analytics['patient_count'], 4)
+        self.assertEqual(analytics['diagnosis_count'], 6)
+        self.assertEqual(analytics['doctor_patient_connections'], 6)
+        self.assertEqual(analytics['total_entities'], 15)
+        self.assertEqual(analytics['avg_patients_per_doctor'], 2.0)
+        self.assertEqual(analytics['avg_diagnoses_per_patient'], 1.5)
+        self.assertEqual(analytics['patients_with_diagnoses'], 3)
+        self.assertEqual(analytics['hospitals_with_stats'], [
+            {'id': 1, 'name': 'First', 'doctors_count': 2},
+            {'id': 2, 'name': 'Second', 'doctors_count': 1},
+        ])
+        self.assertEqual(analytics['age_distribution'], {
+            '0-17': 1, '18-29': 0, '30-44': 2, '45-59': 0, '60-74': 1, '75+': 0,
+        })
+        # Проверяем, что заголовок Content-Type установлен
+        handler.set_header.assert_called_with("Content-Type", "application/json")
+
+        # Аналитика не обходит записи сущностей
+        self.mock_redis.hgetall.assert_not_called()
+        self.mock_redis.smembers.assert_not_called()
+        self.mock_redis.pipeline.return_value.execute.assert_called_once()
+
+    def test_age_buckets(self):
+        """Тест границ возрастных групп по весам дат рождения"""
+        buckets = main.AnalyticsHandler.get_age_buckets(main.datetime.date(2024, 2, 29))
+
+        self.assertEqual(buckets[0], ('0-17', '(20060229', 20240229))
+        self.assertEqual(buckets[1], ('18-29', '(19940229', 20060229))
+        self.assertEqual(buckets[-1], ('75+', '-inf', 19490229))
+        # Родившемуся 2006-02-28 уже исполнилось 18 лет, 2006-03-01 - еще нет
+        self.assertLessEqual(main.date_score(main.datetime.date(2006, 2, 28)), buckets[1][2])
+        self.assertGreater(main.date_score(main.datetime.date(2006, 3, 1)), int(buckets[0][1][1:]))
+
+    def test_get_analytics_redis_error(self):
+        """Тест ошибки Redis при получении аналитики"""
+        # Настраиваем мок для выбрасывания исключения
+        self.mock_redis.pipeline.return_value.execute.side_effect = Exception("Redis connection failed")
+
+        handler = self.make_handler()
+
+        # Вызываем метод get
+        run(handler.get())
+
+        # Проверяем, что был установлен статус 400 и сообщение об ошибке
+        handler.set_status.assert_called_with(400)
+        handler.write.assert_called_once_with("Error retrieving analytics")
+
+
+class TestTopDiagnosesHandler(unittest.TestCase):
+    """Тесты рейтинга типов диагнозов"""
+
+    def setUp(self):
+        self.original_redis = main.r
+        self.mock_redis = make_redis_mock()
+        main.r = self.mock_redis
+
+    def tearDown(self):
+        main.r = self.original_redis
+
+    def make_handler(self, **arguments):
+        request = Mock()
+        request.method = "GET"
+        request.uri = "/analytics/diagnoses/top"
+        request.headers = {}
+
+        handler = main.TopDiagnosesHandler(Application(), request)
+        handler.get_argument = lambda name, default=None: arguments.get(name, default)
+        handler.write = MagicMock()
+        handler.set_status = MagicMock()
+        return handler
+
+    def test_top_diagnoses(self):
+        """Тест рейтинга по всем диагнозам одной командой"""
+        pipe = self.mock_redis.pipeline.return_value
+        pipe.execute.return_value = [[(b'flu', 3.0), (b'cold', 2.0)]]
+
+        handler = self.make_handler(n='2')
+        run(handler.get())
+
+        pipe.zrevrange.assert_called_once_with("{diagnosis}:analytics:types", 0, 1, withscores=True)
+        handler.write.assert_called_once_with({'hospital_ID': None, 'top': [
+            {'type': 'flu', 'count': 3},
+            {'type': 'cold', 'count': 2},
+        ]})
+
+    def test_top_diagnoses_by_hospital(self):
+        """Тест рейтинга по больнице"""
+        pipe = self.mock_redis.pipeline.return_value
+        pipe.execute.return_value = [b'First', [(b'asthma', 1.0)]]
+
+        handler = self.make_handler(hospital='1', n='100000')
+        run(handler.get())
+
+        pipe.zrevrange.assert_called_once_with("{diagnosis}:analytics:hospital-types:1", 0,
+                                               main.MAX_TOP_DIAGNOSES - 1, withscores=True)
+        handler.write.assert_called_once_with({'hospital_ID': 1, 'top': [{'type': 'asthma', 'count': 1}]})
+
+    def test_top_diagnoses_unknown_hospital(self):
+        """Тест несуществующей больницы"""
+        self.mock_redis.pipeline.return_value.execute.return_value = [None, []]
+
+        handler = self.make_handler(hospital='9')
+        run(handler.get())
+
+        handler.set_status.assert_called_once_with(404)
+        handler.write.assert_called_once_with("No hospital with such ID")
+
+    def test_top_diagnoses_invalid_arguments(self):
+        """Тест некорректных параметров"""
+        for arguments in ({'n': '0'}, {'n': 'x'}, {'hospital': 'x'}):
+            handler = self.make_handler(**arguments)
+            run(handler.get())
+            handler.set_status.assert_called_once_with(400)
+        self.mock_redis.pipeline.assert_not_called()
+
+
+class TestSearchHandler(unittest.TestCase):
+    """Тесты поиска по префиксу"""
+
+    def setUp(self):
+        self.original_redis = main.r
+        self.mock_redis = make_redis_mock()
+        main.r = self.mock_redis
+
+    def tearDown(self):
+        main.r = self.original_redis
+
+    def make_handler(self, **arguments):
+        request = Mock()
+        request.method = "GET"
+        request.uri = "/search/patient"
+        request.headers = {}
+
+        handler = main.SearchHandler(Application(), request)
+        handler.get_argument = lambda name, default=None: arguments.get(name, default)
+        handler.write = MagicMock()
+        handler.set_status = MagicMock()
+        return handler
+
+    def test_search_prefix(self):
+        """Тест поиска без учета регистра по лексикографическому индексу"""
+        self.mock_redis.zrangebylex.return_value = [b'ivanov\x003', b'ivanova\x001']
+        main.entity_cache.set("patient:1", {'surname': 'Ivanova', 'born_date': '1990-01-01', 'sex': 'F', 'mpn': '2'})
+        pipe = self.mock_redis.pipeline.return_value
+        pipe.execute.return_value = [{b'surname': b'Ivanov', b'born_date': b'1980-01-01', b'sex': b'M', b'mpn': b'1'}]
+
+        handler = self.make_handler(q=' IVAN ', limit='5')
+        run(handler.get('patient'))
+
+        self.mock_redis.zrangebylex.assert_awaited_once_with(
+            "{patient}:search", b"[ivan", b"[ivan\xff", start=0, num=5)
+        # Запись из кэша процесса не запрашивается
+        pipe.hgetall.assert_called_once_with("patient:3")
+        handler.write.assert_called_once_with({'model': 'patient', 'query': 'ivan', 'results': [
+            {'id': 3, 'surname': 'Ivanov', 'born_date': '1980-01-01', 'sex': 'M', 'mpn': '1'},
+            {'id': 1, 'surname': 'Ivanova', 'born_date': '1990-01-01', 'sex': 'F', 'mpn': '2'},
+        ]})
+
+    def test_search_limit_capped(self):
+        """Тест ограничения количества результатов"""
+        self.mock_redis.zrangebylex.return_value = []
+        handler = self.make_handler(q='a', limit='100000')
+        run(handler.get('doctor'))
+
+        self.mock_redis.zrangebylex.assert_awaited_once_with(
+            "{doctor}:search", b"[a", b"[a\xff", start=0, num=main.MAX_SEARCH_LIMIT)
+        handler.write.assert_called_once_with({'model': 'doctor', 'query': 'a', 'results': []})
+
+    def test_search_invalid_arguments(self):
+        """Тест пустого запроса и некорректного лимита"""
+        for arguments in ({}, {'q': '  '}, {'q': 'a', 'limit': '0'}, {'q': 'a', 'limit': 'x'}):
+            handler = self.make_handler(**arguments)
+            run(handler.get('patient'))
+            handler.set_status.assert_called_once_with(400)
+        self.mock_redis.zrangebylex.assert_not_called()
+
+    def test_search_redis_error(self):
+        """Тест ошибки подключения к Redis при поиске"""
+        self.mock_redis.zrangebylex.side_effect = redis.exceptions.ConnectionError("Connection refused")
+        handler = self.make_handler(q='a')
+        run(handler.get('patient'))
+
+        handler.set_status.assert_called_once_with(400)
+        handler.write.assert_called_once_with("Redis connection refused")
+
+
+class TestModels(unittest.TestCase):
+    """Тесты описаний моделей MODELS"""
+
+    def test_handlers_use_registry(self):
+        """Тест: у каждой модели есть обработчик с ее описанием"""
+        handlers = [main.HospitalHandler, main.DoctorHandler, main.PatientHandler,
+                    main.DiagnosisHandler, main.DoctorPatientHandler]
+        self.assertEqual([handler.MODEL_NAME for handler in handlers], list(main.MODELS))
+        for handler in handlers:
+            self.assertTrue(issubclass(handler, main.EntityHandler))
+
+    def test_validators(self):
+        """Тест проверки обязательных полей и дополнительных правил"""
+        patient = main.MODELS["patient"]
+        data = {'surname': 'S', 'born_date': '1990-01-01', 'sex': 'M', 'mpn': '1'}
+        self.assertIsNone(patient.validate(data))
+        self.assertEqual(patient.validate(dict(data, mpn='')), "All fields required")
+        self.assertEqual(patient.validate(dict(data, sex='X')), "Sex must be 'M' or 'F'")
+
+    def test_index_updates_skip_empty_fields(self):
+        """Тест: индексы по пустому полю не обновляются"""
+        doctor = main.MODELS["doctor"]
+        self.assertEqual(doctor.get_index_updates({'surname': 'S', 'profession': 'P', 'hospital_ID': ''}),
+                         [("INCRBY", "{doctor}:analytics:count", 1),
+                          ("ZADD", "{doctor}:ids", main.ENTITY_ID, main.ENTITY_ID),
+                          ("ZADD", "{doctor}:search", 0, main.IdSuffix("p\0"))])
+        updates = doctor.get_index_updates({'surname': 'S', 'profession': 'P', 'hospital_ID': '7'})
+        self.assertEqual(updates,
+                         [("INCRBY", "{doctor}:analytics:count", 1),
+                          ("ZADD", "{doctor}:ids", main.ENTITY_ID, main.ENTITY_ID),
+                          ("HINCRBY", "{doctor}:analytics:hospital-doctors", "7", 1),
+                          ("SADD", "{hospital:7}:doctors", main.ENTITY_ID),
+                          ("HSET", "{doctor}:index:hospital", main.ENTITY_ID, "7"),
+                          ("ZADD", "{doctor}:search", 0, main.IdSuffix("p\0"))])
+        # Подстановка ID задается типом аргумента, а не его значением
+        self.assertIsInstance(updates[-1][3], main.IdSuffix)
+        self.assertNotIsInstance(updates[2][2], main.IdSuffix)
+
+    def test_doctor_without_hospital_not_checked(self):
+        """Тест: больница врача проверяется, только если указан ее ID"""
+        doctor = main.MODELS["doctor"]
+        _, keys, args = doctor.get_create_call({'surname': 'S', 'profession': 'P', 'hospital_ID': ''}, 5)
+        self.assertEqual(keys, ["doctor:5", "{doctor}:cache:version", "{doctor}:analytics:count",
+                                "{doctor}:ids", "{doctor}:search"])
+        self.assertEqual(args[:3], [5, "", ""])
+        _, keys, args = doctor.get_create_call({'surname': 'S', 'profession': 'P', 'hospital_ID': '7'}, 5)
+        self.assertEqual(keys[:3], ["doctor:5", "{hospital}:ids", "hospital:7"])
+        self.assertEqual(args[:3], [5, "7", ""])
+
+    @unittest.skipIf(fakeredis is None, "fakeredis[lua] is not installed")
+    def test_rebuild_matches_created_indexes(self):
+        """Тест: пересчет индексов дает те же ключи, что и создание записей"""
+        redis_conn = fakeredis.FakeAsyncRedis(server=fakeredis.FakeServer())
+        rows = [
+            ("hospital", {'name': 'H', 'address': 'A', 'phone': '1', 'beds_number': '10'}),
+            ("doctor", {'surname': 'D', 'profession': 'P', 'hospital_ID': '1'}),
+            ("doctor", {'surname': 'E', 'profession': 'P', 'hospital_ID': ''}),
+            ("patient", {'surname': 'S', 'born_date': '1990-01-01', 'sex': 'F', 'mpn': '1'}),
+            ("doctor-patient", {'doctor_ID': '1', 'patient_ID': '1'}),
+            ("doctor-patient", {'doctor_ID': '2', 'patient_ID': '1'}),
+            # Пересчет относит диагнозы к больницам по текущим связям
+            ("diagnosis", {'patient_ID': '1', 'type': 'Flu', 'information': ''}),
+            ("diagnosis", {'patient_ID': '1', 'type': 'flu', 'information': ''}),
+        ]
+
+        async def snapshot():
+            # Ключи с хеш-тегами, кроме счетчиков ID, версий и служебных ключей базы
+            keys = sorted(key for key in await redis_conn.keys("{*")
+                          if not key.startswith(b"{meta}") and not key.endswith((b":autoID", b":cache:version")))
+            result = {}
+            for key in keys:
+                key_type = await redis_conn.type(key)
+                if key_type == b"hash":
+                    result[key] = await redis_conn.hgetall(key)
+                elif key_type == b"zset":
+                    result[key] = await redis_conn.zrange(key, 0, -1, withscores=True)
+                elif key_type == b"string":
+                    result[key] = await redis_conn.get(key)
+                else:
+                    result[key] = await redis_conn.smembers(key)
+            return result
+
+        async def scenario():
+            with patch.object(main, 'r', redis_conn):
+                await main.init_db()
+                for model, data in rows:
+                    await create_row(redis_conn, model, data)
+                created = await snapshot()
+                await redis_conn.delete(*created)
+                await main.rebuild_indexes()
+                return created, await snapshot()
+
+        created, rebuilt = run(scenario())
+        self.assertIn(b"{patient:1}:doctors", created)
+        self.assertIn(b"{patient}:search", created)
+        self.assertIn(b"{patient}:index:mpn", created)
+        self.assertIn(b"{patient}:index:born", created)
+        self.assertEqual(created[b"{doctor}:ids"], [(b"1", 1.0), (b"2", 2.0)])
+        self.assertEqual(created[b"{doctor-patient}:ids"], [(b"1", 1.0), (b"2", 2.0)])
+        self.assertEqual(created[b"{diagnosis}:analytics:hospital-types:1"], [(b"flu", 2.0)])
+        self.assertEqual(rebuilt, created)
+
+    @unittest.skipIf(fakeredis is None, "fakeredis[lua] is not installed")
+    def test_rebuild_replays_diagnosis_hospitals(self):
+        """Тест: пересчет учитывает диагноз в больницах на момент постановки, а не по текущим связям"""
+        redis_conn = fakeredis.FakeAsyncRedis(server=fakeredis.FakeServer())
+        rows = [
+            ("hospital", {'name': 'H', 'address': 'A', 'phone': '1', 'beds_number': '10'}),
+            ("hospital", {'name': 'G', 'address': 'A', 'phone': '1', 'beds_number': '10'}),
+            ("doctor", {'surname': 'D', 'profession': 'P', 'hospital_ID': '1'}),
+            ("doctor", {'surname': 'E', 'profession': 'P', 'hospital_ID': '2'}),
+            ("patient", {'surname': 'S', 'born_date': '1990-01-01', 'sex': 'F', 'mpn': '1'}),
+            ("doctor-patient", {'doctor_ID': '1', 'patient_ID': '1'}),
+            ("diagnosis", {'patient_ID': '1', 'type': 'flu', 'information': ''}),
+            ("diagnosis", {'patient_ID': '1', 'type': 'cold', 'information': ''}),
+            # Связь появилась после диагнозов
+            ("doctor-patient", {'doctor_ID': '2', 'patient_ID': '1'}),
+        ]
+
+        async def state():
+            return [await redis_conn.zrange(main.HOSPITAL_DIAGNOSIS_TYPES_KEY.format(hospital_id), 0, -1,
+                                            withscores=True) for hospital_id in (1, 2)]
+
+        async def scenario():
+            with patch.object(main, 'r', redis_conn):
+                await main.init_db()
+                for model, data in rows:
+                    await create_row(redis_conn, model, data)
+                created = await state()
+                attribution = await redis_conn.hgetall(main.DIAGNOSIS_HOSPITALS_KEY)
+                await main.rebuild_indexes()
+                rebuilt = await state()
+                # Диагноз без атрибуции (создан до ее появления) учитывается по текущим связям
+                await redis_conn.hdel(main.DIAGNOSIS_HOSPITALS_KEY, "2")
+                await main.rebuild_indexes()
+                return created, attribution, rebuilt, await state(), await redis_conn.hget(
+                    main.DIAGNOSIS_HOSPITALS_KEY, "2")
+
+        created, attribution, rebuilt, legacy, legacy_attribution = run(scenario())
+        self.assertEqual(created, [[(b"cold", 1.0), (b"flu", 1.0)], []])
+        self.assertEqual(attribution, {b"1": b"1", b"2": b"1"})
+        self.assertEqual(rebuilt, created)
+        self.assertEqual(legacy, [[(b"cold", 1.0), (b"flu", 1.0)], [(b"cold", 1.0)]])
+        self.assertEqual(legacy_attribution, b"1,2")
+
+    @unittest.skipIf(fakeredis is None, "fakeredis[lua] is not installed")
+    def test_rebuild_replaces_indexes_in_batches(self):
+        """Тест: пересчет пакетами заменяет устаревшие индексы и удаляет временные ключи"""
+        redis_conn = fakeredis.FakeAsyncRedis(server=fakeredis.FakeServer())
+        rows = [("hospital", {'name': 'H', 'address': 'A', 'phone': '1', 'beds_number': '10'})]
+        rows += [("patient", {'surname': f'S{i}', 'born_date': '1990-01-01', 'sex': 'F', 'mpn': str(i)})
+                 for i in range(5)]
+        rows += [("doctor", {'surname': 'D', 'profession': 'P', 'hospital_ID': '1'}),
+                 ("doctor-patient", {'doctor_ID': '1', 'patient_ID': '1'}),
+                 ("diagnosis", {'patient_ID': '1', 'type': 'Flu', 'information': ''})]
+
+        async def state():
+            result = {}
+            for key in await redis_conn.keys("*"):
+                key_type = await redis_conn.type(key)
+                if key_type == b"hash":
+                    result[key] = await redis_conn.hgetall(key)
+                elif key_type == b"zset":
+                    result[key] = await redis_conn.zrange(key, 0, -1, withscores=True)
+                elif key_type == b"set":
+                    result[key] = await redis_conn.smembers(key)
+                else:
+                    result[key] = await redis_conn.get(key)
+            return result
+
+        async def scenario():
+            with patch.object(main, 'r', redis_conn), patch.object(main, 'PIPELINE_BATCH_SIZE', 2):
+                await main.init_db()
+                for model, data in rows:
+                    await create_row(redis_conn, model, data)
+                created = await state()
+                # Устаревшие значения, лишний ключ FANOUT и остаток прерванного пересчета
+                await redis_conn.set("{patient}:analytics:count", 99)
+                await redis_conn.zadd("{patient}:search", {"x\0" + "9": 0})
+                await redis_conn.zadd(main.HOSPITAL_DIAGNOSIS_TYPES_KEY.format(9), {"flu": 1})
+                await redis_conn.sadd("{patient:1}:doctors" + main.REBUILD_SUFFIX, "7")
+                await main.rebuild_indexes()
+                return created, await state(), await redis_conn.exists(main.REBUILD_LOCK_KEY)
+
+        created, rebuilt, locked = run(scenario())
+        self.assertEqual(rebuilt, created)
+        self.assertFalse(locked)
+
+    @unittest.skipIf(fakeredis is None, "fakeredis[lua] is not installed")
+    def test_rebuild_runs_in_one_process(self):
+        """Тест: пересчет не начинается, пока его выполняет другой процесс"""
+        redis_conn = fakeredis.FakeAsyncRedis(server=fakeredis.FakeServer())
+
+        async def scenario():
+            with patch.object(main, 'r', redis_conn):
+                await redis_conn.set(main.REBUILD_LOCK_KEY, 1)
+                with self.assertRaises(RuntimeError):
+                    await main.rebuild_indexes()
+                return await redis_conn.get(main.INDEX_VERSION_KEY), await redis_conn.exists(main.REBUILD_LOCK_KEY)
+
+        self.assertEqual(run(scenario()), (None, 1))
+
+    @unittest.skipIf(fakeredis is None, "fakeredis[lua] is not installed")
+    def test_placeholder_like_values_stored_verbatim(self):
+        """Тест: значения '$id' и '$ref' в данных не подменяются ни при создании, ни при пересчете"""
+        redis_conn = fakeredis.FakeAsyncRedis(server=fakeredis.FakeServer())
+        rows = [
+            ("hospital", {'name': '$id', 'address': 'A', 'phone': '1', 'beds_number': '10'}),
+            ("doctor", {'surname': 'D', 'profession': 'P', 'hospital_ID': '1'}),
+            ("patient", {'surname': 'S', 'born_date': '1990-01-01', 'sex': 'F', 'mpn': '$id'}),
+            ("doctor-patient", {'doctor_ID': '1', 'patient_ID': '1'}),
+            ("diagnosis", {'patient_ID': '1', 'type': '$id', 'information': ''}),
+            ("diagnosis", {'patient_ID': '1', 'type': 'x$refy', 'information': ''}),
+        ]
+        hospital_types_key = main.HOSPITAL_DIAGNOSIS_TYPES_KEY.format(1)
+
+        async def state():
+            return (await redis_conn.hgetall(main.PATIENT_MPN_KEY),
+                    await redis_conn.hgetall(main.HOSPITAL_NAMES_KEY),
+                    await redis_conn.zrange(main.DIAGNOSIS_TYPES_KEY, 0, -1, withscores=True),
+                    await redis_conn.zrange(hospital_types_key, 0, -1, withscores=True))
+
+        async def scenario():
+            with patch.object(main, 'r', redis_conn):
+                await main.init_db()
+                for model, data in rows:
+                    await create_row(redis_conn, model, data)
+                # Повтор того же полиса '$id' отклоняется как дубликат
+                duplicate = await create_row(redis_conn, "patient",
+                                             {'surname': 'T', 'born_date': '1990-01-01', 'sex': 'F', 'mpn': '$id'})
+                created = await state()
+                await redis_conn.delete(main.PATIENT_MPN_KEY, main.HOSPITAL_NAMES_KEY,
+                                        main.DIAGNOSIS_TYPES_KEY, hospital_types_key)
+                await main.rebuild_indexes()
+                return duplicate, created, await state()
+
+        duplicate, created, rebuilt = run(scenario())
+        self.assertIs(main.MODELS["patient"].parse_result(duplicate), main.DUPLICATE)
+        mpn_index, hospital_names, types, hospital_types = created
+        self.assertEqual(mpn_index, {b"$id": b"1"})
+        self.assertEqual(hospital_names, {b"1": b"$id"})
+        self.assertEqual(types, [(b"$id", 1.0), (b"x$refy", 1.0)])
+        self.assertEqual(hospital_types, [(b"$id", 1.0), (b"x$refy", 1.0)])
+        self.assertEqual(rebuilt, created)
+
+
+@unittest.skipIf(fakeredis is None, "fakeredis[lua] is not installed")
+class TestRoundTripBudgets(tornado.testing.AsyncHTTPTestCase):
+    """Бюджеты обращений к Redis для эндпоинтов
+
+    Эндпоинты работают с Redis в памяти (fakeredis), а команды и round
+    trip считаются на уровне соединения, поэтому учитываются все
+    обращения обработчиков. Размер пакета уменьшен, чтобы списки
+    читались несколькими пакетами.
+    """
+
+    BATCH_SIZE = 10
+    HOSPITALS, DOCTORS, PATIENTS, DIAGNOSES = 3, 25, 40, 40
+
+    def setUp(self):
+        # Сохраняем оригинальное соединение с Redis
+        self.original_redis = main.r
+        # Отдельный сервер: по умолчанию экземпляры fakeredis делят данные
+        main.r = fakeredis.FakeAsyncRedis(server=fakeredis.FakeServer())
+        main.response_cache.clear()
+        main.entity_cache.clear()
+
+        batch_size = patch.object(main, 'PIPELINE_BATCH_SIZE', self.BATCH_SIZE)
+        batch_size.start()
+        self.addCleanup(batch_size.stop)
+
+        super().setUp()
+        self.io_loop.run_sync(self.seed)
+
+    def tearDown(self):
+        super().tearDown()
+        # Восстанавливаем оригинальное соединение
+        main.r = self.original_redis
+
+    def runTest(self):
+        # AsyncTestCase в Tornado 6.0 требует существующий метод в __init__,
+        # а pytest создает служебный экземпляр с именем runTest
+        pass
+
+    def get_app(self):
+        return main.make_app(production=True)
+
+    async def seed(self):
+        """Данные создаются теми же скриптами, что и формами; все врачи - в больнице 1"""
+        await main.init_db()
+        await main.r.script_load(main.CREATE_ENTITY_LUA)
+        await main.r.script_load(main.LINK_DOCTOR_PATIENT_LUA)
+        await main.r.script_load(main.LOOKUP_UNIQUE_LUA)
+        await main.r.script_load(main.ZSET_PAGE_LUA)
+        await main.r.script_load(main.FANOUT_REFS_LUA)
+
+        rows = [("hospital", {'name': f"H{i}", 'address': "A", 'phone': "1", 'beds_number': "10"})
+                for i in range(self.HOSPITALS)]
+        rows += [("doctor", {'surname': f"D{i}", 'profession': "surgeon", 'hospital_ID': "1"})
+                 for i in range(self.DOCTORS)]
+        rows += [("patient", {'surname': f"P{i}", 'born_date': "1990-01-01", 'sex': "F", 'mpn': str(i)})
+                 for i in range(self.PATIENTS)]
+        rows += [("diagnosis", {'patient_ID': "1", 'type': "flu", 'information': ""})
+                 for _ in range(self.DIAGNOSES)]
+        rows += [("doctor-patient", {'doctor_ID': str(i + 1), 'patient_ID': "1"})
+                 for i in range(self.DOCTORS)]
+
+        for model, batch in itertools.groupby(rows, key=lambda row: row[0]):
+            await main.create_records(main.MODELS[model], [data for _, data in batch])
+
+    def fetch_counted(self, path, **kwargs):
+        """Запрос с подсчетом команд и round trip Redis"""
+        counts = {'commands': 0, 'round_trips': 0}
+        pack_command = redis.asyncio.connection.Connection.pack_command
+        send_packed_command = redis.asyncio.connection.Connection.send_packed_command
+
+        def counting_pack_command(connection, *args):
+            counts['commands'] += 1
+            return pack_command(connection, *args)
+
+        async def counting_send_packed_command(connection, *args, **kwargs):
+            counts['round_trips'] += 1
+            return await send_packed_command(connection, *args, **kwargs)
+
+        with patch.object(redis.asyncio.connection.Connection, 'pack_command', counting_pack_command), \
+                patch.object(redis.asyncio.connection.Connection, 'send_packed_command',
+                             counting_send_packed_command):
+            response = self.fetch(path, **kwargs)
+        return response, counts['commands'], counts['round_trips']
+
+    def batches(self, count):
+        return math.ceil(count / self.BATCH_SIZE)
+
+    def test_analytics_budget(self):
+        """Аналитика - один pipeline независимо от объема данных"""
+        response, commands, round_trips = self.fetch_counted("/analytics")
+
+        self.assertEqual(response.code, 200)
+        self.assertEqual(round_trips, 1)
+        self.assertLessEqual(commands, len(main.MODELS) + 3 + len(main.AGE_BUCKETS))
+        # Все пациенты набора родились в 1990 году
+        age_distribution = json.loads(response.body)['age_distribution']
+        self.assertEqual(sum(age_distribution.values()), self.PATIENTS)
+
+    def test_top_diagnoses_budget(self):
+        """Рейтинг диагнозов - один round trip независимо от их количества"""
+        for path in ("/analytics/diagnoses/top", "/analytics/diagnoses/top?hospital=1"):
+            response, commands, round_trips = self.fetch_counted(path)
+            self.assertEqual(response.code, 200)
+            self.assertEqual(round_trips, 1)
+            self.assertLessEqual(commands, 2)
+
+        top = json.loads(self.fetch("/analytics/diagnoses/top").body)['top']
+        self.assertEqual(top, [{'type': 'flu', 'count': self.DIAGNOSES}])
+
+    def test_list_page_budget(self):
+        """Страница списка - версии, множество ID и ceil(limit / пакет) pipeline"""
+        limit = 25
+        response, commands, round_trips = self.fetch_counted(f"/patient?limit={limit}")
+
+        self.assertEqual(response.code, 200)
+        self.assertLessEqual(round_trips, 2 + self.batches(limit))
+        self.assertLessEqual(commands, 2 + limit)
+
+        # Повторная страница отдается из кэша: читаются только версии
+        response, commands, round_trips = self.fetch_counted(f"/patient?limit={limit}")
+        self.assertEqual(response.code, 200)
+        self.assertEqual((commands, round_trips), (1, 1))
+
+    def test_doctor_patient_page_budget(self):
+        """Страница связей читается пакетами по ID врачей"""
+        response, commands, round_trips = self.fetch_counted("/doctor-patient")
+
+        self.assertEqual(response.code, 200)
+        self.assertLessEqual(round_trips, 2 + self.batches(self.DOCTORS))
+
+    def test_hospital_doctors_budget(self):
+        """Врачи больницы - индекс и ceil(врачей / пакет) pipeline"""
+        response, commands, round_trips = self.fetch_counted("/hospital/1/doctors")
+
+        self.assertEqual(response.code, 200)
+        self.assertLessEqual(round_trips, 1 + self.batches(self.DOCTORS))
+        self.assertLessEqual(commands, 2 + self.DOCTORS)
+
+    def test_patient_chart_budget(self):
+        """Карта пациента - один pipeline при любом числе диагнозов и врачей"""
+        response, commands, round_trips = self.fetch_counted("/patient/1/chart")
+
+        self.assertEqual(response.code, 200)
+        self.assertEqual(round_trips, 1)
+        self.assertLessEqual(commands, 3)
+
+    def test_patient_by_mpn_budget(self):
+        """Пациент по номеру полиса - один round trip"""
+        response, commands, round_trips = self.fetch_counted("/patient/by-mpn/5")
+
+        self.assertEqual(response.code, 200)
+        self.assertEqual(json.loads(response.body)['patient']['mpn'], "5")
+        self.assertEqual((commands, round_trips), (1, 1))
+
+    def test_patient_born_budget(self):
+        """Пациенты по датам рождения - индекс и ceil(limit / пакет) pipeline"""
+        limit = 25
+        response, commands, round_trips = self.fetch_counted(
+            f"/patient/born?from=1990-01-01&to=1990-12-31&limit={limit}")
+
+        self.assertEqual(response.code, 200)
+        self.assertEqual(len(json.loads(response.body)['patients']), limit)
+        self.assertLessEqual(round_trips, 1 + self.batches(limit))
+        self.assertLessEqual(commands, 1 + limit)
+
+    def test_search_budget(self):
+        """Поиск по префиксу - индекс и ceil(результатов / пакет) pipeline"""
+        response, commands, round_trips = self.fetch_counted("/search/patient?q=p1&limit=50")
+
+        self.assertEqual(response.code, 200)
+        # P1 и P10..P19
+        self.assertEqual(len(json.loads(response.body)['results']), 11)
+        self.assertLessEqual(round_trips, 1 + self.batches(11))
+        self.assertLessEqual(commands, 1 + 11)
+
+    def test_create_budget(self):
+        """Создание сущности - два round trip (выделение ID, у диагноза - вместе
+        с чтением больниц врачей пациента, и скрипт), связи - один"""
+        forms = [
+            ("/hospital", "name=H&address=A&phone=1&beds_number=1", (2, 2)),
+            ("/doctor", "surname=S&profession=P&hospital_ID=1", (2, 2)),
+            ("/patient", "surname=S&born_date=2000-01-01&sex=M&mpn=new", (2, 2)),
+            ("/diagnosis", "patient_ID=1&type=flu&information=", (3, 2)),
+            ("/doctor-patient", "doctor_ID=2&patient_ID=2", (1, 1)),
+        ]
+        for path, body, budget in forms:
+            response, commands, round_trips = self.fetch_counted(path, method="POST", body=body)
+            self.assertEqual(response.code, 200, path)
+            self.assertEqual((commands, round_trips), budget, path)
+
+    def test_export_budget(self):
+        """Выгрузка - множество ID и ceil(записей / пакет) pipeline"""
+        response, commands, round_trips = self.fetch_counted("/export/patient")
+
+        self.assertEqual(response.code, 200)
+        self.assertLessEqual(round_trips, 1 + self.batches(self.PATIENTS))
+        self.assertLessEqual(commands, 1 + self.PATIENTS + self.batches(self.PATIENTS))
+
+    def test_id_gaps_budget(self):
+        """Пропуски в нумерации ID не добавляют обращений"""
+        self.io_loop.run_sync(lambda: main.r.incrby("{patient}:autoID", 100000))
+        response = self.fetch("/patient", method="POST",
+                              body="surname=Gap&born_date=2000-01-01&sex=M&mpn=gap")
+        self.assertEqual(response.code, 200)
+        patients = self.PATIENTS + 1
+
+        response, commands, round_trips = self.fetch_counted("/export/patient")
+        self.assertEqual(response.code, 200)
+        self.assertEqual(len(response.body.splitlines()), patients)
+        self.assertLessEqual(round_trips, 1 + self.batches(patients))
+        self.assertLessEqual(commands, 1 + patients + self.batches(patients))
+
+        response, commands, round_trips = self.fetch_counted(f"/patient?limit={patients}")
+        self.assertEqual(response.code, 200)
+        self.assertIn(b"Gap", response.body)
+        self.assertLessEqual(round_trips, 2 + self.batches(patients))
+
+    def test_import_budget(self):
+        """Импорт - загрузка скриптов и два pipeline на пакет (выделение ID и создание)"""
+        rows = 35
+        body = "\n".join(json.dumps({'name': f"H{i}", 'address': "A"}) for i in range(rows))
+        response, commands, round_trips = self.fetch_counted("/import/hospital", method="POST", body=body)
+
+        self.assertEqual(response.code, 200)
+        self.assertEqual(json.loads(response.body)['created'], rows)
+        self.assertLessEqual(round_trips, 2 + 2 * self.batches(rows))
+
+
+
+async def dump_database(redis_conn):
+    """Содержимое всех ключей базы для сравнения раскладок"""
+    result = {}
+    for key in sorted(await redis_conn.keys("*")):
+        key_type = await redis_conn.type(key)
+        if key_type == b"hash":
+            result[key] = await redis_conn.hgetall(key)
+        elif key_type == b"zset":
+            result[key] = await redis_conn.zrange(key, 0, -1, withscores=True)
+        elif key_type == b"set":
+            result[key] = await redis_conn.smembers(key)
+        else:
+            result[key] = await redis_conn.get(key)
+    return result
+
+
+@unittest.skipIf(fakeredis is None, "fakeredis[lua] is not installed")
+class TestClusterMode(tornado.testing.AsyncHTTPTestCase):
+    """Эндпоинты в режиме кластера (CLUSTER_MODE) на Redis в памяти
+
+    fakeredis не проверяет слоты, поэтому раскладка ключей проверяется
+    отдельно (TestClusterKeyLayout), а здесь - запись сущностей после
+    скрипта и чтения без SORT ... GET и Lua-поиска.
+    """
+
+    def setUp(self):
+        # Сохраняем оригинальное соединение с Redis
+        self.original_redis = main.r
+        main.r = fakeredis.FakeAsyncRedis(server=fakeredis.FakeServer())
+        main.response_cache.clear()
+        main.entity_cache.clear()
+
+        cluster_mode = patch.object(main, 'CLUSTER_MODE', True)
+        cluster_mode.start()
+        self.addCleanup(cluster_mode.stop)
+
+        super().setUp()
+        self.io_loop.run_sync(main.init_db)
+
+    def tearDown(self):
+        super().tearDown()
+        # Восстанавливаем оригинальное соединение
+        main.r = self.original_redis
+
+    def runTest(self):
+        # См. TestRoundTripBudgets.runTest
+        pass
+
+    def get_app(self):
+        return main.make_app(production=True)
+
+    def post(self, path, body):
+        response = self.fetch(path, method="POST", body=body)
+        self.assertEqual(response.code, 200, response.body)
+        return response.body.decode()
+
+    def test_create_writes_records(self):
+        """Тест: запись создается после скрипта, метка связанной записи читается вместе с ней"""
+        self.assertEqual(self.post("/hospital", "name=H&address=A&phone=1&beds_number=1"), "OK: ID 1 for H")
+        self.post("/patient", "surname=Smith&born_date=1990-01-01&sex=F&mpn=100")
+        self.assertEqual(self.post("/diagnosis", "patient_ID=1&type=flu&information=cold"),
+                         "OK: ID 1 for patient Smith")
+
+        record = self.io_loop.run_sync(lambda: main.r.hgetall("diagnosis:1"))
+        self.assertEqual(record, {b"patient_ID": b"1", b"type": b"flu", b"information": b"cold"})
+
+    def test_missing_reference_writes_nothing(self):
+        """Тест: при отсутствии связанной записи запись не создается"""
+        response = self.fetch("/diagnosis", method="POST", body="patient_ID=5&type=flu&information=")
+        self.assertEqual(response.code, 400)
+        self.assertFalse(self.io_loop.run_sync(lambda: main.r.exists("diagnosis:1")))
+
+    def test_link_and_chart(self):
+        """Тест: связь врача и пациента и карта пациента без SORT ... GET"""
+        self.post("/hospital", "name=H&address=A&phone=1&beds_number=1")
+        self.post("/doctor", "surname=House&profession=diagnostician&hospital_ID=1")
+        self.post("/patient", "surname=Smith&born_date=1990-01-01&sex=F&mpn=100")
+        self.post("/diagnosis", "patient_ID=1&type=flu&information=")
+        self.post("/doctor-patient", "doctor_ID=1&patient_ID=1")
+        response = self.fetch("/doctor-patient", method="POST", body="doctor_ID=1&patient_ID=1")
+        self.assertEqual(response.code, 200)
+
+        members = self.io_loop.run_sync(lambda: main.r.smembers("doctor-patient:1"))
+        self.assertEqual(members, {b"1"})
+
+        chart = json.loads(self.fetch("/patient/1/chart").body)
+        self.assertEqual(chart['patient']['surname'], "Smith")
+        self.assertEqual(chart['diagnoses'], [{'id': 1, 'type': "flu", 'information': ""}])
+        self.assertEqual(chart['doctors'],
+                         [{'id': 1, 'surname': "House", 'profession': "diagnostician", 'hospital_ID': "1"}])
+        self.assertEqual(self.fetch("/patient/2/chart").code, 404)
+
+    def test_patient_by_mpn(self):
+        """Тест поиска по номеру полиса без Lua-скрипта"""
+        self.post("/patient", "surname=Smith&born_date=1990-01-01&sex=F&mpn=100")
+
+        response = self.fetch("/patient/by-mpn/100")
+        self.assertEqual(response.code, 200)
+        self.assertEqual(json.loads(response.body)['patient']['surname'], "Smith")
+        self.assertEqual(self.fetch("/patient/by-mpn/200").code, 404)
+
+    def test_import(self):
+        """Тест: импорт пишет записи всех созданных строк"""
+        body = "\n".join(json.dumps({'surname': f"P{i}", 'born_date': "1990-01-01", 'sex': "M", 'mpn': "1"})
+                         for i in range(3))
+        report = json.loads(self.post("/import/patient", body))
+
+        self.assertEqual(report['created'], 1)
+        self.assertEqual(report['failed'], 2)
+        records = self.io_loop.run_sync(lambda: dump_database(main.r))
+        self.assertEqual(records[b"patient:1"][b"surname"], b"P0")
+        self.assertNotIn(b"patient:2", records)
+
+
+@unittest.skipIf(fakeredis is None, "fakeredis[lua] is not installed")
+class TestClusterKeyLayout(unittest.TestCase):
+    """Тесты раскладки ключей для Redis Cluster"""
+
+    ROWS = [
+        ("hospital", {'name': 'H', 'address': 'A', 'phone': '1', 'beds_number': '10'}),
+        ("doctor", {'surname': 'D', 'profession': 'P', 'hospital_ID': '1'}),
+        ("patient", {'surname': 'S', 'born_date': '1990-01-01', 'sex': 'F', 'mpn': '1'}),
+        ("doctor-patient", {'doctor_ID': '1', 'patient_ID': '1'}),
+        ("diagnosis", {'patient_ID': '1', 'type': 'flu', 'information': ''}),
+    ]
+
+    def test_scripts_use_model_slot(self):
+        """Тест: скрипты кластера обращаются к слоту модели, индексы сущностей - к слотам их записей"""
+        from redis.crc import key_slot
+
+        for model, data in self.ROWS:
+            unique, model_commands, entity_commands, fanouts = main.MODELS[model].get_cluster_commands(data)
+            slot = key_slot(f"{{{model}}}".encode())
+            names = [main.AUTO_ID_KEY.format(model), main.PENDING_KEY.format(model), main.IDS_KEY.format(model)]
+            names += unique[::2] + [command[1] for command in model_commands]
+            # Команды FANOUT после развертывания
+            names += [command[1] for args in fanouts for command in main.expand_fanout(args, [b"1"])]
+            for name in names:
+                if ":" in name:
+                    self.assertEqual(key_slot(name.encode()), slot, (model, name))
+            for command in entity_commands:
+                record = main.key_tag(command[1])
+                self.assertIn(record.split(":")[0], main.MODELS, (model, command))
+                self.assertEqual(key_slot(command[1].encode()), key_slot(record.encode()), (model, command))
+
+    def test_same_data_as_single_mode(self):
+        """Тест: в режиме кластера создаются те же ключи, что и без него"""
+
+        async def scenario(cluster):
+            redis_conn = fakeredis.FakeAsyncRedis(server=fakeredis.FakeServer())
+            with patch.object(main, 'r', redis_conn), patch.object(main, 'CLUSTER_MODE', cluster):
+                await main.init_db()
+                for model, data in self.ROWS:
+                    model = main.MODELS[model]
+                    if cluster:
+                        result, = await main.ClusterCreate(model).create([data])
+                    else:
+                        result = model.parse_result(await create_row(redis_conn, model.name, data))
+                    self.assertTrue(result[1], (model.name, result))
+                return await dump_database(redis_conn)
+
+        single = run(scenario(False))
+        self.assertIn(b"doctor-patient:1", single)
+        self.assertEqual(run(scenario(True)), single)
+
+
+@unittest.skipIf(fakeredis is None, "fakeredis[lua] is not installed")
+class TestClusterCreate(unittest.TestCase):
+    """Тесты создания по шагам в режиме кластера: журнал и восстановление"""
+
+    class FailingCreate(main.ClusterCreate):
+        """Создание, прерванное сбоем Redis на первой команде fail(command)"""
+
+        def __init__(self, model, fail):
+            super().__init__(main.MODELS[model])
+            self.fail = fail
+
+        async def run(self, calls):
+            if any(self.fail(command) for command, _ in calls):
+                raise redis.exceptions.ConnectionError("Connection lost")
+            await super().run(calls)
+
+    def scenario(self, steps):
+        async def scenario():
+            redis_conn = fakeredis.FakeAsyncRedis(server=fakeredis.FakeServer())
+            with patch.object(main, 'r', redis_conn), patch.object(main, 'CLUSTER_MODE', True):
+                await main.init_db()
+                for model, data in TestClusterKeyLayout.ROWS[:3]:
+                    await main.create_records(main.MODELS[model], [data])
+                await main.create_records(main.MODELS["doctor-patient"], [{'doctor_ID': '1', 'patient_ID': '1'}])
+                await steps(redis_conn)
+
+        run(scenario())
+
+    def test_interrupted_before_record_rolled_back(self):
+        """Тест: создание, прерванное до записи сущности, откатывается - номер полиса освобождается"""
+        data = {'surname': 'T', 'born_date': '1990-01-01', 'sex': 'F', 'mpn': '2'}
+
+        async def steps(redis_conn):
+            create = self.FailingCreate("patient", lambda command: command[:2] == ("HSET", "patient:2"))
+            with self.assertRaises(redis.exceptions.ConnectionError):
+                await create.create([data])
+            self.assertEqual(await redis_conn.hget(main.PATIENT_MPN_KEY, "2"), b"2")
+            # Свежая запись журнала не трогается
+            self.assertEqual(await main.recover_pending(), {})
+            self.assertEqual(await redis_conn.hlen("{patient}:pending"), 1)
+
+            self.assertEqual(await main.recover_pending(timeout=0), {'patient': (0, 1)})
+            self.assertFalse(await redis_conn.exists("{patient}:pending"))
+            self.assertIsNone(await redis_conn.hget(main.PATIENT_MPN_KEY, "2"))
+            self.assertEqual(await redis_conn.zrange(main.IDS_KEY.format("patient"), 0, -1), [b"1"])
+            result, = await main.create_records(main.MODELS["patient"], [data])
+            self.assertEqual(result, (3, True, None))
+
+        self.scenario(steps)
+
+    def test_interrupted_before_commit_finished(self):
+        """Тест: создание, прерванное после записи сущности, завершается вместе с FANOUT"""
+        data = {'patient_ID': '1', 'type': 'flu', 'information': ''}
+
+        async def steps(redis_conn):
+            create = self.FailingCreate("diagnosis", lambda command: command[:2] == (
+                "EVALSHA", main.commit_entity_script.sha))
+            with self.assertRaises(redis.exceptions.ConnectionError):
+                await create.create([data])
+            self.assertEqual(await redis_conn.smembers(main.PATIENT_DIAGNOSES_KEY.format(1)), {b"1"})
+            self.assertIsNone(await redis_conn.get(main.ENTITY_COUNT_KEY.format("diagnosis")))
+
+            self.assertEqual(await main.recover_pending(timeout=0), {'diagnosis': (1, 0)})
+            self.assertFalse(await redis_conn.exists("{diagnosis}:pending"))
+            self.assertEqual(await redis_conn.get(main.ENTITY_COUNT_KEY.format("diagnosis")), b"1")
+            self.assertEqual(await redis_conn.zrange(main.HOSPITAL_DIAGNOSIS_TYPES_KEY.format(1), 0, -1,
+                                                     withscores=True), [(b"flu", 1.0)])
+            # Повторное восстановление ничего не меняет
+            self.assertEqual(await main.recover_pending(timeout=0), {})
+            self.assertEqual(await redis_conn.get(main.ENTITY_COUNT_KEY.format("diagnosis")), b"1")
+
+        self.scenario(steps)
+
+    def test_interrupted_link_rolled_back(self):
+        """Тест: связь, прерванная до записи, откатывается без следов в индексе пациента"""
+        data = {'doctor_ID': '1', 'patient_ID': '2'}
+
+        async def steps(redis_conn):
+            await main.create_records(main.MODELS["patient"], [
+                {'surname': 'T', 'born_date': '1990-01-01', 'sex': 'F', 'mpn': '2'}])
+            create = self.FailingCreate("doctor-patient", lambda command: command[0] == "SADD")
+            with self.assertRaises(redis.exceptions.ConnectionError):
+                await create.create([data])
+            # Из pipeline шага 3 успел выполниться только индекс пациента
+            await redis_conn.sadd(main.PATIENT_DOCTORS_KEY.format(2), "1")
+
+            self.assertEqual(await main.recover_pending(timeout=0), {'doctor-patient': (0, 1)})
+            self.assertFalse(await redis_conn.exists(main.PATIENT_DOCTORS_KEY.format(2)))
+            self.assertEqual(await redis_conn.get(main.ENTITY_COUNT_KEY.format("doctor-patient")), b"1")
+
+        self.scenario(steps)
+
+    def test_repeated_link_not_journaled(self):
+        """Тест: повтор существующей связи не попадает в журнал и не учитывается дважды при восстановлении"""
+        data = {'doctor_ID': '1', 'patient_ID': '1'}
+
+        async def steps(redis_conn):
+            create = self.FailingCreate("doctor-patient", lambda command: command[0] == "SADD")
+            with self.assertRaises(redis.exceptions.ConnectionError):
+                await create.create([data])
+            self.assertFalse(await redis_conn.exists("{doctor-patient}:pending"))
+
+            self.assertEqual(await main.recover_pending(timeout=0), {})
+            result, = await main.create_records(main.MODELS["doctor-patient"], [data])
+            self.assertEqual(result, (None, True, None))
+            self.assertEqual(await redis_conn.get(main.ENTITY_COUNT_KEY.format("doctor-patient")), b"1")
+
+        self.scenario(steps)
+
+
+@unittest.skipIf(fakeredis is None, "fakeredis[lua] is not installed")
+class TestMigrateLayout(unittest.TestCase):
+    """Тесты переноса базы из раскладки ключей без хеш-тегов"""
+
+    LEGACY = {
+        "hospital:1": {"name": "H", "address": "A"},
+        "doctor:1": {"surname": "D", "profession": "P", "hospital_ID": "1"},
+        "patient:1": {"surname": "S", "born_date": "1990-01-01", "sex": "F", "mpn": "7"},
+    }
+
+    async def make_legacy(self):
+        redis_conn = fakeredis.FakeAsyncRedis(server=fakeredis.FakeServer())
+        for key, record in self.LEGACY.items():
+            await redis_conn.hset(key, mapping=record)
+        await redis_conn.sadd("doctor-patient:1", "1")
+        for model in main.ENTITY_MODELS:
+            await redis_conn.set(f"{model}:autoID", 5)
+        await redis_conn.set("db_initiated", 1)
+        await redis_conn.set("db:index_version", 8)
+        await redis_conn.sadd("hospital-doctor:1", "1")
+        await redis_conn.hset("index:patient-mpn", "7", "1")
+        return redis_conn
+
+    async def assert_migrated(self, redis_conn):
+        self.assertEqual(await redis_conn.get("{patient}:autoID"), b"5")
+        self.assertEqual(await redis_conn.get(main.DB_INITIATED_KEY), b"1")
+        self.assertEqual(await redis_conn.hgetall("patient:1"),
+                         {key.encode(): value.encode() for key, value in self.LEGACY["patient:1"].items()})
+        self.assertEqual(await redis_conn.smembers("doctor-patient:1"), {b"1"})
+        # Индексы перестроены в ключах с хеш-тегом
+        self.assertEqual(await redis_conn.smembers("{hospital:1}:doctors"), {b"1"})
+        self.assertEqual(await redis_conn.hget(main.PATIENT_MPN_KEY, "7"), b"1")
+        self.assertEqual(await redis_conn.smembers("{patient:1}:doctors"), {b"1"})
+
+    def test_in_place(self):
+        """Тест переноса на месте при инициализации базы"""
+        async def scenario():
+            redis_conn = await self.make_legacy()
+            with patch.object(main, 'r', redis_conn):
+                await main.init_db()
+
+            await self.assert_migrated(redis_conn)
+            keys = await redis_conn.keys("*")
+            self.assertFalse([key for key in keys if not key.startswith(b"{") and key.split(b":")[0] not in
+                              (b"hospital", b"doctor", b"patient", b"doctor-patient")])
+            self.assertNotIn(b"patient:autoID", keys)
+
+        run(scenario())
+
+    def test_from_source(self):
+        """Тест копирования записей из другой базы"""
+        async def scenario():
+            source = await self.make_legacy()
+            target = fakeredis.FakeAsyncRedis(server=fakeredis.FakeServer())
+            with patch.object(main, 'r', target):
+                self.assertEqual(await main.migrate_layout(source), 4)
+
+            await self.assert_migrated(target)
+            self.assertNotIn(b"index:patient-mpn", await target.keys("*"))
+            # Исходная база не изменяется
+            self.assertEqual(await source.get("patient:autoID"), b"5")
+
+        run(scenario())
+
+    def test_meta_layout(self):
+        """Тест переноса базы, где все служебные ключи имели общий тег '{meta}'"""
+        async def scenario():
+            redis_conn = fakeredis.FakeAsyncRedis(server=fakeredis.FakeServer())
+            for key, record in self.LEGACY.items():
+                await redis_conn.hset(key, mapping=record)
+            await redis_conn.sadd("doctor-patient:1", "1")
+            for model in main.ENTITY_MODELS:
+                await redis_conn.set(f"{{meta}}:{model}:autoID", 5)
+                await redis_conn.zadd(f"{{meta}}:{model}:ids", {"1": 1})
+            await redis_conn.zadd("{meta}:doctor-patient:ids", {"1": 1})
+            await redis_conn.hset("{meta}:cache:versions", "patient", 7)
+            await redis_conn.hset("{meta}:index:patient-mpn", "7", "1")
+            await redis_conn.sadd("{meta}:patient-doctor:1", "1")
+            await redis_conn.set(main.DB_INITIATED_KEY, 1)
+            await redis_conn.set(main.INDEX_VERSION_KEY, 9)
+            with patch.object(main, 'r', redis_conn):
+                await main.init_db()
+
+            await self.assert_migrated(redis_conn)
+            self.assertEqual(await redis_conn.get(main.CACHE_VERSION_KEY.format("patient")), b"7")
+            keys = await redis_conn.keys("{meta}*")
+            self.assertEqual(set(keys), {main.DB_INITIATED_KEY.encode(), main.INDEX_VERSION_KEY.encode()})
+
+        run(scenario())
+
+
+@unittest.skipUnless(os.environ.get("REDIS_CLUSTER_TEST_NODE"), "REDIS_CLUSTER_TEST_NODE is not set")
+class TestRealCluster(unittest.TestCase):
+    """Проверка на настоящем Redis Cluster (docker-compose.cluster.yml)
+
+    REDIS_CLUSTER_TEST_NODE - адрес любого узла, например
+    redis://redis-1:6379 в сети compose. Тест очищает все узлы кластера.
+    """
+
+    def test_create_link_and_read(self):
+        """Тест: создание по шагам, восстановление, pipeline и пересчет индексов на узлах кластера"""
+        from redis.asyncio.cluster import RedisCluster
+
+        async def scenario():
+            cluster = RedisCluster.from_url(os.environ["REDIS_CLUSTER_TEST_NODE"])
+            try:
+                await cluster.flushall()
+                with patch.object(main, 'r', cluster), patch.object(main, 'CLUSTER_MODE', True):
+                    await main.init_db()
+                    for model, data in TestClusterKeyLayout.ROWS:
+                        result, = await main.create_records(main.MODELS[model], [data])
+                        self.assertTrue(result[1], (model, result))
+                    await main.recover_pending(timeout=0)
+
+                    pipe = cluster.pipeline(transaction=False)
+                    for model in main.ENTITY_MODELS:
+                        pipe.hgetall(f"{model}:1")
+                    self.assertTrue(all(await pipe.execute()))
+
+                    created = await cluster.smembers("{patient:1}:doctors")
+                    await main.rebuild_indexes()
+                    self.assertEqual(await cluster.smembers("{patient:1}:doctors"), created)
+            finally:
+                await cluster.close()
+
+        run(scenario())
+
+
+class TestReplicaRouting(unittest.TestCase):
+    """Тесты выбора реплик для чтения"""
+
+    def setUp(self):
+        self.manager = main.RedisManager({'REDIS_REPLICAS': 'replica-1:6380, replica-2'})
+        self.primary = make_redis_mock()
+
+    def make_handler(self, handler_class, method, cookie=None):
+        request = Mock()
+        request.method = method
+        request.uri = "/"
+        request.headers = {}
+        request.cookies = {}
+        if cookie is not None:
+            request.cookies[main.LAST_WRITE_COOKIE] = Mock(value=cookie)
+
+        handler = handler_class(Application(), request)
+        handler.set_cookie = MagicMock()
+        return handler
+
+    def test_replica_settings(self):
+        """Тест пулов реплик: адреса и отказ от повторов в пользу перехода на primary"""
+        self.assertEqual(self.manager.settings['replicas'], [('replica-1', 6380), ('replica-2', 6379)])
+        kwargs = [replica.connection_pool.connection_kwargs for replica in self.manager.replicas]
+        self.assertEqual([(kw['host'], kw['port']) for kw in kwargs], [('replica-1', 6380), ('replica-2', 6379)])
+        self.assertEqual(kwargs[0]['retry']._retries, 0)
+        self.assertEqual(main.RedisManager({}).replicas, [])
+
+    def test_round_robin_skips_failed_replicas(self):
+        """Тест выдачи реплик по кругу и пропуска недоступных"""
+        indexes = [self.manager.get_read_connection(self.primary).index for _ in range(3)]
+        self.assertEqual(indexes, [0, 1, 0])
+
+        self.manager.mark_replica_down(0)
+        indexes = [self.manager.get_read_connection(self.primary).index for _ in range(3)]
+        self.assertEqual(indexes, [1, 1, 1])
+        self.assertEqual([replica['available'] for replica in self.manager.replica_stats()], [False, True])
+
+        self.manager.mark_replica_down(1)
+        self.assertIs(self.manager.get_read_connection(self.primary), self.primary)
+
+        # По истечении интервала реплика снова выдается
+        self.manager.replica_down_until[0] = 0.0
+        self.assertEqual(self.manager.get_read_connection(self.primary).index, 0)
+
+    def test_command_failover(self):
+        """Тест повтора команды на primary при ошибке реплики"""
+        replica = make_redis_mock()
+        replica.hget.side_effect = redis.exceptions.ConnectionError()
+        self.manager.replicas[0] = replica
+        self.primary.hget.return_value = b"7"
+        redis_conn = self.manager.get_read_connection(self.primary)
+
+        self.assertEqual(run(redis_conn.hget("key", "field")), b"7")
+        self.assertEqual(run(redis_conn.hget("key", "field")), b"7")
+        replica.hget.assert_awaited_once()
+        self.assertEqual(self.primary.hget.await_count, 2)
+        self.assertFalse(self.manager.replica_stats()[0]['available'])
+
+    def test_pipeline_failover(self):
+        """Тест повтора pipeline на primary при ошибке реплики"""
+        replica = make_redis_mock()
+        replica.pipeline.return_value.execute.side_effect = redis.exceptions.TimeoutError()
+        self.manager.replicas[0] = replica
+        self.primary.pipeline.return_value.execute.return_value = [{b"name": b"H"}]
+        redis_conn = self.manager.get_read_connection(self.primary)
+
+        pipe = redis_conn.pipeline(transaction=False)
+        pipe.hgetall("hospital:1")
+        self.assertEqual(run(pipe.execute()), [{b"name": b"H"}])
+        self.primary.pipeline.assert_called_once_with(transaction=False)
+        self.primary.pipeline.return_value.hgetall.assert_called_once_with("hospital:1")
+
+    def test_failover_error_on_primary_raised(self):
+        """Тест: ошибка primary после перехода передается обработчику"""
+        replica = make_redis_mock()
+        replica.get.side_effect = redis.exceptions.ConnectionError()
+        self.primary.get.side_effect = redis.exceptions.ConnectionError()
+        self.manager.replicas[0] = replica
+
+        with self.assertRaises(redis.exceptions.ConnectionError):
+            run(self.manager.get_read_connection(self.primary).get("key"))
+
+    def test_handler_routing(self):
+        """Тест: чтения GET - с реплики, запись и чтение после записи - с primary"""
+        with patch.object(main, 'redis_manager', self.manager), patch.object(main, 'r', self.primary):
+            handler = self.make_handler(main.HospitalHandler, "GET")
+            self.assertIsInstance(handler.get_redis().client, main.ReplicaRedis)
+            self.assertTrue(handler.replica_reads)
+
+            handler = self.make_handler(main.HospitalHandler, "POST")
+            self.assertIs(handler.get_redis().client, self.primary)
+            self.assertEqual(handler.set_cookie.call_args[0][0], main.LAST_WRITE_COOKIE)
+
+            handler = self.make_handler(main.HospitalHandler, "GET", cookie=f"{time.time():.3f}")
+            self.assertIs(handler.get_redis().client, self.primary)
+            self.assertFalse(handler.replica_reads)
+
+            handler = self.make_handler(main.HospitalHandler, "GET", cookie=f"{time.time() - 60:.3f}")
+            self.assertIsInstance(handler.get_redis().client, main.ReplicaRedis)
+
+            handler = self.make_handler(main.HealthHandler, "GET")
+            self.assertIs(handler.get_redis().client, self.primary)
+
+    def test_no_replicas(self):
+        """Тест: без реплик все запросы идут на primary без cookie"""
+        with patch.object(main, 'r', self.primary):
+            handler = self.make_handler(main.HospitalHandler, "POST")
+            self.assertIs(handler.get_redis().client, self.primary)
+            handler.set_cookie.assert_not_called()
+
+
+@unittest.skipIf(fakeredis is None, "fakeredis[lua] is not installed")
+class TestReplicaReads(tornado.testing.AsyncHTTPTestCase):
+    """Чтение с реплики на Redis в памяти
+
+    Реплика - отдельный сервер fakeredis с копией исходных данных, поэтому
+    записи primary на ней не видны, как при отставании репликации.
+    """
+
+    def setUp(self):
+        # Сохраняем оригинальное соединение с Redis
+        self.original_redis = main.r
+        main.r = fakeredis.FakeAsyncRedis(server=fakeredis.FakeServer())
+        main.response_cache.clear()
+        main.entity_cache.clear()
+
+        self.replica_server = fakeredis.FakeServer()
+        self.manager = main.RedisManager({'REDIS_REPLICAS': 'replica'})
+        self.manager.replicas = [fakeredis.FakeAsyncRedis(server=self.replica_server)]
+        manager = patch.object(main, 'redis_manager', self.manager)
+        manager.start()
+        self.addCleanup(manager.stop)
+
+        super().setUp()
+        self.io_loop.run_sync(lambda: self.seed(main.r))
+        self.io_loop.run_sync(lambda: self.seed(self.manager.replicas[0]))
+
+    def tearDown(self):
+        super().tearDown()
+        # Восстанавливаем оригинальное соединение
+        main.r = self.original_redis
+
+    def runTest(self):
+        # См. TestRoundTripBudgets.runTest
+        pass
+
+    def get_app(self):
+        return main.make_app(production=True)
+
+    async def seed(self, redis_conn):
+        with patch.object(main, 'r', redis_conn):
+            await main.init_db()
+        rows = [
+            ("hospital", {'name': 'H', 'address': 'A', 'phone': '1', 'beds_number': '10'}),
+            ("doctor", {'surname': 'House', 'profession': 'P', 'hospital_ID': '1'}),
+            ("patient", {'surname': 'Smith', 'born_date': '1990-01-01', 'sex': 'F', 'mpn': '1'}),
+            ("doctor-patient", {'doctor_ID': '1', 'patient_ID': '1'}),
+            ("diagnosis", {'patient_ID': '1', 'type': 'flu', 'information': ''}),
+        ]
+        for model, data in rows:
+            await create_row(redis_conn, model, data)
+
+    def test_read_your_writes(self):
+        """Тест: после записи чтения клиента идут на primary, остальные - на реплику"""
+        response = self.fetch("/patient", method="POST", body="surname=New&born_date=2000-01-01&sex=M&mpn=2")
+        self.assertEqual(response.code, 200)
+        cookie = response.headers['Set-Cookie'].split(";")[0]
+        self.assertTrue(cookie.startswith(f"{main.LAST_WRITE_COOKIE}="))
+
+        # Реплика еще не получила запись
+        self.assertEqual(self.fetch("/patient/by-mpn/2").code, 404)
+        response = self.fetch("/patient/by-mpn/2", headers={'Cookie': cookie})
+        self.assertEqual(response.code, 200)
+        self.assertEqual(json.loads(response.body)['patient']['surname'], "New")
+
+    def test_chart_from_replica(self):
+        """Тест: карта пациента с реплики совпадает с картой с primary"""
+        cookie = f"{main.LAST_WRITE_COOKIE}={time.time():.3f}"
+        from_primary = self.fetch("/patient/1/chart", headers={'Cookie': cookie})
+        # Реплика отклоняет SORT: карта читается по индексам и записям
+        with patch.object(redis.asyncio.client.Pipeline, 'sort', side_effect=AssertionError("SORT on replica")):
+            from_replica = self.fetch("/patient/1/chart")
+
+        self.assertEqual(from_replica.code, 200)
+        self.assertEqual(json.loads(from_replica.body), json.loads(from_primary.body))
+        self.assertEqual(len(json.loads(from_replica.body)['doctors']), 1)
+
+    def test_failover_to_primary(self):
+        """Тест: при недоступной реплике чтения идут на primary"""
+        self.fetch("/patient", method="POST", body="surname=New&born_date=2000-01-01&sex=M&mpn=2")
+        self.replica_server.connected = False
+
+        response = self.fetch("/patient/by-mpn/2")
+        self.assertEqual(response.code, 200)
+        health = json.loads(self.fetch("/health").body)
+        self.assertEqual(health['redis'], 'ok')
+        self.assertEqual(health['redis_replicas'], [{'address': "replica:6379", 'available': False}])
+
+
+@unittest.skipIf(fakeredis is None, "fakeredis[lua] is not installed")
+class TestDatasetLoad(unittest.TestCase):
+    """Тесты загрузки синтетического набора (generate_dataset.py)"""
+
+    COUNTS = {'hospital': 2, 'doctor': 3, 'patient': 4, 'diagnosis': 3, 'doctor-patient': 3}
+
+    def load(self, prepare=None):
+        import generate_dataset
+        redis_conn = fakeredis.FakeAsyncRedis(server=fakeredis.FakeServer())
+
+        async def scenario():
+            with patch.object(main, 'r', redis_conn):
+                await main.init_db()
+                if prepare:
+                    await prepare(redis_conn)
+                try:
+                    result = await generate_dataset.load(redis_conn, self.COUNTS, seed=1)
+                except generate_dataset.DatasetError as e:
+                    result = e
+                return result, await redis_conn.get(main.AUTO_ID_KEY.format("diagnosis"))
+
+        return run(scenario())
+
+    def test_references_created_ids(self):
+        """Тест: ссылки набора указывают на ID, выданные скриптом, даже с пропусками"""
+        async def prepare(redis_conn):
+            # Чужие записи заняли ID 1-4: новые больницы получают ID с 5
+            await redis_conn.set(main.AUTO_ID_KEY.format("hospital"), 5)
+
+        generator, next_diagnosis_id = self.load(prepare)
+        self.assertEqual(generator.ids['hospital'], [5, 6])
+        self.assertEqual(generator.ids['patient'], [1, 2, 3, 4])
+        self.assertIn(generator.pick("hospital"), ("5", "6"))
+        self.assertEqual(generator.patient_mpn(2), "1000000002")
+        self.assertEqual(next_diagnosis_id, b"4")
+
+    def test_rejected_rows_raise(self):
+        """Тест: отклоненная скриптом строка прерывает загрузку"""
+        async def prepare(redis_conn):
+            # Номер полиса второго пациента набора уже занят
+            await redis_conn.hset(main.PATIENT_MPN_KEY, "1000000002", 99)
+
+        error, next_diagnosis_id = self.load(prepare)
+        self.assertIn("patient: 1 of 4 rows in batch rejected", str(error))
+        self.assertIn("Patient with such MPN already exists", str(error))
+        # Диагнозы и связи после ошибки не создаются
+        self.assertEqual(next_diagnosis_id, b"1")
 
 
 if __name__ == '__main__':